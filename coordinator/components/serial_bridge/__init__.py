@@ -1,26 +1,215 @@
 import esphome.codegen as cg
 import esphome.config_validation as cv
-from esphome.const import CONF_ID
-from esphome.components import uart
+from esphome import pins
+from esphome.const import (
+    CONF_ID,
+    ENTITY_CATEGORY_DIAGNOSTIC,
+    STATE_CLASS_MEASUREMENT,
+    STATE_CLASS_TOTAL_INCREASING,
+)
+from esphome.components import sensor, uart
 
 DEPENDENCIES = ['wifi', 'uart']
+AUTO_LOAD = ['sensor']
 
 serial_bridge_ns = cg.esphome_ns.namespace('serial_bridge')
-SerialBridge = serial_bridge_ns.class_('SerialBridge', cg.Component)
+SerialBridge = serial_bridge_ns.class_('SerialBridge', cg.PollingComponent)
+BridgeChannel = serial_bridge_ns.class_('BridgeChannel')
+FramingMode = serial_bridge_ns.enum('FramingMode')
 
+FRAMING_MODES = {
+    "none": FramingMode.FRAMING_NONE,
+    "xbee_api": FramingMode.FRAMING_XBEE_API,
+    "xbee_api_escaped": FramingMode.FRAMING_XBEE_API_ESCAPED,
+}
+
+CONF_CHANNELS = "channels"
 CONF_UART_ID = "uart_id"
 CONF_PORT = "port"
+CONF_MAX_CLIENTS = "max_clients"
+CONF_TX_BUFFER_SIZE = "tx_buffer_size"
+CONF_FLUSH_THRESHOLD = "flush_threshold"
+CONF_FLUSH_TIMEOUT = "flush_timeout"
+CONF_RX_BUFFER_SIZE = "rx_buffer_size"
+CONF_MAX_BYTES_PER_LOOP = "max_bytes_per_loop"
+CONF_FRAMING = "framing"
+CONF_FRAME_TIMEOUT = "frame_timeout"
+CONF_RFC2217 = "rfc2217"
+CONF_DTR_PIN = "dtr_pin"
+CONF_RTS_PIN = "rts_pin"
+CONF_USE_TASK = "use_task"
+CONF_TASK_PRIORITY = "task_priority"
+CONF_TASK_STACK_SIZE = "task_stack_size"
+CONF_UART_POLL_INTERVAL = "uart_poll_interval"
+CONF_UART_TO_TCP_RATE = "uart_to_tcp_rate"
+CONF_TCP_TO_UART_RATE = "tcp_to_uart_rate"
+CONF_SEND_RETRIES = "send_retries"
+CONF_DROPPED_BYTES = "dropped_bytes"
+CONF_CONNECTIONS = "connections"
+CONF_MAX_BUFFER_FILL = "max_buffer_fill"
+CONF_LOOP_LATENCY = "loop_latency"
+
+# Diagnostic sensors, published every update_interval
+SENSORS = {
+    CONF_UART_TO_TCP_RATE: sensor.sensor_schema(
+        unit_of_measurement="B/s",
+        icon="mdi:upload-network",
+        accuracy_decimals=0,
+        state_class=STATE_CLASS_MEASUREMENT,
+        entity_category=ENTITY_CATEGORY_DIAGNOSTIC,
+    ),
+    CONF_TCP_TO_UART_RATE: sensor.sensor_schema(
+        unit_of_measurement="B/s",
+        icon="mdi:download-network",
+        accuracy_decimals=0,
+        state_class=STATE_CLASS_MEASUREMENT,
+        entity_category=ENTITY_CATEGORY_DIAGNOSTIC,
+    ),
+    CONF_SEND_RETRIES: sensor.sensor_schema(
+        icon="mdi:reload-alert",
+        accuracy_decimals=0,
+        state_class=STATE_CLASS_TOTAL_INCREASING,
+        entity_category=ENTITY_CATEGORY_DIAGNOSTIC,
+    ),
+    CONF_DROPPED_BYTES: sensor.sensor_schema(
+        unit_of_measurement="B",
+        icon="mdi:delete-alert",
+        accuracy_decimals=0,
+        state_class=STATE_CLASS_TOTAL_INCREASING,
+        entity_category=ENTITY_CATEGORY_DIAGNOSTIC,
+    ),
+    CONF_CONNECTIONS: sensor.sensor_schema(
+        icon="mdi:lan-connect",
+        accuracy_decimals=0,
+        state_class=STATE_CLASS_TOTAL_INCREASING,
+        entity_category=ENTITY_CATEGORY_DIAGNOSTIC,
+    ),
+    CONF_MAX_BUFFER_FILL: sensor.sensor_schema(
+        unit_of_measurement="B",
+        icon="mdi:tray-full",
+        accuracy_decimals=0,
+        state_class=STATE_CLASS_MEASUREMENT,
+        entity_category=ENTITY_CATEGORY_DIAGNOSTIC,
+    ),
+    CONF_LOOP_LATENCY: sensor.sensor_schema(
+        unit_of_measurement="ms",
+        icon="mdi:timer-outline",
+        accuracy_decimals=1,
+        state_class=STATE_CLASS_MEASUREMENT,
+        entity_category=ENTITY_CATEGORY_DIAGNOSTIC,
+    ),
+}
+
+
+def power_of_two(value):
+    value = cv.positive_not_null_int(value)
+    if value & (value - 1):
+        raise cv.Invalid(f"{value} is not a power of two")
+    return value
+
+
+CHANNEL_KEYS = (CONF_UART_ID, CONF_PORT, CONF_DTR_PIN, CONF_RTS_PIN, *SENSORS)
+
+
+def single_channel(config):
+    # uart_id/port at the top level is shorthand for a one entry channel list
+    if not isinstance(config, dict):
+        raise cv.Invalid("expected a dictionary")
+    if CONF_CHANNELS in config:
+        for key in CHANNEL_KEYS:
+            if key in config:
+                raise cv.Invalid(f"{key} goes inside {CONF_CHANNELS} when {CONF_CHANNELS} is used")
+        return config
+    if CONF_UART_ID not in config:
+        raise cv.Invalid(f"Either {CONF_UART_ID} or {CONF_CHANNELS} is required")
+    config = dict(config)
+    config[CONF_CHANNELS] = [{key: config.pop(key) for key in CHANNEL_KEYS if key in config}]
+    return config
+
 
-CONFIG_SCHEMA = cv.Schema({
-    cv.GenerateID(): cv.declare_id(SerialBridge),
+def validate_ports(channels):
+    ports = [channel[CONF_PORT] for channel in channels]
+    if len(ports) != len(set(ports)):
+        raise cv.Invalid("Every channel needs its own port")
+    return channels
+
+
+CHANNEL_SCHEMA = cv.Schema({
+    cv.GenerateID(): cv.declare_id(BridgeChannel),
     cv.Required(CONF_UART_ID): cv.use_id(uart.UARTComponent),
     cv.Optional(CONF_PORT, default=8888): cv.port,
-}).extend(cv.COMPONENT_SCHEMA)
+    cv.Optional(CONF_DTR_PIN): pins.gpio_output_pin_schema,
+    cv.Optional(CONF_RTS_PIN): pins.gpio_output_pin_schema,
+}).extend({cv.Optional(key): schema for key, schema in SENSORS.items()})
+
+
+def validate_buffers(config):
+    if config[CONF_FLUSH_THRESHOLD] > config[CONF_TX_BUFFER_SIZE]:
+        raise cv.Invalid(f"{CONF_FLUSH_THRESHOLD} cannot be larger than {CONF_TX_BUFFER_SIZE}")
+    # A pass must be able to drain at least one full read buffer, so the
+    # per-loop budget follows rx_buffer_size when that is raised above it
+    config[CONF_MAX_BYTES_PER_LOOP] = max(
+        config.get(CONF_MAX_BYTES_PER_LOOP, 4096), config[CONF_RX_BUFFER_SIZE]
+    )
+    return config
+
+
+CONFIG_SCHEMA = cv.All(
+    single_channel,
+    cv.Schema({
+        cv.GenerateID(): cv.declare_id(SerialBridge),
+        cv.Required(CONF_CHANNELS): cv.All(cv.ensure_list(CHANNEL_SCHEMA), cv.Length(min=1), validate_ports),
+        cv.Optional(CONF_MAX_CLIENTS, default=4): cv.int_range(min=1, max=8),
+        cv.Optional(CONF_TX_BUFFER_SIZE, default=2048): power_of_two,
+        cv.Optional(CONF_FLUSH_THRESHOLD, default=256): cv.positive_not_null_int,
+        cv.Optional(CONF_FLUSH_TIMEOUT, default="2ms"): cv.positive_time_period_milliseconds,
+        cv.Optional(CONF_RX_BUFFER_SIZE, default=1024): cv.int_range(min=64, max=16384),
+        cv.Optional(CONF_MAX_BYTES_PER_LOOP): cv.positive_not_null_int,
+        cv.Optional(CONF_FRAMING, default="none"): cv.enum(FRAMING_MODES, lower=True),
+        cv.Optional(CONF_FRAME_TIMEOUT, default="5ms"): cv.positive_time_period_milliseconds,
+        cv.Optional(CONF_RFC2217, default=False): cv.boolean,
+        cv.Optional(CONF_USE_TASK, default=False): cv.boolean,
+        cv.Optional(CONF_TASK_PRIORITY, default=5): cv.int_range(min=1, max=24),
+        cv.Optional(CONF_TASK_STACK_SIZE, default=4096): cv.int_range(min=2048, max=32768),
+        cv.Optional(CONF_UART_POLL_INTERVAL, default="1ms"): cv.All(
+            cv.positive_time_period_milliseconds,
+            cv.Range(min=cv.TimePeriod(milliseconds=1), max=cv.TimePeriod(milliseconds=100)),
+        ),
+    }).extend(cv.polling_component_schema("10s")),
+    validate_buffers,
+)
 
 async def to_code(config):
     var = cg.new_Pvariable(config[CONF_ID])
     await cg.register_component(var, config)
-    
-    uart_var = await cg.get_variable(config[CONF_UART_ID])
-    cg.add(var.set_uart_parent(uart_var))
-    cg.add(var.set_port(config[CONF_PORT]))
+
+    for channel_config in config[CONF_CHANNELS]:
+        channel = cg.new_Pvariable(channel_config[CONF_ID])
+        uart_var = await cg.get_variable(channel_config[CONF_UART_ID])
+        cg.add(channel.set_uart_parent(uart_var))
+        cg.add(channel.set_port(channel_config[CONF_PORT]))
+        if CONF_DTR_PIN in channel_config:
+            pin = await cg.gpio_pin_expression(channel_config[CONF_DTR_PIN])
+            cg.add(channel.set_dtr_pin(pin))
+        if CONF_RTS_PIN in channel_config:
+            pin = await cg.gpio_pin_expression(channel_config[CONF_RTS_PIN])
+            cg.add(channel.set_rts_pin(pin))
+        for key in SENSORS:
+            if key in channel_config:
+                sens = await sensor.new_sensor(channel_config[key])
+                cg.add(getattr(channel, f"set_{key}_sensor")(sens))
+        cg.add(var.add_channel(channel))
+
+    cg.add(var.set_max_clients(config[CONF_MAX_CLIENTS]))
+    cg.add(var.set_tx_buffer_size(config[CONF_TX_BUFFER_SIZE]))
+    cg.add(var.set_flush_threshold(config[CONF_FLUSH_THRESHOLD]))
+    cg.add(var.set_flush_timeout(config[CONF_FLUSH_TIMEOUT]))
+    cg.add(var.set_rx_buffer_size(config[CONF_RX_BUFFER_SIZE]))
+    cg.add(var.set_max_bytes_per_loop(config[CONF_MAX_BYTES_PER_LOOP]))
+    cg.add(var.set_framing(config[CONF_FRAMING]))
+    cg.add(var.set_frame_timeout(config[CONF_FRAME_TIMEOUT]))
+    cg.add(var.set_rfc2217(config[CONF_RFC2217]))
+    cg.add(var.set_use_task(config[CONF_USE_TASK]))
+    cg.add(var.set_task_priority(config[CONF_TASK_PRIORITY]))
+    cg.add(var.set_task_stack_size(config[CONF_TASK_STACK_SIZE]))
+    cg.add(var.set_uart_poll_interval(config[CONF_UART_POLL_INTERVAL]))
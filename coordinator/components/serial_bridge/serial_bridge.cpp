@@ -1,10 +1,15 @@
 #include "serial_bridge.h"
 
+#include <algorithm>
+#include <cstring>
+
 #ifdef USE_ESP32
 #include "lwip/sockets.h"
 #include "lwip/netdb.h"
 #include "fcntl.h"
 #include "errno.h"
+#include "freertos/FreeRTOS.h"
+#include "freertos/task.h"
 #endif
 
 namespace esphome {
@@ -12,109 +17,923 @@ namespace serial_bridge {
 
 static const char *TAG = "serial_bridge";
 
+// TCP keepalive on client sockets, a half-open peer is dropped after ~11 s
+static const int KEEPALIVE_IDLE_S = 5;
+static const int KEEPALIVE_INTERVAL_S = 2;
+static const int KEEPALIVE_COUNT = 3;
+
+static const uint8_t XBEE_FRAME_DELIMITER = 0x7E;
+static const uint8_t XBEE_ESCAPE = 0x7D;
+
+// Telnet (RFC 854) commands and options used by RFC 2217
+static const uint8_t TELNET_IAC = 255;
+static const uint8_t TELNET_DONT = 254;
+static const uint8_t TELNET_DO = 253;
+static const uint8_t TELNET_WONT = 252;
+static const uint8_t TELNET_WILL = 251;
+static const uint8_t TELNET_SB = 250;
+static const uint8_t TELNET_SE = 240;
+static const uint8_t TELNET_OPTION_BINARY = 0;
+static const uint8_t TELNET_OPTION_SGA = 3;
+static const uint8_t TELNET_OPTION_COM_PORT = 44;
+
+// RFC 2217 client commands, the server answers with the command + 100
+static const uint8_t RFC2217_SET_BAUDRATE = 1;
+static const uint8_t RFC2217_SET_DATASIZE = 2;
+static const uint8_t RFC2217_SET_PARITY = 3;
+static const uint8_t RFC2217_SET_STOPSIZE = 4;
+static const uint8_t RFC2217_SET_CONTROL = 5;
+static const uint8_t RFC2217_NOTIFY_MODEMSTATE = 7;
+static const uint8_t RFC2217_FLOWCONTROL_SUSPEND = 8;
+static const uint8_t RFC2217_FLOWCONTROL_RESUME = 9;
+static const uint8_t RFC2217_SET_LINESTATE_MASK = 10;
+static const uint8_t RFC2217_SET_MODEMSTATE_MASK = 11;
+static const uint8_t RFC2217_PURGE_DATA = 12;
+static const uint8_t RFC2217_SERVER_OFFSET = 100;
+
+static const uint8_t RFC2217_PARITY_NONE = 1;
+static const uint8_t RFC2217_PARITY_ODD = 2;
+static const uint8_t RFC2217_PARITY_EVEN = 3;
+
+static const uint8_t RFC2217_CONTROL_FLOW_REQUEST = 0;
+static const uint8_t RFC2217_CONTROL_FLOW_NONE = 1;
+static const uint8_t RFC2217_CONTROL_FLOW_HARDWARE = 3;
+static const uint8_t RFC2217_CONTROL_BREAK_REQUEST = 4;
+static const uint8_t RFC2217_CONTROL_BREAK_ON = 5;
+static const uint8_t RFC2217_CONTROL_BREAK_OFF = 6;
+static const uint8_t RFC2217_CONTROL_DTR_REQUEST = 7;
+static const uint8_t RFC2217_CONTROL_DTR_ON = 8;
+static const uint8_t RFC2217_CONTROL_DTR_OFF = 9;
+static const uint8_t RFC2217_CONTROL_RTS_REQUEST = 10;
+static const uint8_t RFC2217_CONTROL_RTS_ON = 11;
+static const uint8_t RFC2217_CONTROL_RTS_OFF = 12;
+
+static const uint8_t RFC2217_PURGE_RECEIVE = 1;
+static const uint8_t RFC2217_PURGE_BOTH = 3;
+
+// CTS, DSR and CD asserted, we have no inputs to report
+static const uint8_t RFC2217_MODEMSTATE = 0xB0;
+
 void SerialBridge::setup() {
-  ESP_LOGI(TAG, "Serial bridge component ready, will start server when WiFi connects");
+  // One allocation holds the TX rings of all channels, one RX buffer serves them all
+  this->tx_pool_.reset(new uint8_t[this->tx_buffer_size_ * this->channels_.size()]);
+  this->rx_buffer_.reset(new uint8_t[this->rx_buffer_size_]);
+  uint8_t *tx_buffer = this->tx_pool_.get();
+  for (auto *channel : this->channels_) {
+    channel->tx_buffer_ = tx_buffer;
+    tx_buffer += this->tx_buffer_size_;
+    channel->clients_.resize(this->max_clients_);
+    if (channel->dtr_pin_ != nullptr) {
+      channel->dtr_pin_->setup();
+    }
+    if (channel->rts_pin_ != nullptr) {
+      channel->rts_pin_->setup();
+    }
+    this->set_dtr_(*channel, false);
+    this->set_rts_(*channel, false);
+    channel->last_pass_ = micros();
+  }
+  this->last_update_ = millis();
+#ifdef USE_ESP32
+  if (this->use_task_) {
+    if (xTaskCreate(SerialBridge::task_func_, "serial_bridge", this->task_stack_size_, this, this->task_priority_,
+                    &this->task_handle_) != pdPASS) {
+      ESP_LOGE(TAG, "Failed to create bridge task");
+      this->mark_failed();
+      return;
+    }
+  }
+#endif
+  ESP_LOGI(TAG, "Serial bridge component ready with %u channel(s), will start servers when WiFi connects",
+           (unsigned) this->channels_.size());
+}
+
+void SerialBridge::update() {
+  // Runs at update_interval, so publishing never slows down the data path.
+  // In task mode the counters are written by the bridge task, a peak reset
+  // racing with a new peak only loses that one sample.
+  const uint32_t now = millis();
+  const float seconds = (now - this->last_update_) / 1000.0f;
+  this->last_update_ = now;
+  for (auto *channel : this->channels_) {
+    BridgeStats &stats = channel->stats_;
+    const uint32_t uart_to_tcp = stats.uart_to_tcp_bytes - channel->last_uart_to_tcp_bytes_;
+    const uint32_t tcp_to_uart = stats.tcp_to_uart_bytes - channel->last_tcp_to_uart_bytes_;
+    channel->last_uart_to_tcp_bytes_ = stats.uart_to_tcp_bytes;
+    channel->last_tcp_to_uart_bytes_ = stats.tcp_to_uart_bytes;
+    const uint32_t max_buffer_fill = stats.max_buffer_fill;
+    const uint32_t max_loop_gap = stats.max_loop_gap;
+    stats.max_buffer_fill = 0;
+    stats.max_loop_gap = 0;
+    ESP_LOGV(TAG, "Port %u: %u B UART->TCP, %u B TCP->UART, peak fill %u B", channel->port_, (unsigned) uart_to_tcp,
+             (unsigned) tcp_to_uart, (unsigned) max_buffer_fill);
+#ifdef USE_SENSOR
+    if (seconds > 0) {
+      if (channel->uart_to_tcp_rate_sensor_ != nullptr) {
+        channel->uart_to_tcp_rate_sensor_->publish_state(uart_to_tcp / seconds);
+      }
+      if (channel->tcp_to_uart_rate_sensor_ != nullptr) {
+        channel->tcp_to_uart_rate_sensor_->publish_state(tcp_to_uart / seconds);
+      }
+    }
+    if (channel->send_retries_sensor_ != nullptr) {
+      channel->send_retries_sensor_->publish_state(stats.send_retries);
+    }
+    if (channel->dropped_bytes_sensor_ != nullptr) {
+      channel->dropped_bytes_sensor_->publish_state(stats.dropped_bytes);
+    }
+    if (channel->connections_sensor_ != nullptr) {
+      channel->connections_sensor_->publish_state(stats.connections);
+    }
+    if (channel->max_buffer_fill_sensor_ != nullptr) {
+      channel->max_buffer_fill_sensor_->publish_state(max_buffer_fill);
+    }
+    if (channel->loop_latency_sensor_ != nullptr) {
+      channel->loop_latency_sensor_->publish_state(max_loop_gap / 1000.0f);
+    }
+#endif
+  }
 }
 
 void SerialBridge::loop() {
 #ifdef USE_ESP32
-  // Check if WiFi is connected and server needs to be started
-  if (!this->server_started_ && wifi::global_wifi_component->is_connected()) {
-    // Create socket
-    this->server_socket_ = socket(AF_INET, SOCK_STREAM, 0);
-    if (this->server_socket_ < 0) {
-      ESP_LOGE(TAG, "Failed to create socket");
-      return;
+  // In task mode all socket and UART work happens in task_func_()
+  if (!this->use_task_) {
+    this->run_once_();
+  }
+#endif
+}
+
+#ifdef USE_ESP32
+void SerialBridge::task_func_(void *arg) {
+  auto *bridge = static_cast<SerialBridge *>(arg);
+  while (true) {
+    bridge->wait_for_events_();
+    bridge->run_once_();
+  }
+}
+
+void SerialBridge::wait_for_events_() {
+  fd_set read_fds;
+  fd_set write_fds;
+  FD_ZERO(&read_fds);
+  FD_ZERO(&write_fds);
+  int max_fd = -1;
+  for (auto *channel : this->channels_) {
+    if (!channel->server_started_) {
+      continue;
     }
+    bool slot_free = false;
+    for (auto &client : channel->clients_) {
+      slot_free |= client.socket < 0;
+    }
+    // With every slot taken, a queued connection would keep the listener
+    // readable and select() would return at once on every pass. It waits in
+    // the backlog until a client leaves instead.
+    if (slot_free) {
+      FD_SET(channel->server_socket_, &read_fds);
+      max_fd = std::max(max_fd, channel->server_socket_);
+    }
+    for (auto &client : channel->clients_) {
+      if (client.socket < 0) {
+        continue;
+      }
+      FD_SET(client.socket, &read_fds);
+      // Only wait for writability when the last send would have blocked,
+      // otherwise select() returns immediately while data waits for its flush timeout.
+      if (client.blocked) {
+        FD_SET(client.socket, &write_fds);
+      }
+      max_fd = std::max(max_fd, client.socket);
+    }
+  }
+  if (max_fd < 0) {
+    // Nothing to select on until WiFi is up and the servers are listening
+    vTaskDelay(pdMS_TO_TICKS(100));
+    return;
+  }
 
-    // Set socket options
-    int opt = 1;
-    setsockopt(this->server_socket_, SOL_SOCKET, SO_REUSEADDR, &opt, sizeof(opt));
+  // The UART driver does not expose a selectable descriptor, so the timeout doubles as the UART poll interval.
+  struct timeval timeout;
+  timeout.tv_sec = 0;
+  timeout.tv_usec = this->uart_poll_interval_ * 1000;
+  select(max_fd + 1, &read_fds, &write_fds, nullptr, &timeout);
+}
 
-    // Bind socket
-    struct sockaddr_in server_addr;
-    server_addr.sin_family = AF_INET;
-    server_addr.sin_addr.s_addr = INADDR_ANY;
-    server_addr.sin_port = htons(this->port_);
+void SerialBridge::run_once_() {
+  if (!wifi::global_wifi_component->is_connected()) {
+    return;
+  }
+  for (auto *channel : this->channels_) {
+    if (!channel->server_started_ && !this->start_server_(*channel)) {
+      continue;
+    }
 
-    if (bind(this->server_socket_, (struct sockaddr *)&server_addr, sizeof(server_addr)) < 0) {
-      ESP_LOGE(TAG, "Failed to bind socket to port %d", this->port_);
-      close(this->server_socket_);
-      this->server_socket_ = -1;
-      return;
+    const uint32_t now = micros();
+    channel->stats_.max_loop_gap = std::max(channel->stats_.max_loop_gap, now - channel->last_pass_);
+    channel->last_pass_ = now;
+
+    // Forward TCP -> UART. Done before accepting, so a hangup has freed the
+    // owner role by the time a reconnecting client is accepted.
+    for (auto &client : channel->clients_) {
+      if (client.socket >= 0) {
+        this->read_client_(*channel, client);
+      }
     }
 
-    // Listen
-    if (listen(this->server_socket_, 1) < 0) {
-      ESP_LOGE(TAG, "Failed to listen on socket");
-      close(this->server_socket_);
-      this->server_socket_ = -1;
-      return;
+    this->accept_clients_(*channel);
+    if (!this->has_clients_(*channel)) {
+      continue;
     }
 
-    // Set non-blocking
-    fcntl(this->server_socket_, F_SETFL, O_NONBLOCK);
+    // Forward UART -> TCP
+    this->read_uart_(*channel);
+    for (auto &client : channel->clients_) {
+      if (client.socket >= 0) {
+        this->flush_client_(*channel, client);
+      }
+    }
+  }
+}
 
-    this->server_started_ = true;
-    ESP_LOGI(TAG, "TCP server started on port %d", this->port_);
+bool SerialBridge::start_server_(BridgeChannel &channel) {
+  // Create socket
+  channel.server_socket_ = socket(AF_INET, SOCK_STREAM, 0);
+  if (channel.server_socket_ < 0) {
+    ESP_LOGE(TAG, "Failed to create socket");
+    return false;
   }
 
-  // Only proceed if server is started and WiFi is still connected
-  if (!this->server_started_ || !wifi::global_wifi_component->is_connected()) {
-    return;
+  // Set socket options
+  int opt = 1;
+  setsockopt(channel.server_socket_, SOL_SOCKET, SO_REUSEADDR, &opt, sizeof(opt));
+
+  // Bind socket
+  struct sockaddr_in server_addr;
+  server_addr.sin_family = AF_INET;
+  server_addr.sin_addr.s_addr = INADDR_ANY;
+  server_addr.sin_port = htons(channel.port_);
+
+  if (bind(channel.server_socket_, (struct sockaddr *)&server_addr, sizeof(server_addr)) < 0) {
+    ESP_LOGE(TAG, "Failed to bind socket to port %d", channel.port_);
+    close(channel.server_socket_);
+    channel.server_socket_ = -1;
+    return false;
+  }
+
+  // Listen
+  if (listen(channel.server_socket_, this->max_clients_) < 0) {
+    ESP_LOGE(TAG, "Failed to listen on socket");
+    close(channel.server_socket_);
+    channel.server_socket_ = -1;
+    return false;
   }
 
-  // Accept new connections
-  if (this->client_socket_ < 0) {
+  // Set non-blocking
+  fcntl(channel.server_socket_, F_SETFL, O_NONBLOCK);
+
+  channel.server_started_ = true;
+  ESP_LOGI(TAG, "TCP server started on port %d", channel.port_);
+  return true;
+}
+
+void SerialBridge::accept_clients_(BridgeChannel &channel) {
+  for (auto &client : channel.clients_) {
+    if (client.socket >= 0) {
+      continue;
+    }
     struct sockaddr_in client_addr;
     socklen_t client_len = sizeof(client_addr);
-    int new_client = accept(this->server_socket_, (struct sockaddr *)&client_addr, &client_len);
-    
-    if (new_client >= 0) {
-      this->client_socket_ = new_client;
-      fcntl(this->client_socket_, F_SETFL, O_NONBLOCK);
-      ESP_LOGI(TAG, "Client connected");
+    int new_client = accept(channel.server_socket_, (struct sockaddr *)&client_addr, &client_len);
+    if (new_client < 0) {
+      return;
+    }
+
+    fcntl(new_client, F_SETFL, O_NONBLOCK);
+    if (this->framing_ != FRAMING_NONE) {
+      // Frames are already coalesced, don't let Nagle hold them back
+      int opt = 1;
+      setsockopt(new_client, IPPROTO_TCP, TCP_NODELAY, &opt, sizeof(opt));
     }
+    // Without keepalive a peer that vanished (WiFi drop, host suspend) would
+    // hold its slot, and the owner role, forever
+    int keepalive = 1;
+    setsockopt(new_client, SOL_SOCKET, SO_KEEPALIVE, &keepalive, sizeof(keepalive));
+#ifdef TCP_KEEPIDLE
+    int idle = KEEPALIVE_IDLE_S;
+    int interval = KEEPALIVE_INTERVAL_S;
+    int count = KEEPALIVE_COUNT;
+    setsockopt(new_client, IPPROTO_TCP, TCP_KEEPIDLE, &idle, sizeof(idle));
+    setsockopt(new_client, IPPROTO_TCP, TCP_KEEPINTVL, &interval, sizeof(interval));
+    setsockopt(new_client, IPPROTO_TCP, TCP_KEEPCNT, &count, sizeof(count));
+#endif
+
+    bool owner_connected = false;
+    for (auto &other : channel.clients_) {
+      owner_connected |= other.socket >= 0 && other.owner;
+    }
+    client = BridgeClient{};
+    client.socket = new_client;
+    // The first client gets read/write access, later ones only watch
+    client.owner = !owner_connected;
+    client.connected_at = millis();
+    // Start from live data, nothing queued before the connect is replayed
+    client.tail = channel.tx_head_;
+    channel.stats_.connections++;
+    ESP_LOGI(TAG, "Client connected (%s)", client.owner ? "owner" : "monitor");
   }
+}
 
-  if (this->client_socket_ >= 0) {
-    // Forward UART -> TCP
-    if (this->uart_) {
-      while (this->uart_->available()) {
-        uint8_t data;
-        if (this->uart_->read_byte(&data)) {
-          if (send(this->client_socket_, &data, 1, 0) < 0) {
-            if (errno != EAGAIN && errno != EWOULDBLOCK) {
-              ESP_LOGD(TAG, "Client disconnected (send failed)");
-              close(this->client_socket_);
-              this->client_socket_ = -1;
-              break;
-            }
+void SerialBridge::close_client_(BridgeChannel &channel, BridgeClient &client) {
+  close(client.socket);
+  client.socket = -1;
+  client.blocked = false;
+  if (this->rfc2217_ && client.owner) {
+    // Like a closed serial port: modem lines drop and the line goes idle.
+    // The line settings stay as the last client left them.
+    this->set_break_(channel, false);
+    this->set_dtr_(channel, false);
+    this->set_rts_(channel, false);
+  }
+  if (!client.owner) {
+    return;
+  }
+  client.owner = false;
+
+  // Hand the port to the newest monitor. That is usually the owner coming
+  // back (a reopen or reconnect that beat the old socket's hangup), and a
+  // long-running watcher keeps its read-only view.
+  BridgeClient *next = nullptr;
+  for (auto &other : channel.clients_) {
+    if (other.socket >= 0 && (next == nullptr || (int32_t) (other.connected_at - next->connected_at) > 0)) {
+      next = &other;
+    }
+  }
+  if (next != nullptr) {
+    next->owner = true;
+    ESP_LOGI(TAG, "Monitor promoted to owner");
+  }
+}
+
+void SerialBridge::read_uart_(BridgeChannel &channel) {
+  const size_t mask = this->tx_buffer_size_ - 1;
+  size_t available = channel.uart_->available();
+  while (available > 0) {
+    size_t space = this->tx_buffer_size_ - (channel.tx_head_ - this->tx_tail_(channel));
+    if (this->rfc2217_) {
+      // 0xFF has to be doubled on the wire, reserve room for the worst case
+      space /= 2;
+    }
+    if (space == 0) {
+      // Hold back, the rest stays in the UART driver buffer until we can send.
+      break;
+    }
+    size_t len;
+    if (this->rfc2217_) {
+      uint8_t chunk[64];
+      len = std::min({available, space, sizeof(chunk)});
+      if (!channel.uart_->read_array(chunk, len)) {
+        break;
+      }
+      this->mark_uart_read_(channel);
+      for (size_t i = 0; i < len; i++) {
+        if (chunk[i] == TELNET_IAC) {
+          channel.tx_buffer_[channel.tx_head_++ & mask] = TELNET_IAC;
+        }
+        channel.tx_buffer_[channel.tx_head_++ & mask] = chunk[i];
+        if (this->framing_ != FRAMING_NONE && this->scan_frame_byte_(channel, chunk[i])) {
+          channel.tx_frame_end_ = channel.tx_head_;
+        }
+      }
+    } else {
+      size_t index = channel.tx_head_ & mask;
+      len = std::min({available, space, this->tx_buffer_size_ - index});
+      uint8_t *data = channel.tx_buffer_ + index;
+      if (!channel.uart_->read_array(data, len)) {
+        break;
+      }
+      this->mark_uart_read_(channel);
+      if (this->framing_ != FRAMING_NONE) {
+        for (size_t i = 0; i < len; i++) {
+          if (this->scan_frame_byte_(channel, data[i])) {
+            channel.tx_frame_end_ = channel.tx_head_ + i + 1;
           }
         }
       }
+      channel.tx_head_ += len;
     }
+    available -= len;
+    channel.stats_.uart_to_tcp_bytes += len;
+    channel.stats_.max_buffer_fill =
+        std::max<uint32_t>(channel.stats_.max_buffer_fill, channel.tx_head_ - this->tx_tail_(channel));
 
-    // Forward TCP -> UART
-    uint8_t buffer[64];
-    int bytes_received = recv(this->client_socket_, buffer, sizeof(buffer), 0);
+    // Monitors never hold the owner back. One that fell a full ring behind
+    // has lost data anyway and skips ahead to live data.
+    for (auto &client : channel.clients_) {
+      if (client.socket >= 0 && channel.tx_head_ - client.tail > this->tx_buffer_size_) {
+        ESP_LOGD(TAG, "Monitor too slow, skipping %u bytes", (unsigned) (channel.tx_head_ - client.tail));
+        channel.stats_.dropped_bytes += channel.tx_head_ - client.tail;
+        client.tail = channel.tx_head_;
+      }
+    }
+  }
+}
+
+void SerialBridge::mark_uart_read_(BridgeChannel &channel) {
+  channel.tx_last_rx_ = millis();
+  for (auto &client : channel.clients_) {
+    if (client.socket >= 0 && client.tail == channel.tx_head_) {
+      client.oldest = channel.tx_last_rx_;
+    }
+  }
+}
+
+bool SerialBridge::scan_frame_byte_(BridgeChannel &channel, uint8_t byte) {
+  const bool escaped = this->framing_ == FRAMING_XBEE_API_ESCAPED;
+  if (byte == XBEE_FRAME_DELIMITER && (escaped || channel.frame_state_ == FRAME_SYNC)) {
+    // In escaped mode a raw delimiter always starts a new frame
+    channel.frame_state_ = FRAME_LENGTH_HIGH;
+    channel.frame_escape_ = false;
+    return false;
+  }
+  if (channel.frame_state_ == FRAME_SYNC) {
+    // Not inside an API frame, e.g. transparent mode text. Flushed on idle.
+    return false;
+  }
+  if (escaped) {
+    if (byte == XBEE_ESCAPE) {
+      channel.frame_escape_ = true;
+      return false;
+    }
+    if (channel.frame_escape_) {
+      byte ^= 0x20;
+      channel.frame_escape_ = false;
+    }
+  }
+  switch (channel.frame_state_) {
+    case FRAME_LENGTH_HIGH:
+      channel.frame_remaining_ = byte << 8;
+      channel.frame_state_ = FRAME_LENGTH_LOW;
+      break;
+    case FRAME_LENGTH_LOW:
+      // Payload plus the trailing checksum byte
+      channel.frame_remaining_ = (channel.frame_remaining_ | byte) + 1;
+      channel.frame_state_ = FRAME_BODY;
+      break;
+    case FRAME_BODY:
+      if (--channel.frame_remaining_ == 0) {
+        channel.frame_state_ = FRAME_SYNC;
+        return true;
+      }
+      break;
+    default:
+      break;
+  }
+  return false;
+}
+
+void SerialBridge::flush_client_(BridgeChannel &channel, BridgeClient &client) {
+  size_t pending = channel.tx_head_ - client.tail;
+  if (pending == 0 && client.control_len == 0) {
+    return;
+  }
+  if (client.control_len > 0) {
+    // A telnet reply waits behind this client's data, everything goes now
+  } else if (client.suspended) {
+    return;
+  } else if (this->framing_ != FRAMING_NONE) {
+    // Complete frames go out right away. A partial frame waits until the UART
+    // has been idle for frame_timeout, or the ring is full and it has to go.
+    if (pending < this->tx_buffer_size_ && millis() - channel.tx_last_rx_ < this->frame_timeout_) {
+      int32_t complete = channel.tx_frame_end_ - client.tail;
+      if (complete <= 0) {
+        return;
+      }
+      pending = complete;
+    }
+  } else if (pending < this->flush_threshold_ && millis() - client.oldest < this->flush_timeout_) {
+    return;
+  }
+
+  const size_t mask = this->tx_buffer_size_ - 1;
+  client.blocked = false;
+  while (pending > 0) {
+    size_t index = client.tail & mask;
+    size_t len = std::min(pending, this->tx_buffer_size_ - index);
+    // Data wrapping around the end of the ring still goes out as one segment
+    int flags = len < pending ? MSG_MORE : 0;
+    ssize_t sent = send(client.socket, channel.tx_buffer_ + index, len, flags);
+    if (sent < 0) {
+      if (errno != EAGAIN && errno != EWOULDBLOCK) {
+        ESP_LOGD(TAG, "Client disconnected (send failed)");
+        this->close_client_(channel, client);
+      } else {
+        // On EAGAIN the data stays queued and is retried on the next loop.
+        client.blocked = true;
+        channel.stats_.send_retries++;
+      }
+      return;
+    }
+    client.tail += sent;
+    pending -= sent;
+    if ((size_t) sent < len) {
+      client.blocked = true;
+      channel.stats_.send_retries++;
+      return;
+    }
+  }
+
+  // Only reached with the data sent up to a whole-byte boundary, so a reply
+  // can never end up between the two halves of an escaped 0xFF.
+  if (client.control_len > 0) {
+    ssize_t sent = send(client.socket, client.control, client.control_len, 0);
+    if (sent < 0) {
+      if (errno != EAGAIN && errno != EWOULDBLOCK) {
+        ESP_LOGD(TAG, "Client disconnected (send failed)");
+        this->close_client_(channel, client);
+      } else {
+        client.blocked = true;
+        channel.stats_.send_retries++;
+      }
+      return;
+    }
+    client.control_len -= sent;
+    memmove(client.control, client.control + sent, client.control_len);
+    client.blocked = client.control_len > 0;
+  }
+}
+
+void SerialBridge::read_client_(BridgeChannel &channel, BridgeClient &client) {
+  size_t total = 0;
+  while (client.socket >= 0 && total < this->max_bytes_per_loop_) {
+    size_t len = std::min(this->rx_buffer_size_, this->max_bytes_per_loop_ - total);
+    int bytes_received = recv(client.socket, this->rx_buffer_.get(), len, 0);
     if (bytes_received > 0) {
-      for (int i = 0; i < bytes_received; i++) {
-        if (this->uart_) {
-          this->uart_->write_byte(buffer[i]);
-        }
+      size_t data_len = bytes_received;
+      if (this->rfc2217_) {
+        data_len = this->process_telnet_(channel, client, this->rx_buffer_.get(), data_len);
+      }
+      // Monitors are read only, whatever they send is dropped
+      if (channel.uart_ && client.owner && data_len > 0) {
+        channel.uart_->write_array(this->rx_buffer_.get(), data_len);
+        channel.stats_.tcp_to_uart_bytes += data_len;
+      }
+      total += bytes_received;
+      if ((size_t) bytes_received < len) {
+        // Socket is drained for now
+        return;
       }
     } else if (bytes_received == 0) {
       ESP_LOGI(TAG, "Client disconnected");
-      close(this->client_socket_);
-      this->client_socket_ = -1;
-    } else if (errno != EAGAIN && errno != EWOULDBLOCK) {
-      ESP_LOGW(TAG, "Recv error, closing client");
-      close(this->client_socket_);
-      this->client_socket_ = -1;
+      this->close_client_(channel, client);
+    } else {
+      if (errno != EAGAIN && errno != EWOULDBLOCK) {
+        ESP_LOGW(TAG, "Recv error, closing client");
+        this->close_client_(channel, client);
+      }
+      return;
+    }
+  }
+}
+
+size_t SerialBridge::process_telnet_(BridgeChannel &channel, BridgeClient &client, uint8_t *data, size_t len) {
+  // Strips telnet commands in place, data bytes are compacted to the front
+  size_t out = 0;
+  for (size_t i = 0; i < len; i++) {
+    uint8_t byte = data[i];
+    switch (client.telnet_state) {
+      case TELNET_STATE_DATA:
+        if (byte == TELNET_IAC) {
+          client.telnet_state = TELNET_STATE_IAC;
+        } else {
+          data[out++] = byte;
+        }
+        break;
+      case TELNET_STATE_IAC:
+        if (byte == TELNET_IAC) {
+          data[out++] = byte;
+          client.telnet_state = TELNET_STATE_DATA;
+        } else if (byte >= TELNET_WILL && byte <= TELNET_DONT) {
+          client.telnet_verb = byte;
+          client.telnet_state = TELNET_STATE_OPTION;
+        } else if (byte == TELNET_SB) {
+          client.telnet_sb_len = 0;
+          client.telnet_state = TELNET_STATE_SB;
+        } else {
+          // NOP, GA and friends carry no payload
+          client.telnet_state = TELNET_STATE_DATA;
+        }
+        break;
+      case TELNET_STATE_OPTION:
+        this->handle_telnet_option_(client, client.telnet_verb, byte);
+        client.telnet_state = TELNET_STATE_DATA;
+        break;
+      case TELNET_STATE_SB:
+        if (byte == TELNET_IAC) {
+          client.telnet_state = TELNET_STATE_SB_IAC;
+        } else if (client.telnet_sb_len < sizeof(client.telnet_sb)) {
+          client.telnet_sb[client.telnet_sb_len++] = byte;
+        }
+        break;
+      case TELNET_STATE_SB_IAC:
+        if (byte == TELNET_IAC) {
+          if (client.telnet_sb_len < sizeof(client.telnet_sb)) {
+            client.telnet_sb[client.telnet_sb_len++] = byte;
+          }
+          client.telnet_state = TELNET_STATE_SB;
+        } else {
+          if (byte == TELNET_SE) {
+            this->handle_subnegotiation_(channel, client);
+          }
+          client.telnet_state = TELNET_STATE_DATA;
+        }
+        break;
     }
   }
+  return out;
+}
+
+void SerialBridge::handle_telnet_option_(BridgeClient &client, uint8_t verb, uint8_t option) {
+  uint8_t bit = 0;
+  switch (option) {
+    case TELNET_OPTION_BINARY:
+      bit = 1 << 0;
+      break;
+    case TELNET_OPTION_SGA:
+      bit = 1 << 1;
+      break;
+    case TELNET_OPTION_COM_PORT:
+      bit = 1 << 2;
+      break;
+  }
+
+  // Only acknowledge state changes (RFC 1143), so negotiation cannot loop
+  switch (verb) {
+    case TELNET_DO:
+      if (bit == 0) {
+        this->send_telnet_option_(client, TELNET_WONT, option);
+      } else if (!(client.telnet_will & bit)) {
+        client.telnet_will |= bit;
+        this->send_telnet_option_(client, TELNET_WILL, option);
+      }
+      break;
+    case TELNET_WILL:
+      if (bit == 0) {
+        this->send_telnet_option_(client, TELNET_DONT, option);
+      } else if (!(client.telnet_do & bit)) {
+        client.telnet_do |= bit;
+        this->send_telnet_option_(client, TELNET_DO, option);
+      }
+      break;
+    case TELNET_DONT:
+      if (client.telnet_will & bit) {
+        client.telnet_will &= ~bit;
+        this->send_telnet_option_(client, TELNET_WONT, option);
+      }
+      break;
+    case TELNET_WONT:
+      if (client.telnet_do & bit) {
+        client.telnet_do &= ~bit;
+        this->send_telnet_option_(client, TELNET_DONT, option);
+      }
+      break;
+  }
+}
+
+void SerialBridge::handle_subnegotiation_(BridgeChannel &channel, BridgeClient &client) {
+  if (client.telnet_sb_len < 2 || client.telnet_sb[0] != TELNET_OPTION_COM_PORT) {
+    return;
+  }
+  const uint8_t command = client.telnet_sb[1];
+  const uint8_t *value = client.telnet_sb + 2;
+  const size_t value_len = client.telnet_sb_len - 2;
+  if (command == RFC2217_SET_BAUDRATE && value_len < 4) {
+    return;
+  }
+  if (value_len == 0 && command != RFC2217_NOTIFY_MODEMSTATE && command != RFC2217_FLOWCONTROL_SUSPEND &&
+      command != RFC2217_FLOWCONTROL_RESUME) {
+    return;
+  }
+
+  if (!client.owner && command >= RFC2217_SET_BAUDRATE && command <= RFC2217_SET_CONTROL) {
+    // Monitors may negotiate whatever they like but never touch the line,
+    // their requests are acknowledged as sent.
+    this->send_subnegotiation_(client, command, value, command == RFC2217_SET_BAUDRATE ? 4 : 1);
+    return;
+  }
+
+  // Every answer carries the setting actually in effect. A client that asked
+  // for something we cannot do sees the old value and reports the failure.
+  switch (command) {
+    case RFC2217_SET_BAUDRATE: {
+      uint32_t baud_rate = (uint32_t(value[0]) << 24) | (uint32_t(value[1]) << 16) | (uint32_t(value[2]) << 8) | value[3];
+      if (baud_rate != 0 && baud_rate != channel.uart_->get_baud_rate()) {
+        ESP_LOGI(TAG, "Client set baud rate to %u", (unsigned) baud_rate);
+        channel.uart_->flush();
+        channel.uart_->set_baud_rate(baud_rate);
+        channel.uart_->load_settings(false);
+      }
+      baud_rate = channel.uart_->get_baud_rate();
+      uint8_t reply[4] = {uint8_t(baud_rate >> 24), uint8_t(baud_rate >> 16), uint8_t(baud_rate >> 8), uint8_t(baud_rate)};
+      this->send_subnegotiation_(client, command, reply, sizeof(reply));
+      break;
+    }
+    case RFC2217_SET_DATASIZE: {
+      if (value[0] >= 5 && value[0] <= 8 && value[0] != channel.uart_->get_data_bits()) {
+        channel.uart_->flush();
+        channel.uart_->set_data_bits(value[0]);
+        channel.uart_->load_settings(false);
+      }
+      uint8_t reply = channel.uart_->get_data_bits();
+      this->send_subnegotiation_(client, command, &reply, 1);
+      break;
+    }
+    case RFC2217_SET_PARITY: {
+      uart::UARTParityOptions parity = channel.uart_->get_parity();
+      if (value[0] == RFC2217_PARITY_NONE) {
+        parity = uart::UART_CONFIG_PARITY_NONE;
+      } else if (value[0] == RFC2217_PARITY_ODD) {
+        parity = uart::UART_CONFIG_PARITY_ODD;
+      } else if (value[0] == RFC2217_PARITY_EVEN) {
+        parity = uart::UART_CONFIG_PARITY_EVEN;
+      }
+      if (parity != channel.uart_->get_parity()) {
+        channel.uart_->flush();
+        channel.uart_->set_parity(parity);
+        channel.uart_->load_settings(false);
+      }
+      uint8_t reply = RFC2217_PARITY_NONE;
+      if (channel.uart_->get_parity() == uart::UART_CONFIG_PARITY_ODD) {
+        reply = RFC2217_PARITY_ODD;
+      } else if (channel.uart_->get_parity() == uart::UART_CONFIG_PARITY_EVEN) {
+        reply = RFC2217_PARITY_EVEN;
+      }
+      this->send_subnegotiation_(client, command, &reply, 1);
+      break;
+    }
+    case RFC2217_SET_STOPSIZE: {
+      // 1.5 stop bits (3) is not supported
+      if ((value[0] == 1 || value[0] == 2) && value[0] != channel.uart_->get_stop_bits()) {
+        channel.uart_->flush();
+        channel.uart_->set_stop_bits(value[0]);
+        channel.uart_->load_settings(false);
+      }
+      uint8_t reply = channel.uart_->get_stop_bits();
+      this->send_subnegotiation_(client, command, &reply, 1);
+      break;
+    }
+    case RFC2217_SET_CONTROL: {
+      uint8_t reply = this->handle_control_(channel, value[0]);
+      this->send_subnegotiation_(client, command, &reply, 1);
+      break;
+    }
+    case RFC2217_NOTIFY_MODEMSTATE: {
+      uint8_t reply = RFC2217_MODEMSTATE;
+      this->send_subnegotiation_(client, command, &reply, 1);
+      break;
+    }
+    case RFC2217_FLOWCONTROL_SUSPEND:
+      client.suspended = true;
+      break;
+    case RFC2217_FLOWCONTROL_RESUME:
+      client.suspended = false;
+      break;
+    case RFC2217_SET_LINESTATE_MASK:
+    case RFC2217_SET_MODEMSTATE_MASK:
+      // Nothing is ever notified, the mask is just acknowledged
+      this->send_subnegotiation_(client, command, value, 1);
+      break;
+    case RFC2217_PURGE_DATA:
+      if (value[0] == RFC2217_PURGE_RECEIVE || value[0] == RFC2217_PURGE_BOTH) {
+        // Drop what the device sent and this client has not seen yet
+        client.tail = channel.tx_head_;
+        uint8_t discard;
+        while (client.owner && channel.uart_->available()) {
+          channel.uart_->read_byte(&discard);
+        }
+      }
+      // The TCP -> UART direction is written straight through, nothing to purge
+      this->send_subnegotiation_(client, command, value, 1);
+      break;
+    default:
+      ESP_LOGV(TAG, "Ignoring RFC 2217 command %u", command);
+      break;
+  }
+}
+
+uint8_t SerialBridge::handle_control_(BridgeChannel &channel, uint8_t control) {
+  switch (control) {
+    case RFC2217_CONTROL_BREAK_ON:
+    case RFC2217_CONTROL_BREAK_OFF:
+      this->set_break_(channel, control == RFC2217_CONTROL_BREAK_ON);
+      // fall through
+    case RFC2217_CONTROL_BREAK_REQUEST:
+      return channel.break_ ? RFC2217_CONTROL_BREAK_ON : RFC2217_CONTROL_BREAK_OFF;
+    case RFC2217_CONTROL_DTR_ON:
+    case RFC2217_CONTROL_DTR_OFF:
+      this->set_dtr_(channel, control == RFC2217_CONTROL_DTR_ON);
+      // fall through
+    case RFC2217_CONTROL_DTR_REQUEST:
+      return channel.dtr_ ? RFC2217_CONTROL_DTR_ON : RFC2217_CONTROL_DTR_OFF;
+    case RFC2217_CONTROL_RTS_ON:
+    case RFC2217_CONTROL_RTS_OFF:
+      this->set_rts_(channel, control == RFC2217_CONTROL_RTS_ON);
+      // fall through
+    case RFC2217_CONTROL_RTS_REQUEST:
+      return channel.rts_ ? RFC2217_CONTROL_RTS_ON : RFC2217_CONTROL_RTS_OFF;
+    case RFC2217_CONTROL_FLOW_REQUEST:
+    default:
+      // Only "no flow control" is available, RTS is a plain output pin.
+      // Unknown or unsupported requests get the flow setting back, which
+      // the client sees as a refusal.
+      return RFC2217_CONTROL_FLOW_NONE;
+  }
+}
+
+void SerialBridge::send_telnet_option_(BridgeClient &client, uint8_t verb, uint8_t option) {
+  const uint8_t reply[3] = {TELNET_IAC, verb, option};
+  this->queue_control_(client, reply, sizeof(reply));
+}
+
+void SerialBridge::send_subnegotiation_(BridgeClient &client, uint8_t command, const uint8_t *value, size_t len) {
+  uint8_t reply[4 + 2 * 4 + 2] = {TELNET_IAC, TELNET_SB, TELNET_OPTION_COM_PORT,
+                                   uint8_t(command + RFC2217_SERVER_OFFSET)};
+  size_t reply_len = 4;
+  for (size_t i = 0; i < len && i < 4; i++) {
+    if (value[i] == TELNET_IAC) {
+      reply[reply_len++] = TELNET_IAC;
+    }
+    reply[reply_len++] = value[i];
+  }
+  reply[reply_len++] = TELNET_IAC;
+  reply[reply_len++] = TELNET_SE;
+  this->queue_control_(client, reply, reply_len);
+}
+
+void SerialBridge::queue_control_(BridgeClient &client, const uint8_t *data, size_t len) {
+  if (sizeof(client.control) - client.control_len < len) {
+    ESP_LOGW(TAG, "Too many pending telnet replies, dropping one");
+    return;
+  }
+  memcpy(client.control + client.control_len, data, len);
+  client.control_len += len;
+}
+
+void SerialBridge::set_break_(BridgeChannel &channel, bool active) {
+  channel.break_ = active;
+#ifdef USE_ESP_IDF
+  // Inverting the idle-high TX line holds it low, which is a break condition
+  auto *idf_uart = static_cast<uart::IDFUARTComponent *>(channel.uart_);
+  uart_set_line_inverse((uart_port_t) idf_uart->get_hw_serial_number(), active ? UART_SIGNAL_TXD_INV : 0);
+#else
+  if (active) {
+    ESP_LOGW(TAG, "Break is only supported with the esp-idf framework");
+  }
+#endif
+}
 #endif
+
+uint32_t SerialBridge::tx_tail_(const BridgeChannel &channel) const {
+  bool found = false;
+  uint32_t tail = channel.tx_head_;
+  for (auto &client : channel.clients_) {
+    if (client.socket < 0) {
+      continue;
+    }
+    if (client.owner) {
+      return client.tail;
+    }
+    // Position comparisons have to survive the counters wrapping
+    if (!found || (int32_t) (client.tail - tail) < 0) {
+      tail = client.tail;
+      found = true;
+    }
+  }
+  return tail;
+}
+
+bool SerialBridge::has_clients_(const BridgeChannel &channel) const {
+  for (auto &client : channel.clients_) {
+    if (client.socket >= 0) {
+      return true;
+    }
+  }
+  return false;
+}
+
+void SerialBridge::set_dtr_(BridgeChannel &channel, bool active) {
+  channel.dtr_ = active;
+  // Asserted means low, the same as the TTL side of a USB serial adapter
+  if (channel.dtr_pin_ != nullptr) {
+    channel.dtr_pin_->digital_write(!active);
+  }
+}
+
+void SerialBridge::set_rts_(BridgeChannel &channel, bool active) {
+  channel.rts_ = active;
+  if (channel.rts_pin_ != nullptr) {
+    channel.rts_pin_->digital_write(!active);
+  }
 }
 
 }  // namespace serial_bridge
@@ -1,33 +1,235 @@
 #pragma once
 
+#include <memory>
+#include <vector>
+
 #include "esphome/core/component.h"
+#include "esphome/core/gpio.h"
+#include "esphome/core/hal.h"
 #include "esphome/core/log.h"
 #include "esphome/components/uart/uart.h"
 #include "esphome/components/wifi/wifi_component.h"
 
+#ifdef USE_SENSOR
+#include "esphome/components/sensor/sensor.h"
+#endif
+
 #ifdef USE_ESP32
 #include "lwip/sockets.h"
 #include "lwip/netdb.h"
+#include "freertos/FreeRTOS.h"
+#include "freertos/task.h"
+#endif
+
+#ifdef USE_ESP_IDF
+#include "driver/uart.h"
+#include "esphome/components/uart/uart_component_esp_idf.h"
 #endif
 
 namespace esphome {
 namespace serial_bridge {
 
-class SerialBridge : public Component {
+enum FramingMode : uint8_t {
+  FRAMING_NONE = 0,
+  // XBee API frames, AP=1
+  FRAMING_XBEE_API,
+  // XBee API frames with escaped control characters, AP=2
+  FRAMING_XBEE_API_ESCAPED,
+};
+
+enum FrameState : uint8_t { FRAME_SYNC, FRAME_LENGTH_HIGH, FRAME_LENGTH_LOW, FRAME_BODY };
+
+enum TelnetState : uint8_t {
+  TELNET_STATE_DATA,
+  TELNET_STATE_IAC,
+  TELNET_STATE_OPTION,
+  TELNET_STATE_SB,
+  TELNET_STATE_SB_IAC,
+};
+
+// One TCP connection. Every client reads the shared TX ring through its own
+// tail, so fanning UART data out to monitors costs no copies.
+struct BridgeClient {
+  int socket = -1;
+  bool owner = false;     // the only client whose data reaches the UART
+  uint32_t tail = 0;      // TX ring position sent up to
+  uint32_t oldest = 0;    // millis() when data started waiting for this client
+  uint32_t connected_at = 0;  // millis() at accept, picks the next owner
+  bool blocked = false;   // last send() could not take everything
+  bool suspended = false; // RFC 2217 FLOWCONTROL-SUSPEND
+
+  // RFC 2217 (telnet COM port control) state
+  TelnetState telnet_state = TELNET_STATE_DATA;
+  uint8_t telnet_verb = 0;
+  uint8_t telnet_will = 0;  // options we agreed to perform
+  uint8_t telnet_do = 0;    // options the client agreed to perform
+  uint8_t telnet_sb[16];
+  uint8_t telnet_sb_len = 0;
+  // Replies for this client only, sent right after its pending ring data
+  uint8_t control[32];
+  uint8_t control_len = 0;
+};
+
+// Counters behind the diagnostic sensors. Rates are derived from totals in
+// update(), peaks are reset after every publish.
+struct BridgeStats {
+  uint32_t uart_to_tcp_bytes = 0;
+  uint32_t tcp_to_uart_bytes = 0;
+  uint32_t send_retries = 0;
+  uint32_t dropped_bytes = 0;
+  uint32_t connections = 0;
+  uint32_t max_buffer_fill = 0;
+  uint32_t max_loop_gap = 0;  // microseconds between two forwarding passes
+};
+
+class SerialBridge;
+
+// One UART and its TCP server. Channels only hold state, the SerialBridge
+// drives all of them from one loop with one set of buffers.
+class BridgeChannel {
  public:
   void set_uart_parent(uart::UARTComponent *parent) { this->uart_ = parent; }
   void set_port(uint16_t port) { this->port_ = port; }
-  void setup() override;
-  void loop() override;
-  float get_setup_priority() const override { return setup_priority::AFTER_WIFI; }
+  void set_dtr_pin(GPIOPin *pin) { this->dtr_pin_ = pin; }
+  void set_rts_pin(GPIOPin *pin) { this->rts_pin_ = pin; }
+#ifdef USE_SENSOR
+  void set_uart_to_tcp_rate_sensor(sensor::Sensor *sensor) { this->uart_to_tcp_rate_sensor_ = sensor; }
+  void set_tcp_to_uart_rate_sensor(sensor::Sensor *sensor) { this->tcp_to_uart_rate_sensor_ = sensor; }
+  void set_send_retries_sensor(sensor::Sensor *sensor) { this->send_retries_sensor_ = sensor; }
+  void set_dropped_bytes_sensor(sensor::Sensor *sensor) { this->dropped_bytes_sensor_ = sensor; }
+  void set_connections_sensor(sensor::Sensor *sensor) { this->connections_sensor_ = sensor; }
+  void set_max_buffer_fill_sensor(sensor::Sensor *sensor) { this->max_buffer_fill_sensor_ = sensor; }
+  void set_loop_latency_sensor(sensor::Sensor *sensor) { this->loop_latency_sensor_ = sensor; }
+#endif
 
  protected:
+  friend class SerialBridge;
+
   uart::UARTComponent *uart_;
   uint16_t port_ = 8888;
   bool server_started_ = false;
-#ifdef USE_ESP32
   int server_socket_ = -1;
-  int client_socket_ = -1;
+  std::vector<BridgeClient> clients_;
+
+  // UART -> TCP ring, a slice of the bridge's buffer pool. Head and client
+  // tails are free-running byte counters.
+  uint8_t *tx_buffer_ = nullptr;
+  uint32_t tx_head_ = 0;
+  uint32_t tx_last_rx_ = 0;  // millis() of the last UART read
+
+  // API frame parser state for the UART -> TCP direction
+  FrameState frame_state_ = FRAME_SYNC;
+  bool frame_escape_ = false;
+  uint32_t frame_remaining_ = 0;
+  uint32_t tx_frame_end_ = 0;  // ring position just past the last complete frame
+
+  // RFC 2217 line state, controlled by the owner
+  bool break_ = false;
+  bool dtr_ = false;
+  bool rts_ = false;
+  GPIOPin *dtr_pin_ = nullptr;
+  GPIOPin *rts_pin_ = nullptr;
+
+  BridgeStats stats_;
+  uint32_t last_pass_ = 0;  // micros() of the previous forwarding pass
+  // Totals at the previous update(), for the rate sensors
+  uint32_t last_uart_to_tcp_bytes_ = 0;
+  uint32_t last_tcp_to_uart_bytes_ = 0;
+#ifdef USE_SENSOR
+  sensor::Sensor *uart_to_tcp_rate_sensor_ = nullptr;
+  sensor::Sensor *tcp_to_uart_rate_sensor_ = nullptr;
+  sensor::Sensor *send_retries_sensor_ = nullptr;
+  sensor::Sensor *dropped_bytes_sensor_ = nullptr;
+  sensor::Sensor *connections_sensor_ = nullptr;
+  sensor::Sensor *max_buffer_fill_sensor_ = nullptr;
+  sensor::Sensor *loop_latency_sensor_ = nullptr;
+#endif
+};
+
+class SerialBridge : public PollingComponent {
+ public:
+  void add_channel(BridgeChannel *channel) { this->channels_.push_back(channel); }
+  void set_max_clients(uint8_t max_clients) { this->max_clients_ = max_clients; }
+  // Must be a power of two, positions are masked into the ring.
+  void set_tx_buffer_size(size_t size) { this->tx_buffer_size_ = size; }
+  void set_flush_threshold(size_t threshold) { this->flush_threshold_ = threshold; }
+  void set_flush_timeout(uint32_t timeout) { this->flush_timeout_ = timeout; }
+  void set_rx_buffer_size(size_t size) { this->rx_buffer_size_ = size; }
+  void set_max_bytes_per_loop(size_t max_bytes) { this->max_bytes_per_loop_ = max_bytes; }
+  void set_framing(FramingMode framing) { this->framing_ = framing; }
+  void set_frame_timeout(uint32_t timeout) { this->frame_timeout_ = timeout; }
+  void set_rfc2217(bool rfc2217) { this->rfc2217_ = rfc2217; }
+  void set_use_task(bool use_task) { this->use_task_ = use_task; }
+  void set_task_priority(uint8_t priority) { this->task_priority_ = priority; }
+  void set_task_stack_size(uint32_t stack_size) { this->task_stack_size_ = stack_size; }
+  void set_uart_poll_interval(uint32_t interval) { this->uart_poll_interval_ = interval; }
+  void setup() override;
+  void loop() override;
+  void update() override;
+  float get_setup_priority() const override { return setup_priority::AFTER_WIFI; }
+
+ protected:
+#ifdef USE_ESP32
+  static void task_func_(void *arg);
+  // Block in select() until a socket is ready or the UART poll interval elapses.
+  void wait_for_events_();
+  // One pass of server setup, accept and forwarding in both directions.
+  void run_once_();
+  bool start_server_(BridgeChannel &channel);
+  void accept_clients_(BridgeChannel &channel);
+  void close_client_(BridgeChannel &channel, BridgeClient &client);
+  // Move as much UART data as fits into the channel's TX ring.
+  void read_uart_(BridgeChannel &channel);
+  // Send pending TX ring data once the size or latency threshold is reached.
+  void flush_client_(BridgeChannel &channel, BridgeClient &client);
+  void mark_uart_read_(BridgeChannel &channel);
+  // Feed one UART byte to the API frame parser, true when it completes a frame.
+  bool scan_frame_byte_(BridgeChannel &channel, uint8_t byte);
+  // Drain a client socket, up to max_bytes_per_loop per call. Only the owner's data goes to the UART.
+  void read_client_(BridgeChannel &channel, BridgeClient &client);
+
+  // RFC 2217: strip telnet commands from client data in place, returns the data length.
+  size_t process_telnet_(BridgeChannel &channel, BridgeClient &client, uint8_t *data, size_t len);
+  void handle_telnet_option_(BridgeClient &client, uint8_t verb, uint8_t option);
+  void handle_subnegotiation_(BridgeChannel &channel, BridgeClient &client);
+  // Apply a SET-CONTROL value and return the resulting state for the reply.
+  uint8_t handle_control_(BridgeChannel &channel, uint8_t control);
+  void send_telnet_option_(BridgeClient &client, uint8_t verb, uint8_t option);
+  void send_subnegotiation_(BridgeClient &client, uint8_t command, const uint8_t *value, size_t len);
+  void queue_control_(BridgeClient &client, const uint8_t *data, size_t len);
+  void set_break_(BridgeChannel &channel, bool active);
+#endif
+  void set_dtr_(BridgeChannel &channel, bool active);
+  void set_rts_(BridgeChannel &channel, bool active);
+  // Oldest ring position still needed: the owner's tail, or the slowest monitor's without an owner.
+  uint32_t tx_tail_(const BridgeChannel &channel) const;
+  bool has_clients_(const BridgeChannel &channel) const;
+
+  std::vector<BridgeChannel *> channels_;
+  uint32_t last_update_ = 0;  // millis() of the previous update()
+  uint8_t max_clients_ = 4;
+
+  // Every channel gets a tx_buffer_size slice of the pool
+  std::unique_ptr<uint8_t[]> tx_pool_;
+  size_t tx_buffer_size_ = 2048;
+  size_t flush_threshold_ = 256;
+  uint32_t flush_timeout_ = 2;
+
+  FramingMode framing_ = FRAMING_NONE;
+  uint32_t frame_timeout_ = 5;
+  bool rfc2217_ = false;
+
+  // TCP -> UART receive buffer, shared by all clients of all channels
+  std::unique_ptr<uint8_t[]> rx_buffer_;
+  size_t rx_buffer_size_ = 1024;
+  size_t max_bytes_per_loop_ = 4096;
+  // Dedicated bridge task instead of polling from loop()
+  bool use_task_ = false;
+  uint8_t task_priority_ = 5;
+  uint32_t task_stack_size_ = 4096;
+  uint32_t uart_poll_interval_ = 1;
+#ifdef USE_ESP32
+  TaskHandle_t task_handle_ = nullptr;
 #endif
 };
 
@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 """
-XBee Recovery Script - Try to recover unresponsive XBee with proper socat delays
+XBee Recovery Script - Try to recover unresponsive XBee over the bridge link
+
+Works on the xbee_bridge.py PTY (waiting for its link), a plain socat device
+or a socket:// / rfc2217:// URL, probing baud rates before falling back to +++.
 """
 
 import serial
@@ -8,8 +11,22 @@ import time
 import sys
 import os
 
+from xbee_bridge import control_path_for, wait_for_link
+from xbee_autobaud import autobaud, rank_candidates
+from xbee_cache import LinkCache
+from xbee_expect import AT_REPLY, BOOTLOADER, ERROR
+from xbee_transport import DEFAULT_TARGET, XBeeLink, is_url
+from xbee_xmodem import FlashJournal
+
 def wait_for_socat_reconnect(device_path="/tmp/ttyXBEE", timeout=30):
     """Wait for socat to recreate the virtual device"""
+    # xbee_bridge.py keeps the device around and reports its link state
+    if os.path.exists(control_path_for(device_path)):
+        if wait_for_link(device_path, timeout):
+            return True
+        print(f"  ✗ Timeout waiting for the bridge link")
+        return False
+
     print(f"  Waiting for socat to reconnect...")
     
     start_time = time.time()
@@ -23,22 +40,16 @@ def wait_for_socat_reconnect(device_path="/tmp/ttyXBEE", timeout=30):
     print(f"\n  ✗ Timeout waiting for {device_path}")
     return False
 
-def try_recovery_at_baud(baud_rate, device_path="/tmp/ttyXBEE"):
-    """Try recovery at specific baud rate"""
+def try_recovery_at_baud(baud_rate, link):
+    """Try recovery at specific baud rate on an open XBeeLink"""
     
     print(f"\nTrying bootloader recovery at {baud_rate} baud...")
     
-    # Wait for socat to be ready
-    if not wait_for_socat_reconnect(device_path):
-        return False, None
-    
     try:
-        ser = serial.Serial(device_path, baud_rate, timeout=5)
-        time.sleep(3)  # Longer initial delay
-        
-        print("  Connected to serial port")
+        link.set_baud(baud_rate)
+        console = link.console
         
-        # Try multiple bootloader entry methods
+        # Try multiple bootloader entry methods, each waits at most its deadline
         methods = [
             (b'\r\n', "Basic newline", 2),
             (b'+++', "AT command mode", None),  # Special handling
@@ -47,30 +58,24 @@ def try_recovery_at_baud(baud_rate, device_path="/tmp/ttyXBEE"):
             (b'\x00\x00\x00\x00\x00', "Null sequence", 2),
         ]
         
-        for cmd, desc, delay in methods:
+        for cmd, desc, deadline in methods:
             print(f"  Trying: {desc}")
-            ser.flushInput()
-            ser.flushOutput()
+            console.discard()
             
             # Special handling for +++ command
             if cmd == b'+++':
-                time.sleep(1.5)  # Guard time
-                ser.write(cmd)
-                time.sleep(1.5)  # Guard time
+                _, response = console.command_mode()
             else:
-                ser.write(cmd)
-                if delay:
-                    time.sleep(delay)
+                console.write(cmd)
+                _, response = console.expect(BOOTLOADER + AT_REPLY, deadline)
             
-            # Read response
-            response = ser.read(2000).decode('utf-8', errors='ignore')
+            response = response.decode('utf-8', errors='ignore')
             
             if response.strip():
                 print(f"  Response: {repr(response[:150])}")
                 
-                if "Gecko Bootloader" in response:
+                if "Gecko Bootloader" in response or "BL >" in response:
                     print(f"  ✓ BOOTLOADER FOUND at {baud_rate} baud!")
-                    ser.close()
                     return True, "bootloader"
                     
                 elif "OK" in response:
@@ -78,28 +83,23 @@ def try_recovery_at_baud(baud_rate, device_path="/tmp/ttyXBEE"):
                     
                     # Try to force bootloader from AT mode
                     print("  Attempting to force bootloader mode...")
-                    ser.write(b'AT%F\r')
-                    time.sleep(3)
-                    
-                    bootloader_response = ser.read(2000).decode('utf-8', errors='ignore')
+                    console.write(b'AT%F\r')
+                    _, bootloader_response = console.expect(BOOTLOADER + (ERROR,), 3)
+                    bootloader_response = bootloader_response.decode('utf-8', errors='ignore')
                     print(f"  Bootloader force response: {repr(bootloader_response[:100])}")
                     
                     if "Gecko Bootloader" in bootloader_response:
                         print("  ✓ Successfully forced into bootloader!")
-                        ser.close()
                         return True, "bootloader"
                     
-                    ser.close()
                     return True, "at_mode"
                 
                 elif response and len(response.strip()) > 0:
                     print(f"  ⚠ Unknown response, but XBee is alive!")
-                    ser.close()
                     return True, "unknown"
             else:
                 print("  No response")
         
-        ser.close()
         return False, None
         
     except Exception as e:
@@ -107,53 +107,76 @@ def try_recovery_at_baud(baud_rate, device_path="/tmp/ttyXBEE"):
         return False, None
 
 def main():
-    device_path = "/tmp/ttyXBEE"
+    target = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_TARGET
     
     print("XBee Recovery Script")
     print("===================")
     print("This will try to recover an unresponsive XBee")
-    print("Make sure socat is running in another terminal!")
+    print(f"Target: {target}")
     print()
     
-    # Check if socat device exists
-    if not os.path.exists(device_path):
-        print(f"✗ {device_path} not found!")
-        print("Make sure socat is running:")
-        print("./xbee_socat_setup.sh your-esp32-ip 8888")
+    if not is_url(target) and not wait_for_socat_reconnect(target, timeout=5):
+        print(f"✗ {target} not found!")
+        print("Make sure the bridge is running:")
+        print("./socat.sh your-esp32-ip 8888")
+        print("or pass the bridge directly: rfc2217://your-esp32-ip:8888")
         return
     
     baud_rates = [115200, 9600, 38400, 19200, 57600]
     
-    for i, baud in enumerate(baud_rates):
-        print(f"\n{'='*50}")
-        print(f"Attempt {i+1}/{len(baud_rates)}")
-        
-        success, mode = try_recovery_at_baud(baud)
+    try:
+        link = XBeeLink(target, baud_rates[0]).open()
+    except serial.SerialException as e:
+        print(f"✗ Could not open {target}: {e}")
+        return
+    
+    with link:
+        # Short probes find a responsive radio in a fraction of a second per rate
+        print("\nProbing baud rates...")
+        cache = LinkCache()
+        result = autobaud(link, rank_candidates(baud_rates), command_mode=False, cache=cache)
+        if result:
+            print(f"  ✓ Answer at {result.baud} baud ({result.mode}) after {result.elapsed:.1f}s")
+            if result.mode == "api":
+                print(f"\n✓ SUCCESS!")
+                print(f"XBee is responding at {result.baud} baud in API mode")
+                print(f"\nTest with:")
+                print(f"python3 test.py -d {target} -b {result.baud} --api {result.api_mode}")
+                return
+            # The recovery steps start at the rate that answered
+            baud_rates = rank_candidates([result.baud], baud_rates)
         
-        if success:
-            print(f"\n✓ SUCCESS!")
-            print(f"XBee is responding at {baud} baud in {mode} mode")
+        for i, baud in enumerate(baud_rates):
+            print(f"\n{'='*50}")
+            print(f"Attempt {i+1}/{len(baud_rates)}")
             
-            if mode == "bootloader":
-                print("\nYou can now flash firmware:")
-                print(f"python gentle_xbee_flash.py XB3-24Z/XB3-24Z_1014-th.gbl")
-            elif mode == "at_mode":
-                print(f"\nXBee is working! Test with:")
-                print(f"python3 xbee_at_test.py -b {baud}")
+            success, mode = try_recovery_at_baud(baud, link)
             
-            return
+            if success:
+                cache.remember(target, baud=baud, mode=mode)
+                print(f"\n✓ SUCCESS!")
+                print(f"XBee is responding at {baud} baud in {mode} mode")
+                
+                if mode == "bootloader":
+                    if FlashJournal(target).load():
+                        print("\nAn interrupted upload is pending, the same command resumes it:")
+                    else:
+                        print("\nYou can now flash firmware:")
+                    print(f"python3 xbee_firmware_flash.py XB3-24Z/XB3-24Z_1014-th.gbl {target}")
+                elif mode == "at_mode":
+                    print(f"\nXBee is working! Test with:")
+                    print(f"python3 test.py -d {target} -b {baud}")
+                
+                return
         
-        # Add delay between attempts to let socat settle
-        if i < len(baud_rates) - 1:
-            print(f"  Waiting 10 seconds before next attempt...")
-            time.sleep(10)
+        cache.invalidate(target)
     
     print(f"\n✗ XBee recovery failed at all baud rates")
     print("\nTroubleshooting steps:")
     print("1. Check ESP32 is powered and running")
     print("2. Check XBee power connections")
     print("3. Try hardware reset of ESP32")
-    print("4. Check socat is running and connected")
+    print("4. Check the bridge (socat.sh / xbee_bridge.py) is running and connected")
     print("5. Consider removing XBee and flashing directly via USB-serial")
 
 if __name__ == "__main__":
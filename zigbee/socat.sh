@@ -12,6 +12,12 @@ echo "ESP32 IP: $ESP32_IP"
 echo "ESP32 Port: $ESP32_PORT" 
 echo "Virtual Device: $VIRTUAL_DEVICE"
 
+# The Python bridge keeps the device stable across reconnects, set
+# USE_SOCAT=1 to fall back to the plain socat loop below.
+if [ -z "$USE_SOCAT" ] && command -v python3 &> /dev/null; then
+    exec python3 "$(dirname "$0")/xbee_bridge.py" "$ESP32_IP" "$ESP32_PORT" --device "$VIRTUAL_DEVICE"
+fi
+
 # Check if socat is available
 if ! command -v socat &> /dev/null; then
     echo "Error: socat not found"
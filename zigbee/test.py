@@ -1,127 +1,246 @@
 #!/usr/bin/env python3
 """
 XBee AT Command Tester - Test AT commands via virtual serial device
+
+    python3 test.py -d /tmp/ttyXBEE -b 9600
+    python3 test.py sweep -i bridges.txt -f csv -o health.csv
 """
 
+import csv
+import json
 import serial
 import time
 import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from xbee_api import ApiClient
+from xbee_autobaud import autobaud, rank_candidates
+from xbee_at import INVENTORY, PARAMETERS, describe, query, serial_number
+from xbee_cache import LinkCache, remember_radio
+from xbee_expect import GUARD_TIME
+from xbee_fleet import read_inventory
+from xbee_transport import DEFAULT_TARGET, XBeeLink
+from xbee_verify import read_firmware
+
+# Sweep mode: what's read from every radio, and the table it goes into
+SWEEP_PARAMETERS = ("VR", "SH", "SL", "ID", "AP", "CE", "GT")
+SWEEP_COLUMNS = ["target", "status", "baud", "mode", "firmware", "serial", "pan_id", "api_mode", "coordinator",
+                 "elapsed", "detail"]
+SWEEP_JOBS = 16
 
-def test_xbee_at(device_path="/tmp/ttyXBEE", baud_rate=9600):
-    """Test XBee AT commands"""
+def test_xbee_at(link, baud_rate=9600, api_mode=0, guard_time=GUARD_TIME):
+    """Test XBee AT commands on an open XBeeLink, returns the parameters or False"""
     
-    print(f"Connecting to {device_path} at {baud_rate} baud...")
+    print(f"Testing {link.target} at {baud_rate} baud...")
     
     try:
-        # Open serial connection
-        ser = serial.Serial(device_path, baud_rate, timeout=3)
-        time.sleep(2)  # Let connection stabilize
+        link.set_baud(baud_rate)
+        console = link.console
         
-        print("✓ Serial connection opened")
+        if api_mode:
+            return test_xbee_api(console, api_mode)
         
-        # Clear any existing data
-        ser.flushInput()
-        ser.flushOutput()
-        
-        # Enter command mode
+        # Enter command mode, +++ with no CR/LF, OK arrives after the guard time
         print("\nEntering command mode...")
-        print("Waiting 1.5 seconds (guard time)...")
-        time.sleep(1.5)
-        
-        print("Sending +++")
-        ser.write(b'+++')  # No CR/LF for command mode entry
-        
-        print("Waiting 1.5 seconds (guard time)...")
-        time.sleep(1.5)
+        entered, response = console.command_mode(guard_time)
+        print(f"Response: {repr(response.decode('utf-8', errors='ignore'))}")
         
-        # Check for OK response
-        response = ser.read(100).decode('utf-8', errors='ignore')
-        print(f"Response: {repr(response)}")
-        
-        if 'OK' not in response:
+        if not entered:
             print("⚠ No OK response...")
             return False
         else:
             print("✓ Command mode entered successfully")
         
-        # Test AT commands
-        commands = [
-            ("ATVR", "Firmware version"),
-            ("ATSL", "Serial number low"),
-            ("ATSH", "Serial number high"), 
-            ("ATBD", "Baud rate"),
-            ("ATAP", "API mode"),
-            ("ATCE", "Coordinator enable"),
-            ("ATID", "PAN ID"),
-        ]
+        # Query all parameters in one round trip
+        print(f"\n→ Sent: AT{','.join(INVENTORY)}")
+        # GT as well, for the link cache
+        info = query(console, INVENTORY + ("GT",))
         
-        for cmd, desc in commands:
-            print(f"\nTesting {cmd} ({desc}):")
-            
-            # Clear buffer
-            ser.flushInput()
-            
-            # Send command with CR
-            full_cmd = cmd + '\r'
-            ser.write(full_cmd.encode())
-            print(f"→ Sent: {cmd}")
-            
-            # Wait for response
-            time.sleep(1)
-            
-            # Read response
-            response = ser.read(100).decode('utf-8', errors='ignore').strip()
-            if response:
-                print(f"← Response: {repr(response)}")
-            else:
-                print("← No response")
+        for name in INVENTORY:
+            desc, _ = PARAMETERS[name]
+            print(f"← AT{name} ({desc}): {describe(name, info[name])}")
         
         # Exit command mode
         print(f"\nExiting command mode...")
-        ser.write(b'ATCN\r')
-        time.sleep(1)
-        response = ser.read(100).decode('utf-8', errors='ignore')
+        response = console.at("CN")
         print(f"Exit response: {repr(response)}")
         
-        ser.close()
         print("\n✓ Test completed")
+        return info
         
     except serial.SerialException as e:
         print(f"✗ Serial error: {e}")
         return False
     except KeyboardInterrupt:
         print("\n^C received")
-        if 'ser' in locals():
-            ser.close()
         return False
     except Exception as e:
         print(f"✗ Error: {e}")
         return False
+
+def test_xbee_api(console, api_mode):
+    """Query the same parameters with API frames, no command mode needed"""
+    
+    print(f"\nSending {len(INVENTORY)} AT command frames (AP={api_mode})...")
+    client = ApiClient(console, escaped=api_mode == 2)
+    info = client.query(INVENTORY + ("GT",))
+    
+    for name in INVENTORY:
+        desc, _ = PARAMETERS[name]
+        print(f"← AT{name} ({desc}): {describe(name, info[name])}")
+    
+    if all(value is None for value in info.values()):
+        print("⚠ No API responses...")
+        return False
     
-    return True
+    print("\n✓ Test completed")
+    return info
+
+def health_check(target, cache):
+    """One row of a sweep: find the radio on target and read SWEEP_PARAMETERS"""
+    
+    start = time.monotonic()
+    row = dict.fromkeys(SWEEP_COLUMNS)
+    row["target"] = target
+    entry = cache.lookup(target) or {}
+    guard_time = entry.get("guard_time", GUARD_TIME)
+    try:
+        with XBeeLink(target, entry.get("baud", 9600)) as link:
+            result = autobaud(link, rank_candidates([entry.get("baud")]), cache=cache)
+            if result is None:
+                row["status"] = "no response"
+            elif result.mode == "bootloader":
+                row.update(status="bootloader", baud=result.baud, mode=result.mode)
+            else:
+                info = read_firmware(link, result.mode, guard_time, SWEEP_PARAMETERS, result.api_mode)
+                if info is None:
+                    row.update(status="no response", baud=result.baud, mode=result.mode)
+                    cache.invalidate(target)
+                else:
+                    number = serial_number(info)
+                    row.update(
+                        status="ok",
+                        baud=result.baud,
+                        mode=result.mode,
+                        firmware=describe("VR", info["VR"]),
+                        serial=f"{number:016X}" if number is not None else None,
+                        pan_id=f"{info['ID']:X}" if info["ID"] is not None else None,
+                        api_mode=info["AP"],
+                        coordinator=info["CE"],
+                    )
+                    remember_radio(cache, target, result.baud, result.mode, info)
+    except Exception as e:
+        # Anything, down to a malformed inventory line, only fails this row
+        row.update(status="error", detail=str(e) or type(e).__name__)
+    row["elapsed"] = round(time.monotonic() - start, 2)
+    return row
+
+def sweep(targets, jobs=SWEEP_JOBS):
+    """Health check many targets at once, rows in the order of targets"""
+    
+    cache = LinkCache()
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(lambda target: health_check(target, cache), targets))
+
+def write_rows(rows, output_format, out):
+    """Rows as a table, JSON or CSV"""
+    
+    if output_format == "json":
+        json.dump(rows, out, indent=1)
+        out.write("\n")
+    elif output_format == "csv":
+        writer = csv.DictWriter(out, fieldnames=SWEEP_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        widths = {column: max(len(column), *(len(str(row[column] if row[column] is not None else "-")) for row in rows))
+                  for column in SWEEP_COLUMNS}
+        out.write("  ".join(column.ljust(widths[column]) for column in SWEEP_COLUMNS).rstrip() + "\n")
+        for row in rows:
+            cells = (str(row[column] if row[column] is not None else "-").ljust(widths[column]) for column in SWEEP_COLUMNS)
+            out.write("  ".join(cells).rstrip() + "\n")
+
+def sweep_main(argv):
+    """test.py sweep [targets] [-i inventory] [-j jobs] [-f table|json|csv] [-o file]"""
+    
+    import argparse
+    
+    parser = argparse.ArgumentParser(prog="test.py sweep", description="Health check many XBees in parallel")
+    parser.add_argument("targets", nargs="*", help="Serial device paths or pyserial URLs")
+    parser.add_argument("-i", "--inventory", help="File with one target per line, # starts a comment")
+    parser.add_argument("-j", "--jobs", type=int, default=SWEEP_JOBS, help="Devices checked at the same time")
+    parser.add_argument("-f", "--format", choices=["table", "json", "csv"], default="table", help="Output format")
+    parser.add_argument("-o", "--output", help="Write the table to this file instead of stdout")
+    args = parser.parse_args(argv)
+    
+    targets = list(args.targets)
+    if args.inventory:
+        targets += read_inventory(args.inventory)
+    targets = list(dict.fromkeys(targets))
+    if not targets:
+        parser.error("no targets, pass them as arguments or with --inventory")
+    
+    rows = sweep(targets, args.jobs)
+    if args.output:
+        with open(args.output, "w", newline="") as f:
+            write_rows(rows, args.format, f)
+    else:
+        write_rows(rows, args.format, sys.stdout)
+    sys.exit(0 if all(row["status"] == "ok" for row in rows) else 1)
 
 if __name__ == "__main__":
     import argparse
     
-    parser = argparse.ArgumentParser(description="Test XBee AT commands")
-    parser.add_argument("-d", "--device", default="/tmp/ttyXBEE", help="Serial device path")
+    if sys.argv[1:2] == ["sweep"]:
+        sweep_main(sys.argv[2:])
+    
+    parser = argparse.ArgumentParser(description="Test XBee AT commands",
+                                     epilog="test.py sweep --help: check many devices at once")
+    parser.add_argument("-d", "--device", default=DEFAULT_TARGET,
+                        help="Serial device path or pyserial URL (socket://host:8888, rfc2217://host:8888)")
     parser.add_argument("-b", "--baud", type=int, default=9600, help="Baud rate")
+    parser.add_argument("-a", "--api", type=int, choices=[0, 1, 2], default=0,
+                        help="Talk API frames to a radio with AP=1 or AP=2 instead of command mode")
     
     args = parser.parse_args()
     
-    # Test different baud rates if first fails
+    # Test different baud rates if first fails, the one that answers a probe first
     baud_rates = [args.baud, 9600, 115200, 38400, 19200]
     
-    for baud in baud_rates:
-        if baud != args.baud:
-            print(f"\n{'='*50}")
-            print(f"Trying baud rate: {baud}")
-            print(f"{'='*50}")
+    try:
+        link = XBeeLink(args.device, args.baud).open()
+    except serial.SerialException as e:
+        print(f"✗ Serial error: {e}")
+        sys.exit(1)
+    print("✓ Serial connection opened")
+    
+    cache = LinkCache()
+    entry = cache.lookup(args.device) or {}
+    guard_time = entry.get("guard_time", GUARD_TIME)
+    
+    with link:
+        result = autobaud(link, rank_candidates(baud_rates), command_mode=False, cache=cache)
+        if result:
+            print(f"✓ Radio answered at {result.baud} baud ({result.mode}) after {result.elapsed:.2f}s")
+            baud_rates = rank_candidates([result.baud], baud_rates)
+            if result.mode == "api" and not args.api:
+                args.api = result.api_mode
         
-        if test_xbee_at(args.device, baud):
-            print(f"\n✓ Success with baud rate: {baud}")
-            break
+        for baud in baud_rates:
+            if baud != args.baud:
+                print(f"\n{'='*50}")
+                print(f"Trying baud rate: {baud}")
+                print(f"{'='*50}")
+            
+            info = test_xbee_at(link, baud, args.api, guard_time)
+            if info:
+                print(f"\n✓ Success with baud rate: {baud}")
+                remember_radio(cache, args.device, baud, "api" if args.api else "at_mode", info)
+                break
+            else:
+                print(f"✗ Failed with baud rate: {baud}")
+                if result and baud == result.baud:
+                    # Whatever the probe or the cache said, it didn't work
+                    cache.invalidate(args.device)
         else:
-            print(f"✗ Failed with baud rate: {baud}")
-    else:
-        print("\n✗ All baud rates failed")
+            print("\n✗ All baud rates failed")
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+XBee API Frames - Encode/decode AP=1 and AP=2 frames, concurrent local AT commands
+
+Frames are 0x7E, 16-bit length, frame data, checksum. AP=2 additionally
+escapes 0x7E, 0x7D, 0x11 and 0x13 as 0x7D followed by the byte XOR 0x20.
+
+Local AT Command frames (0x08) carry a frame ID, so any number of commands
+can be in flight and their 0x88 responses are matched as they arrive. No
++++ and no guard times.
+"""
+
+import time
+
+START = 0x7E
+ESCAPE = 0x7D
+XON = 0x11
+XOFF = 0x13
+ESCAPED_BYTES = (START, ESCAPE, XON, XOFF)
+
+AT_COMMAND = 0x08
+AT_COMMAND_RESPONSE = 0x88
+MODEM_STATUS = 0x8A
+
+# Longest frame any XBee sends is a few hundred bytes, anything above is a false start
+MAX_FRAME_LENGTH = 512
+
+AT_STATUS = {0: "OK", 1: "ERROR", 2: "Invalid command", 3: "Invalid parameter", 4: "Tx failure"}
+
+
+def checksum(frame_data):
+    """0xFF minus the low byte of the frame data sum"""
+    return 0xFF - (sum(frame_data) & 0xFF)
+
+
+def escape(data):
+    """AP=2 escaping"""
+    out = bytearray()
+    for byte in data:
+        if byte in ESCAPED_BYTES:
+            out += bytes((ESCAPE, byte ^ 0x20))
+        else:
+            out.append(byte)
+    return bytes(out)
+
+
+def encode_frame(frame_data, escaped=False):
+    """Wrap frame data (API identifier first) into a frame"""
+    body = len(frame_data).to_bytes(2, "big") + bytes(frame_data) + bytes((checksum(frame_data),))
+    return bytes((START,)) + (escape(body) if escaped else body)
+
+
+def at_command_frame(frame_id, command, parameter=b"", escaped=False):
+    """Local AT Command frame, frame_id 0 means no response"""
+    return encode_frame(bytes((AT_COMMAND, frame_id)) + command.encode() + bytes(parameter), escaped)
+
+
+class FrameDecoder:
+    """Incremental decoder, feed() bytes as they arrive and get complete frames back"""
+
+    def __init__(self, escaped=False):
+        self.escaped = escaped
+        self.buffer = bytearray()
+        self.errors = 0  # checksum failures and resyncs
+
+    def feed(self, data):
+        """Add received bytes, returns the list of complete frame data"""
+        self.buffer += data
+        return self.decode_escaped() if self.escaped else self.decode()
+
+    def decode(self):
+        """AP=1: lengths are literal, so frames are sliced straight out of the buffer"""
+        frames = []
+        view = memoryview(self.buffer)
+        pos = 0
+        try:
+            while True:
+                start = self.buffer.find(START, pos)
+                if start < 0:
+                    pos = len(self.buffer)
+                    break
+                pos = start
+                if len(self.buffer) - start < 3:
+                    break
+                length = (self.buffer[start + 1] << 8) | self.buffer[start + 2]
+                if length > MAX_FRAME_LENGTH:
+                    self.errors += 1
+                    pos = start + 1
+                    continue
+                end = start + 3 + length + 1
+                if len(self.buffer) < end:
+                    break
+                # Checksum over a view, the frame itself is copied only once it's valid
+                if (sum(view[start + 3:end - 1]) + self.buffer[end - 1]) & 0xFF == 0xFF:
+                    frames.append(bytes(view[start + 3:end - 1]))
+                    pos = end
+                else:
+                    # Not a real frame start, look for the next one
+                    self.errors += 1
+                    pos = start + 1
+        finally:
+            view.release()
+        del self.buffer[:pos]
+        return frames
+
+    def decode_escaped(self):
+        """AP=2: an unescaped 0x7E only ever starts a frame, so frames are split on it"""
+        frames = []
+        while True:
+            start = self.buffer.find(START)
+            if start < 0:
+                self.buffer.clear()
+                break
+            if start > 0:
+                del self.buffer[:start]
+            following = self.buffer.find(START, 1)
+            raw = self.buffer[1:following] if following > 0 else self.buffer[1:]
+            body = unescape(raw)
+            if body is not None and len(body) >= 2:
+                length = (body[0] << 8) | body[1]
+                if length > MAX_FRAME_LENGTH:
+                    self.errors += 1
+                    del self.buffer[:1]
+                    continue
+                if len(body) >= length + 3:
+                    frame = body[2:2 + length]
+                    if (sum(frame) + body[2 + length]) & 0xFF == 0xFF:
+                        frames.append(bytes(frame))
+                    else:
+                        self.errors += 1
+                    del self.buffer[:1]
+                    continue
+            if following > 0:
+                # Cut short by the next frame
+                self.errors += 1
+                del self.buffer[:following]
+                continue
+            break
+        return frames
+
+
+def unescape(raw):
+    """Undo AP=2 escaping, None if raw ends in the middle of an escape"""
+    parts = bytes(raw).split(bytes((ESCAPE,)))
+    out = bytearray(parts[0])
+    for part in parts[1:]:
+        if not part:
+            return None
+        out.append(part[0] ^ 0x20)
+        out += part[1:]
+    return out
+
+
+class ApiClient:
+    """Local AT commands over an Expect console, with many frames in flight"""
+
+    def __init__(self, console, escaped=False):
+        self.console = console
+        self.escaped = escaped
+        self.decoder = FrameDecoder(escaped)
+        self.next_id = 1
+        self.responses = {}  # frame_id: (command, status, data)
+        self.pending = {}  # frame_id: command
+        self.other_frames = []  # modem status, received data, ...
+
+    def submit(self, command, parameter=b""):
+        """Queue one AT command frame for sending, returns its frame ID"""
+        frame_id = self.next_id
+        self.next_id = self.next_id % 255 + 1
+        self.pending[frame_id] = command
+        self.responses.pop(frame_id, None)
+        return frame_id, at_command_frame(frame_id, command, parameter, self.escaped)
+
+    def send(self, commands):
+        """Send several (command, parameter) pairs in one write, returns their frame IDs"""
+        frame_ids = []
+        out = bytearray()
+        for command, parameter in commands:
+            frame_id, frame = self.submit(command, parameter)
+            frame_ids.append(frame_id)
+            out += frame
+        self.console.write(bytes(out))
+        return frame_ids
+
+    def poll(self, deadline):
+        """Read and dispatch whatever arrives before the deadline, False if nothing did"""
+        data = self.console.read_some(deadline - time.monotonic())
+        if not data:
+            return False
+        for frame in self.decoder.feed(data):
+            if frame[0] == AT_COMMAND_RESPONSE and len(frame) >= 5 and frame[1] in self.pending:
+                command = self.pending.pop(frame[1])
+                self.responses[frame[1]] = (command, frame[4], bytes(frame[5:]))
+            else:
+                self.other_frames.append(frame)
+        return True
+
+    def wait(self, frame_ids, timeout=1.0):
+        """Wait for responses to frame_ids, returns {frame_id: (command, status, data)}"""
+        deadline = time.monotonic() + timeout
+        while any(frame_id not in self.responses for frame_id in frame_ids):
+            if not self.poll(deadline) and time.monotonic() >= deadline:
+                break
+        return {frame_id: self.responses.pop(frame_id) for frame_id in frame_ids if frame_id in self.responses}
+
+    def query(self, names, timeout=1.0):
+        """Like xbee_at.query, but over API frames, returns {name: value}"""
+        from xbee_at import PARAMETERS
+
+        names = [name.upper() for name in names]
+        frame_ids = self.send((name, b"") for name in names)
+        responses = self.wait(frame_ids, timeout)
+        result = dict.fromkeys(names)
+        for frame_id, name in zip(frame_ids, names):
+            if frame_id not in responses:
+                continue
+            _, status, data = responses[frame_id]
+            if status != 0:
+                continue
+            _, parse = PARAMETERS.get(name, (name, str))
+            # Responses carry the binary value, AT mode the same value in hex
+            try:
+                result[name] = parse(data.hex().upper() or "0")
+            except ValueError:
+                pass
+        for frame_id in frame_ids:
+            self.pending.pop(frame_id, None)
+        return result
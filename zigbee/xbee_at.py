@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+XBee AT Queries - Read several parameters in one round trip
+
+All queries go out in one write as a comma chained command (ATVR,SL,SH...),
+the CR terminated replies are parsed as they stream in. Needs command mode,
+see Expect.command_mode().
+"""
+
+import time
+
+# BD register values, anything above 8 is the rate itself
+BAUD_RATES = {0: 1200, 1: 2400, 2: 4800, 3: 9600, 4: 19200, 5: 38400, 6: 57600, 7: 115200, 8: 230400}
+
+
+def parse_hex(reply):
+    """Numeric AT replies are hex without prefix"""
+    return int(reply, 16)
+
+
+def parse_baud(reply):
+    """BD value to baud rate"""
+    value = parse_hex(reply)
+    return BAUD_RATES.get(value, value)
+
+
+def parse_flag(reply):
+    """0/1 parameters"""
+    return parse_hex(reply) != 0
+
+
+# name: (description, parser)
+PARAMETERS = {
+    "VR": ("Firmware version", str),
+    "HV": ("Hardware version", str),
+    "SL": ("Serial number low", parse_hex),
+    "SH": ("Serial number high", parse_hex),
+    "BD": ("Baud rate", parse_baud),
+    "AP": ("API mode", parse_hex),
+    "CE": ("Coordinator enable", parse_flag),
+    "ID": ("PAN ID", parse_hex),
+    "OP": ("Operating PAN ID", parse_hex),
+    "AI": ("Association indication", parse_hex),
+    "GT": ("Guard time", parse_hex),
+    "CT": ("Command mode timeout", parse_hex),
+}
+
+INVENTORY = ("VR", "SL", "SH", "BD", "AP", "CE", "ID")
+
+
+def query(console, names=INVENTORY, timeout=2.0, chained=True):
+    """Query parameters in one write, returns {name: value}
+
+    Values are typed by PARAMETERS, None where the radio answered ERROR,
+    sent something unparseable or did not answer before the deadline.
+    chained=False sends back-to-back ATxx lines for firmware without
+    comma chaining.
+    """
+    names = [name.upper() for name in names]
+    if chained:
+        console.write(("AT" + ",".join(names) + "\r").encode())
+    else:
+        console.write("".join(f"AT{name}\r" for name in names).encode())
+
+    deadline = time.monotonic() + timeout
+    result = dict.fromkeys(names)
+    for name in names:
+        reply = console.read_line(deadline - time.monotonic())
+        if reply is None:
+            break
+        if reply == "ERROR":
+            continue
+        _, parse = PARAMETERS.get(name, (name, str))
+        try:
+            result[name] = parse(reply)
+        except ValueError:
+            pass
+    return result
+
+
+def serial_number(info):
+    """64-bit serial from SH/SL, None unless both are known"""
+    if info.get("SH") is None or info.get("SL") is None:
+        return None
+    return (info["SH"] << 32) | info["SL"]
+
+
+def describe(name, value):
+    """Human readable form of one parameter"""
+    if value is None:
+        return "no response"
+    if isinstance(value, bool):
+        return "yes" if value else "no"
+    if name in ("SL", "SH", "ID", "OP"):
+        return f"0x{value:X}"
+    return str(value)
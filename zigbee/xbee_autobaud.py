@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+XBee Autobaud - Find baud rate and mode with short probes, first hit wins
+
+Phase one sends a single probe per candidate rate: an ATAP API frame
+(answered in AP=1/AP=2, with the AP value) and a CR (answered by the Gecko bootloader menu, or
+by ERROR if the radio is still in command mode). These come back within a round trip,
+so a wrong rate only costs the probe deadline. Only if nothing answers does
+phase two fall back to +++ with guard times at each rate.
+
+Several devices are probed in parallel, one thread each:
+    python3 xbee_autobaud.py /tmp/ttyXBEE rfc2217://10.0.0.5:8888 rfc2217://10.0.0.6:8888
+"""
+
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from xbee_api import AT_COMMAND_RESPONSE, FrameDecoder, at_command_frame
+from xbee_cache import LinkCache
+from xbee_expect import BOOTLOADER, ERROR, GUARD_TIME, OK
+from xbee_transport import XBeeLink
+
+# Factory default first, then by how often we run radios at that rate
+RANKED_BAUD_RATES = [9600, 115200, 57600, 38400, 19200, 230400, 4800, 2400, 1200]
+PROBE_TIMEOUT = 0.3
+PROBE_FRAME_ID = 0x52
+
+# api_mode is the radio's AP value (1 or 2) when mode is "api", None otherwise
+AutobaudResult = namedtuple("AutobaudResult", ["baud", "mode", "elapsed", "api_mode"])
+
+
+def rank_candidates(preferred=(), candidates=RANKED_BAUD_RATES):
+    """Preferred rates first (last known, command line), then the ranked list"""
+    ranked = []
+    for baud in list(preferred) + list(candidates):
+        if baud and baud not in ranked:
+            ranked.append(baud)
+    return ranked
+
+
+def probe(console, timeout=PROBE_TIMEOUT):
+    """One probe at the current rate, returns (mode, AP value) or (None, None)
+
+    mode is "bootloader", "at_mode" or "api", the AP value is only known for "api".
+    """
+    console.discard()
+    # The CR goes last, so it also terminates the frame bytes as a command line.
+    # The ATAP frame has no bytes to escape, AP=2 radios take it as it is.
+    console.write(at_command_frame(PROBE_FRAME_ID, "AP") + b"\r")
+    decoders = (FrameDecoder(escaped=False), FrameDecoder(escaped=True))
+    received = bytearray()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        chunk = console.read_some(deadline - time.monotonic())
+        if not chunk:
+            continue
+        received += chunk
+        if any(pattern in received for pattern in BOOTLOADER):
+            return "bootloader", None
+        if OK in received or ERROR in received:
+            return "at_mode", None
+        for decoder in decoders:
+            for frame in decoder.feed(chunk):
+                if frame[0] == AT_COMMAND_RESPONSE and frame[1] == PROBE_FRAME_ID:
+                    if len(frame) > 5 and frame[4] == 0:
+                        return "api", frame[5]
+                    # No value came back, the decoder that got the frame is the best guess
+                    return "api", 2 if decoder.escaped else 1
+    return None, None
+
+
+def try_cached(link, entry, probe_timeout, command_mode):
+    """Check the cached settings with a single probe, returns (mode, AP value) like probe"""
+    link.set_baud(entry["baud"])
+    mode, api_mode = probe(link.console, probe_timeout)
+    if mode or entry.get("mode") != "at_mode":
+        return mode, api_mode
+    # Transparent mode only answers +++. Without command_mode the caller
+    # sends that next and invalidates the entry if it fails.
+    if not command_mode:
+        return "at_mode", None
+    entered, _ = link.console.command_mode(entry.get("guard_time", GUARD_TIME))
+    return ("at_mode" if entered else None), None
+
+
+def autobaud(link, candidates=RANKED_BAUD_RATES, probe_timeout=PROBE_TIMEOUT, command_mode=True, cache=None):
+    """Find the rate the radio answers at on an open XBeeLink, returns AutobaudResult or None
+
+    With a LinkCache the last known settings are tried first, so a radio
+    that hasn't changed costs one round trip. Results are written back.
+    """
+    start = time.monotonic()
+    entry = cache.lookup(link.target) if cache else None
+    if entry and entry.get("baud"):
+        mode, api_mode = try_cached(link, entry, probe_timeout, command_mode)
+        if mode:
+            return found(link, cache, entry["baud"], mode, start, api_mode)
+        cache.invalidate(link.target)
+
+    for baud in candidates:
+        link.set_baud(baud)
+        mode, api_mode = probe(link.console, probe_timeout)
+        if mode:
+            return found(link, cache, baud, mode, start, api_mode)
+
+    if command_mode:
+        # Transparent mode only answers +++, which needs the guard times
+        for baud in candidates:
+            link.set_baud(baud)
+            entered, _ = link.console.command_mode()
+            if entered:
+                return found(link, cache, baud, "at_mode", start)
+    return None
+
+
+def found(link, cache, baud, mode, start, api_mode=None):
+    """Build the result and remember it"""
+    if cache:
+        cache.remember(link.target, baud=baud, mode=mode)
+    return AutobaudResult(baud, mode, time.monotonic() - start, api_mode)
+
+
+def autobaud_target(target, candidates=RANKED_BAUD_RATES, **kwargs):
+    """Open target, probe it and close it again"""
+    with XBeeLink(target, candidates[0]) as link:
+        return autobaud(link, candidates, **kwargs)
+
+
+def autobaud_many(targets, candidates=RANKED_BAUD_RATES, max_workers=8, **kwargs):
+    """Probe several devices in parallel, returns {target: AutobaudResult, None or the error}"""
+
+    def run(target):
+        try:
+            return autobaud_target(target, candidates, **kwargs)
+        except Exception as e:
+            # A bad target (even a malformed URL) only fails its own entry
+            return e
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return dict(zip(targets, pool.map(run, targets)))
+
+
+def main():
+    targets = sys.argv[1:] or ["/tmp/ttyXBEE"]
+
+    print("XBee Autobaud")
+    print("=============")
+    print(f"Probing {len(targets)} device(s) at {', '.join(map(str, RANKED_BAUD_RATES))}")
+    print()
+
+    results = autobaud_many(targets, cache=LinkCache())
+    for target, result in results.items():
+        if isinstance(result, AutobaudResult):
+            mode = f"api, AP={result.api_mode}" if result.mode == "api" else result.mode
+            print(f"✓ {target}: {result.baud} baud, {mode} ({result.elapsed:.2f}s)")
+        elif result is None:
+            print(f"✗ {target}: no response")
+        else:
+            print(f"✗ {target}: {result}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+"""
+XBee Bench - Time the probe, query and flash flows against the emulator
+
+Every run starts a fresh xbee_emulator.py radio, so runs don't depend on each
+other, and times one flow end to end, connection included:
+
+    probe           recovery.py try_recovery_at_baud() at 9600, AT mode radio
+    at_query        test.py test_xbee_at(), +++ and one chained query
+    api_query       test.py test_xbee_at() with AP=1 frames
+    check           xbee_usb_direct_flash.py check_xbee_connection(), cold cache
+    upload_xmodem   xbee_firmware_flash.py upload_firmware_xmodem() from BL >
+    upload_stream   xbee_firmware_flash.py manual_firmware_upload(), raw stream
+
+Results are percentiles over the successful runs, plus bytes/s for uploads.
+Save them as a baseline and compare later runs against it:
+
+    python3 xbee_bench.py --save baseline.json
+    python3 xbee_bench.py at_query upload_xmodem -n 10 --compare baseline.json
+    python3 xbee_bench.py --latency 0.02 --jitter 0.03 --transport rfc2217
+
+A p50 more than --threshold slower than the baseline (and by more than
+NOISE_FLOOR) is a regression, and so is a run that used to succeed failing.
+The exit status is non-zero if there are any.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import platform
+import random
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from collections import namedtuple
+
+from recovery import try_recovery_at_baud
+from test import test_xbee_at
+from xbee_cache import LinkCache
+from xbee_firmware_flash import manual_firmware_upload, upload_firmware_xmodem
+from xbee_gbl import TAG_APPLICATION, TAG_END, TAG_HEADER, TAG_PROG
+from xbee_transport import XBeeLink
+from xbee_usb_direct_flash import check_xbee_connection
+from xbee_xmodem import FlashJournal, start_upload
+
+EMULATOR_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "xbee_emulator.py")
+STARTUP_TIMEOUT = 5.0
+STOP_TIMEOUT = 2.0
+DEFAULT_RUNS = 5
+DEFAULT_IMAGE_SIZE = 64 * 1024
+DEFAULT_THRESHOLD = 0.10
+# Differences below this are timer noise, not regressions
+NOISE_FLOOR = 0.02
+PERCENTILES = (50, 90, 99)
+
+# run(target, image) returns True on success; emulator are extra xbee_emulator.py arguments
+Scenario = namedtuple("Scenario", ["description", "emulator", "run", "upload"])
+
+
+def run_probe(target, image):
+    with XBeeLink(target, 9600) as link:
+        found, _ = try_recovery_at_baud(9600, link)
+    return found
+
+
+def run_at_query(target, image):
+    with XBeeLink(target, 9600) as link:
+        return bool(test_xbee_at(link, 9600))
+
+
+def run_api_query(target, image):
+    with XBeeLink(target, 9600) as link:
+        return bool(test_xbee_at(link, 9600, api_mode=1))
+
+
+def run_check(target, image):
+    # Every run gets a new port, so the link cache never knows the target
+    baud, _ = check_xbee_connection(target)
+    return baud is not None
+
+
+def run_upload_xmodem(target, image):
+    with XBeeLink(target, 115200) as link:
+        return upload_firmware_xmodem(image, link)
+
+
+def run_upload_stream(target, image):
+    with XBeeLink(target, 115200) as link:
+        # What upload_firmware_xmodem does before falling back to it
+        return start_upload(link.console) and manual_firmware_upload(image, link)
+
+
+SCENARIOS = {
+    "probe": Scenario("recovery probe at 9600", [], run_probe, False),
+    "at_query": Scenario("AT mode query", [], run_at_query, False),
+    "api_query": Scenario("API mode query", ["--api-mode", "1"], run_api_query, False),
+    "check": Scenario("connection check, cold cache", [], run_check, False),
+    "upload_xmodem": Scenario("XMODEM upload", ["--bootloader"], run_upload_xmodem, True),
+    "upload_stream": Scenario("raw stream upload", ["--bootloader", "--raw-upload"], run_upload_stream, True),
+}
+
+
+def synthetic_image(size, seed=0):
+    """A valid GBL image with size bytes of random programming data"""
+    rng = random.Random(seed)
+
+    def tag(tag_id, body):
+        return struct.pack("<II", tag_id, len(body)) + body
+
+    image = tag(TAG_HEADER, struct.pack("<II", 0x03000000, 0))
+    image += tag(TAG_APPLICATION, struct.pack("<III", 0x01, 0x1015, 0) + bytes(16))
+    image += tag(TAG_PROG, struct.pack("<I", 0) + bytes(rng.getrandbits(8) for _ in range(size)))
+    image += struct.pack("<II", TAG_END, 4)
+    return image + struct.pack("<I", zlib.crc32(image))
+
+
+def free_port():
+    """A TCP port nobody listens on right now"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class EmulatorProcess:
+    """xbee_emulator.py in a subprocess, its own interpreter so it doesn't share the GIL with the flow"""
+
+    def __init__(self, transport, arguments):
+        self.transport = transport
+        self.arguments = arguments
+        self.process = None
+        self.target = None
+
+    def start(self):
+        if self.transport == "pty":
+            self.target = os.path.join(tempfile.gettempdir(), f"ttyXBEE-bench-{os.getpid()}")
+            where = ["--pty", self.target]
+        else:
+            port = free_port()
+            self.target = f"{self.transport}://127.0.0.1:{port}"
+            where = ["--tcp", str(port)] + (["--rfc2217"] if self.transport == "rfc2217" else [])
+        self.process = subprocess.Popen([sys.executable, EMULATOR_SCRIPT] + where + self.arguments,
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                break
+            if self.ready():
+                return self.target
+            time.sleep(0.02)
+        self.stop()
+        raise RuntimeError(f"emulator did not start on {self.target}")
+
+    def ready(self):
+        if self.transport == "pty":
+            return os.path.exists(self.target)
+        try:
+            socket.create_connection(("127.0.0.1", int(self.target.rsplit(":", 1)[1])), 0.2).close()
+            return True
+        except OSError:
+            return False
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            try:
+                self.process.wait(STOP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+            self.process = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def percentile(samples, p):
+    """Nearest rank percentile of sorted samples"""
+    return samples[max(0, math.ceil(p / 100 * len(samples)) - 1)]
+
+
+def summarize(samples, failures, size=None):
+    """Statistics for one scenario, timings over the successful runs only"""
+    samples = sorted(samples)
+    result = {"runs": len(samples) + failures, "ok": len(samples), "samples": [round(s, 4) for s in samples]}
+    if not samples:
+        return result
+    result["min"] = samples[0]
+    result["mean"] = sum(samples) / len(samples)
+    result["max"] = samples[-1]
+    for p in PERCENTILES:
+        result[f"p{p}"] = percentile(samples, p)
+    if size:
+        result["bytes"] = size
+        result["bytes_per_s"] = size / result["p50"]
+    return result
+
+
+def bench(name, scenario, runs, image_path, size, transport, path_arguments, verbose=False):
+    """Time runs of one scenario, returns its summary"""
+    samples = []
+    failures = 0
+    targets = set()
+    for run in range(runs):
+        with EmulatorProcess(transport, scenario.emulator + path_arguments) as target:
+            targets.add(target)
+            output = io.StringIO()
+            start = time.perf_counter()
+            try:
+                with contextlib.redirect_stdout(sys.stdout if verbose else output):
+                    ok = scenario.run(target, image_path)
+            except Exception as e:
+                output.write(f"{type(e).__name__}: {e}\n")
+                ok = False
+            elapsed = time.perf_counter() - start
+        if ok:
+            samples.append(elapsed)
+        else:
+            failures += 1
+            last = [line for line in output.getvalue().splitlines() if line.strip()][-1:]
+            print(f"  ✗ {name} run {run + 1} failed after {elapsed:.2f}s{': ' + last[0].strip() if last else ''}")
+    # Leave nothing behind in the link cache or the flash journal
+    cache = LinkCache()
+    for target in targets:
+        cache.invalidate(target)
+        FlashJournal(target).clear()
+    return summarize(samples, failures, size if scenario.upload else None)
+
+
+def format_result(name, result):
+    """One table line"""
+    if not result["ok"]:
+        return f"  {name:<14} {result['ok']}/{result['runs']} ok"
+    line = (f"  {name:<14} {result['ok']}/{result['runs']} ok  p50 {result['p50']:7.3f}s  p90 {result['p90']:7.3f}s  "
+            f"p99 {result['p99']:7.3f}s  min {result['min']:7.3f}s")
+    if "bytes_per_s" in result:
+        line += f"  {result['bytes_per_s'] / 1024:6.1f} KB/s"
+    return line
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """Print the changes against a baseline, returns the names that regressed"""
+    regressions = []
+    print()
+    print("Against baseline")
+    print("================")
+    if baseline.get("settings") != results["settings"]:
+        print(f"⚠ Different settings, baseline: {baseline.get('settings')}")
+    for name, result in results["scenarios"].items():
+        before = baseline.get("scenarios", {}).get(name)
+        if before is None:
+            print(f"  {name:<14} not in the baseline")
+            continue
+        if before["ok"] and not result["ok"]:
+            print(f"✗ {name:<14} all runs failed, {before['ok']}/{before['runs']} ok before")
+            regressions.append(name)
+            continue
+        if not before["ok"] or not result["ok"]:
+            print(f"  {name:<14} nothing to compare")
+            continue
+        change = result["p50"] / before["p50"] - 1
+        slower = change > threshold and result["p50"] - before["p50"] > NOISE_FLOOR
+        failing = result["ok"] < result["runs"] and before["ok"] == before["runs"]
+        mark = "✗" if slower or failing else "✓"
+        note = " (runs failing now)" if failing else ""
+        print(f"{mark} {name:<14} p50 {before['p50']:7.3f}s -> {result['p50']:7.3f}s  {change:+7.1%}{note}")
+        if slower or failing:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the XBee flows against the emulator")
+    parser.add_argument("scenarios", nargs="*", help=f"any of {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument("-n", "--runs", type=int, default=DEFAULT_RUNS, help="runs per scenario")
+    parser.add_argument("--transport", choices=("socket", "rfc2217", "pty"), default="socket",
+                        help="how the flows reach the emulator")
+    parser.add_argument("--latency", type=float, default=0.0, help="one-way path delay in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random extra delay, up to this many seconds")
+    parser.add_argument("--drop", type=float, default=0.0, help="probability of losing each 128-byte chunk")
+    parser.add_argument("--seed", type=int, default=1, help="emulator random seed")
+    parser.add_argument("--image", help="GBL image to upload (default: a synthetic one)")
+    parser.add_argument("--image-size", type=int, default=DEFAULT_IMAGE_SIZE, help="synthetic image size in bytes")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON file to compare against")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="p50 slowdown that counts as a regression, 0.1 is 10%%")
+    parser.add_argument("-v", "--verbose", action="store_true", help="show the flows' output")
+    args = parser.parse_args()
+
+    names = args.scenarios or list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario {', '.join(unknown)}")
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    image_path = args.image
+    if image_path is None:
+        with tempfile.NamedTemporaryFile(suffix=".gbl", delete=False) as f:
+            f.write(synthetic_image(args.image_size, args.seed))
+            image_path = f.name
+    size = os.path.getsize(image_path)
+
+    path_arguments = ["--boot-time", "0", "--seed", str(args.seed)]
+    for option in ("latency", "jitter", "drop"):
+        if getattr(args, option):
+            path_arguments += [f"--{option}", str(getattr(args, option))]
+    settings = {"transport": args.transport, "latency": args.latency, "jitter": args.jitter, "drop": args.drop,
+                "image_bytes": size}
+
+    print("XBee Bench")
+    print("==========")
+    print(f"{len(names)} scenario(s), {args.runs} runs each, over {args.transport}, image {size} bytes")
+    if args.latency or args.jitter or args.drop:
+        print(f"Path: {args.latency * 1000:.0f}ms latency, {args.jitter * 1000:.0f}ms jitter, {args.drop:.1%} drops")
+    print()
+
+    results = {"created": time.time(), "host": platform.node(), "python": platform.python_version(),
+               "settings": settings, "scenarios": {}}
+    try:
+        for name in names:
+            scenario = SCENARIOS[name]
+            print(f"{name}: {scenario.description}")
+            result = bench(name, scenario, args.runs, image_path, size, args.transport, path_arguments,
+                           args.verbose)
+            results["scenarios"][name] = result
+            print(format_result(name, result))
+    except KeyboardInterrupt:
+        print("\n^C received")
+    finally:
+        if args.image is None:
+            os.unlink(image_path)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=1)
+        print(f"\nResults saved to {args.save}")
+
+    regressions = compare(results, baseline, args.threshold) if baseline else []
+    if regressions:
+        print(f"\n✗ {len(regressions)} regression(s): {', '.join(regressions)}")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+XBee PTY Bridge - Keep /tmp/ttyXBEE stable while the TCP link to the ESP32 comes and goes
+
+Replacement for the socat restart loop. The PTY is created once and never
+removed, the TCP side reconnects with jittered backoff and data is buffered in
+both directions while the link is down. Link state can be queried from the
+control socket (/tmp/ttyXBEE.ctl by default):
+
+    echo status | socat - UNIX-CONNECT:/tmp/ttyXBEE.ctl
+"""
+
+import asyncio
+import json
+import os
+import random
+import signal
+import socket
+import sys
+import time
+import tty
+
+DEFAULT_DEVICE = "/tmp/ttyXBEE"
+BACKOFF_MIN = 0.05
+BACKOFF_MAX = 5.0
+CONNECT_TIMEOUT = 3.0
+
+
+def control_path_for(device_path):
+    """Default control socket path for a device link"""
+    return device_path + ".ctl"
+
+
+def query_bridge(control_path, command="status", timeout=2.0):
+    """Send one command to a running bridge, returns the decoded JSON reply or None"""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(control_path)
+            sock.sendall(command.encode() + b"\n")
+            reply = b""
+            while not reply.endswith(b"\n"):
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                reply += chunk
+        return json.loads(reply)
+    except (OSError, ValueError):
+        return None
+
+
+def wait_for_link(device_path=DEFAULT_DEVICE, timeout=30):
+    """Wait until the bridge behind device_path reports a live TCP link"""
+    control_path = control_path_for(device_path)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status = query_bridge(control_path)
+        if status is None:
+            return False
+        if status["state"] == "connected":
+            return True
+        time.sleep(0.05)
+    return False
+
+
+class PtyBridge:
+    """One PTY, one TCP endpoint, buffered in both directions"""
+
+    def __init__(self, host, port, device_path=DEFAULT_DEVICE, control_path=None, buffer_size=65536):
+        self.host = host
+        self.port = port
+        self.device_path = device_path
+        self.control_path = control_path or control_path_for(device_path)
+        self.buffer_size = buffer_size
+
+        self.state = "disconnected"
+        self.writer = None
+        self.to_tcp = bytearray()  # PTY data waiting for the link
+        self.to_pty = bytearray()  # TCP data the PTY could not take yet
+        self.master_fd = None
+        self.slave_fd = None
+        self.reconnect_event = None
+
+        self.connects = 0
+        self.failures = 0
+        self.bytes_to_tcp = 0
+        self.bytes_to_pty = 0
+        self.dropped = 0
+        self.connected_since = None
+        self.last_error = None
+
+    def open_pty(self):
+        """Create the PTY and point device_path at it"""
+        self.master_fd, self.slave_fd = os.openpty()
+        # Holding the slave open ourselves keeps the master readable while no
+        # client has the device open, so clients can come and go freely.
+        tty.setraw(self.slave_fd)
+        os.set_blocking(self.master_fd, False)
+        if os.path.islink(self.device_path) or os.path.exists(self.device_path):
+            os.unlink(self.device_path)
+        os.symlink(os.ttyname(self.slave_fd), self.device_path)
+
+    def close_pty(self):
+        """Remove the device link and close the PTY"""
+        if os.path.islink(self.device_path):
+            os.unlink(self.device_path)
+        for fd in (self.master_fd, self.slave_fd):
+            if fd is not None:
+                os.close(fd)
+
+    def status(self):
+        """Link state as a dict, for the control socket"""
+        return {
+            "state": self.state,
+            "host": self.host,
+            "port": self.port,
+            "device": self.device_path,
+            "connects": self.connects,
+            "failures": self.failures,
+            "bytes_to_tcp": self.bytes_to_tcp,
+            "bytes_to_pty": self.bytes_to_pty,
+            "buffered_to_tcp": len(self.to_tcp),
+            "buffered_to_pty": len(self.to_pty),
+            "dropped": self.dropped,
+            "connected_for": round(time.monotonic() - self.connected_since, 3) if self.connected_since else None,
+            "last_error": self.last_error,
+        }
+
+    def buffer(self, queue, data):
+        """Append to a buffer, dropping the oldest bytes beyond buffer_size"""
+        queue += data
+        overflow = len(queue) - self.buffer_size
+        if overflow > 0:
+            del queue[:overflow]
+            self.dropped += overflow
+
+    def on_pty_readable(self):
+        """Client wrote to the device"""
+        try:
+            data = os.read(self.master_fd, 65536)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.last_error = f"pty read: {e}"
+            return
+        if self.writer is not None and not self.to_tcp:
+            self.writer.write(data)
+            self.bytes_to_tcp += len(data)
+        else:
+            self.buffer(self.to_tcp, data)
+
+    def write_pty(self, data):
+        """Forward TCP data to the device, keeping what does not fit"""
+        loop = asyncio.get_running_loop()
+        if not self.to_pty:
+            try:
+                written = os.write(self.master_fd, data)
+            except BlockingIOError:
+                written = 0
+            self.bytes_to_pty += written
+            data = data[written:]
+            if not data:
+                return
+            loop.add_writer(self.master_fd, self.on_pty_writable)
+        self.buffer(self.to_pty, data)
+
+    def on_pty_writable(self):
+        """Device has room again, flush the backlog"""
+        try:
+            written = os.write(self.master_fd, self.to_pty)
+        except BlockingIOError:
+            return
+        self.bytes_to_pty += written
+        del self.to_pty[:written]
+        if not self.to_pty:
+            asyncio.get_running_loop().remove_writer(self.master_fd)
+
+    async def connect(self):
+        """Open the TCP link, returns (reader, writer)"""
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), CONNECT_TIMEOUT)
+        sock = writer.get_extra_info("socket")
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 10)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 5)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+        return reader, writer
+
+    async def pump(self, reader):
+        """Copy TCP data to the PTY until the link drops or a reconnect is requested"""
+        while not self.reconnect_event.is_set():
+            read = asyncio.ensure_future(reader.read(65536))
+            reconnect = asyncio.ensure_future(self.reconnect_event.wait())
+            done, _ = await asyncio.wait({read, reconnect}, return_when=asyncio.FIRST_COMPLETED)
+            if read not in done:
+                read.cancel()
+                return
+            reconnect.cancel()
+            data = read.result()
+            if not data:
+                self.last_error = "closed by peer"
+                return
+            self.write_pty(data)
+
+    async def run_link(self):
+        """Keep the TCP link up forever"""
+        delay = BACKOFF_MIN
+        while True:
+            self.state = "connecting"
+            try:
+                reader, writer = await self.connect()
+            except (OSError, asyncio.TimeoutError) as e:
+                self.failures += 1
+                self.last_error = str(e) or type(e).__name__
+                self.state = "disconnected"
+                # Full jitter so several bridges restarting together don't sync up
+                await asyncio.sleep(random.uniform(BACKOFF_MIN, delay))
+                delay = min(delay * 2, BACKOFF_MAX)
+                continue
+
+            print(f"✓ Connected to {self.host}:{self.port}")
+            self.connects += 1
+            self.connected_since = time.monotonic()
+            self.reconnect_event.clear()
+            if self.to_tcp:
+                writer.write(self.to_tcp)
+                self.bytes_to_tcp += len(self.to_tcp)
+                self.to_tcp.clear()
+            self.writer = writer
+            self.state = "connected"
+            delay = BACKOFF_MIN
+            try:
+                await self.pump(reader)
+            except OSError as e:
+                self.last_error = str(e)
+            self.writer = None
+            self.connected_since = None
+            self.state = "disconnected"
+            writer.close()
+            print(f"✗ Link lost ({self.last_error}), reconnecting...")
+
+    async def handle_control(self, reader, writer):
+        """Serve one control socket client"""
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode(errors="ignore").strip()
+                if command == "reconnect":
+                    self.last_error = "reconnect requested"
+                    self.reconnect_event.set()
+                    reply = {"ok": True}
+                elif command == "status":
+                    reply = self.status()
+                else:
+                    reply = {"ok": False, "error": f"unknown command {command!r}"}
+                writer.write(json.dumps(reply).encode() + b"\n")
+                await writer.drain()
+        except OSError:
+            pass
+        writer.close()
+
+    async def run(self):
+        """Run until cancelled"""
+        loop = asyncio.get_running_loop()
+        self.reconnect_event = asyncio.Event()
+        self.open_pty()
+        loop.add_reader(self.master_fd, self.on_pty_readable)
+        if os.path.exists(self.control_path):
+            os.unlink(self.control_path)
+        server = await asyncio.start_unix_server(self.handle_control, self.control_path)
+        print(f"✓ {self.device_path} -> {os.ttyname(self.slave_fd)}, control socket {self.control_path}")
+        try:
+            await self.run_link()
+        finally:
+            server.close()
+            loop.remove_reader(self.master_fd)
+            if self.to_pty:
+                loop.remove_writer(self.master_fd)
+            if os.path.exists(self.control_path):
+                os.unlink(self.control_path)
+            self.close_pty()
+
+
+async def run_until_stopped(coro):
+    """Run coro until it ends or SIGTERM/SIGHUP cancels it, its finally blocks run either way"""
+    task = asyncio.ensure_future(coro)
+    loop = asyncio.get_running_loop()
+    stopped = []
+
+    def stop(signum):
+        print(f"\nStopping ({signal.Signals(signum).name})...")
+        stopped.append(signum)
+        task.cancel()
+
+    for signum in (signal.SIGTERM, signal.SIGHUP):
+        loop.add_signal_handler(signum, stop, signum)
+    try:
+        return await task
+    except asyncio.CancelledError:
+        if not stopped:
+            raise
+    finally:
+        for signum in (signal.SIGTERM, signal.SIGHUP):
+            loop.remove_signal_handler(signum)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Bridge a stable PTY to the ESP32 serial bridge")
+    parser.add_argument("host", nargs="?", default="192.168.1.100", help="ESP32 address")
+    parser.add_argument("port", nargs="?", type=int, default=8888, help="ESP32 serial bridge port")
+    parser.add_argument("-d", "--device", default=DEFAULT_DEVICE, help="PTY link to create")
+    parser.add_argument("-c", "--control", help="Control socket path (default: DEVICE.ctl)")
+    parser.add_argument("--buffer", type=int, default=65536, help="Bytes buffered per direction during outages")
+
+    args = parser.parse_args()
+
+    print("XBee PTY Bridge")
+    print(f"ESP32: {args.host}:{args.port}")
+    bridge = PtyBridge(args.host, args.port, args.device, args.control, args.buffer)
+    try:
+        asyncio.run(run_until_stopped(bridge.run()))
+    except KeyboardInterrupt:
+        print("\nStopping...")
+    except OSError as e:
+        print(f"✗ {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+"""
+XBee Bridge Bench - Echo round trips and throughput through the serial bridge
+
+Needs something that sends every byte back: a jumper from TX to RX on the
+ESP32 UART behind serial_bridge, or the local stand-in this script serves,
+which echoes at a UART's pace and batches like the bridge's flush settings:
+
+    python3 xbee_bridge_bench.py socket://192.168.1.100:8888 -s 1,64,256,1024
+    python3 xbee_bridge_bench.py socket://192.168.1.100:8888 --pty-hop
+    python3 xbee_bridge_bench.py --serve 8888 --baud 115200 --flush-timeout 0.002
+    python3 xbee_bridge_bench.py --local --pty-hop
+
+For every payload size it measures the echo round trip (p50/p90/p99/max) and
+a sustained stream in both directions at once: how fast the host can hand
+data over (tx) and how fast it comes back (rx), with the bytes lost.
+
+--pty-hop repeats each socket:// target through a temporary PTY, made by
+xbee_bridge.py or, with --socat, by socat with the options socat.sh uses,
+to show what the extra hop to /tmp/ttyXBEE costs. --local starts the stand-in
+and benchmarks that. Run it again with other serial_bridge settings (buffer
+sizes, flush_timeout, framing) and a --label to see where the path saturates.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from xbee_api import encode_frame
+from xbee_bench import percentile
+from xbee_bridge import wait_for_link
+from xbee_emulator import Channel
+from xbee_stream import BITS_PER_BYTE
+from xbee_transport import XBeeLink
+
+BRIDGE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "xbee_bridge.py")
+THIS_SCRIPT = os.path.abspath(__file__)
+DEFAULT_SIZES = (1, 16, 64, 256, 1024)
+DEFAULT_COUNT = 100
+DEFAULT_STREAM = 64 * 1024
+ECHO_TIMEOUT = 2.0
+# A stream is over once nothing came back for this long
+IDLE_TIMEOUT = 2.0
+STARTUP_TIMEOUT = 10.0
+STOP_TIMEOUT = 2.0
+# serial_bridge defaults, for the stand-in
+FLUSH_THRESHOLD = 256
+FLUSH_TIMEOUT = 0.002
+API_TX_REQUEST = 0x10
+
+
+def make_payload(size, seed, frames=False):
+    """size bytes that differ from one round trip to the next, as one API frame with frames"""
+    if frames and size >= 6:
+        # Start byte, length and checksum around a Transmit Request
+        body = bytes((API_TX_REQUEST,)) + bytes((seed + k) & 0xFF for k in range(size - 5))
+        return encode_frame(body)
+    return bytes((seed + k) & 0xFF for k in range(size))
+
+
+def measure_rtt(ser, size, count, frames=False):
+    """Echo round trips of one payload size, returns (sorted seconds, failures)"""
+    ser.timeout = ECHO_TIMEOUT
+    ser.reset_input_buffer()
+    samples = []
+    failures = 0
+    for i in range(count):
+        payload = make_payload(size, i, frames)
+        start = time.perf_counter()
+        ser.write(payload)
+        echo = ser.read(len(payload))
+        elapsed = time.perf_counter() - start
+        if echo == payload:
+            samples.append(elapsed)
+            continue
+        failures += 1
+        # Whatever is left of this round trip would spoil the next one
+        time.sleep(0.1)
+        ser.reset_input_buffer()
+    return sorted(samples), failures
+
+
+def measure_stream(ser, size, total, frames=False):
+    """Write total bytes in size chunks while reading the echo, returns a dict"""
+    chunks = [make_payload(size, i, frames) for i in range(max(1, total // size))]
+    total = sum(len(chunk) for chunk in chunks)
+    ser.reset_input_buffer()
+    ser.timeout = 0.1
+    written = {}
+
+    def write():
+        for chunk in chunks:
+            ser.write(chunk)
+        ser.flush()
+        written["done"] = time.perf_counter()
+
+    start = time.perf_counter()
+    writer = threading.Thread(target=write, daemon=True)
+    writer.start()
+    received = 0
+    last = start
+    while received < total and time.perf_counter() - last < IDLE_TIMEOUT:
+        data = ser.read(max(1, ser.in_waiting))
+        if data:
+            received += len(data)
+            last = time.perf_counter()
+    writer.join(IDLE_TIMEOUT)
+    tx_elapsed = written.get("done", time.perf_counter()) - start
+    rx_elapsed = last - start
+    return {
+        "bytes": total,
+        "received": received,
+        "lost": max(0, total - received),
+        "tx_bytes_per_s": total / tx_elapsed if tx_elapsed > 0 else 0.0,
+        "rx_bytes_per_s": received / rx_elapsed if rx_elapsed > 0 else 0.0,
+    }
+
+
+def rtt_stats(samples, failures):
+    """Percentiles of sorted round trip samples"""
+    result = {"count": len(samples) + failures, "failures": failures}
+    if samples:
+        result.update({f"p{p}": percentile(samples, p) for p in (50, 90, 99)})
+        result["max"] = samples[-1]
+    return result
+
+
+def bench_target(target, sizes, count, stream, baud, frames=False):
+    """Round trips and streams at every size on one target, returns {size: {...}}"""
+    results = {}
+    with XBeeLink(target, baud) as link:
+        ser = link.serial
+        for size in sizes:
+            samples, failures = measure_rtt(ser, size, count, frames)
+            result = {"rtt": rtt_stats(samples, failures)}
+            if stream:
+                result["stream"] = measure_stream(ser, size, stream, frames)
+            results[size] = result
+            print(format_line(size, result, baud))
+    return results
+
+
+def format_line(size, result, baud=None):
+    """One table line"""
+    rtt = result["rtt"]
+    if "p50" in rtt:
+        line = (f"  {size:>5} B  rtt p50 {rtt['p50'] * 1000:7.2f}ms  p90 {rtt['p90'] * 1000:7.2f}ms  "
+                f"p99 {rtt['p99'] * 1000:7.2f}ms  max {rtt['max'] * 1000:7.2f}ms")
+    else:
+        line = f"  {size:>5} B  no echo"
+    if rtt["failures"]:
+        line += f"  ({rtt['failures']}/{rtt['count']} failed)"
+    stream = result.get("stream")
+    if stream:
+        line += f"  tx {stream['tx_bytes_per_s'] / 1024:7.1f} KB/s  rx {stream['rx_bytes_per_s'] / 1024:7.1f} KB/s"
+        if baud:
+            line += f" ({stream['rx_bytes_per_s'] * BITS_PER_BYTE / baud:4.0%} of line)"
+        if stream["lost"]:
+            line += f"  {stream['lost']} lost"
+    return line
+
+
+class PtyHop:
+    """A temporary PTY in front of a socket:// target, like socat.sh sets up /tmp/ttyXBEE"""
+
+    def __init__(self, target, use_socat=False):
+        host, port = target.split("://", 1)[1].rsplit(":", 1)
+        self.host = host
+        self.port = port
+        self.use_socat = use_socat
+        self.device = os.path.join(tempfile.gettempdir(), f"ttyXBEE-hop-{os.getpid()}")
+        self.process = None
+
+    def start(self):
+        if self.use_socat:
+            command = ["socat", f"PTY,link={self.device},raw,echo=0",
+                       f"TCP:{self.host}:{self.port},keepalive,keepidle=30,keepintvl=10,keepcnt=3"]
+        else:
+            command = [sys.executable, BRIDGE_SCRIPT, self.host, self.port, "--device", self.device]
+        self.process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while not os.path.exists(self.device):
+            if self.process.poll() is not None or time.monotonic() > deadline:
+                self.stop()
+                raise RuntimeError(f"no PTY at {self.device}")
+            time.sleep(0.05)
+        if not self.use_socat and not wait_for_link(self.device, STARTUP_TIMEOUT):
+            self.stop()
+            raise RuntimeError(f"xbee_bridge.py could not connect to {self.host}:{self.port}")
+        return self.device
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            try:
+                self.process.wait(STOP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+            self.process = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class Loopback:
+    """Stand-in for a serial_bridge with TX wired to RX
+
+    Bytes come back at the UART's pace after the network latency, and are
+    held until flush_threshold of them are waiting or flush_timeout has passed
+    since the first, like the bridge's UART to TCP buffer.
+    """
+
+    def __init__(self, baud=115200, latency=0.0, jitter=0.0, flush_threshold=FLUSH_THRESHOLD,
+                 flush_timeout=FLUSH_TIMEOUT, seed=None):
+        self.baud = baud
+        self.latency = latency
+        self.jitter = jitter
+        self.flush_threshold = flush_threshold
+        self.flush_timeout = flush_timeout
+        self.rng = random.Random(seed)
+
+    async def handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        pending = bytearray()
+        timer = None
+
+        def flush():
+            nonlocal timer
+            timer = None
+            if pending:
+                writer.write(bytes(pending))
+                pending.clear()
+
+        def echoed(data, baud):
+            nonlocal timer
+            pending.extend(data)
+            if len(pending) >= self.flush_threshold:
+                if timer is not None:
+                    timer.cancel()
+                flush()
+            elif timer is None:
+                timer = loop.call_later(self.flush_timeout, flush)
+
+        # Both network legs in one delay, the UART sends and receives the same byte
+        channel = Channel(echoed, 2 * self.latency, self.jitter, 0.0, self.rng)
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                channel.send(data, self.baud)
+        except OSError:
+            pass
+        if timer is not None:
+            timer.cancel()
+        writer.close()
+
+    async def serve(self, host, port, started=None):
+        server = await asyncio.start_server(self.handle, host, port, reuse_address=True)
+        if started:
+            started()
+        async with server:
+            await server.serve_forever()
+
+
+def start_local(args):
+    """The stand-in in a subprocess, returns (process, target)"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    command = [sys.executable, THIS_SCRIPT, "--serve", str(port), "--baud", str(args.baud),
+               "--latency", str(args.latency), "--jitter", str(args.jitter),
+               "--flush-threshold", str(args.flush_threshold), "--flush-timeout", str(args.flush_timeout)]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline and process.poll() is None:
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.2).close()
+            return process, f"socket://127.0.0.1:{port}"
+        except OSError:
+            time.sleep(0.05)
+    process.terminate()
+    raise RuntimeError("the stand-in did not start")
+
+
+def parse_sizes(text):
+    return [int(size) for size in text.split(",") if size]
+
+
+def print_hop_cost(runs):
+    """What the PTY hop added to the median round trip, per size"""
+    direct = {run["target"]: run["sizes"] for run in runs if not run["hop"]}
+    for run in runs:
+        if not run["hop"] or run["target"] not in direct:
+            continue
+        print(f"\nPTY hop ({run['hop']}) on {run['target']}, added to the p50 round trip:")
+        for size, result in run["sizes"].items():
+            before = direct[run["target"]].get(size, {}).get("rtt", {})
+            after = result["rtt"]
+            if "p50" in before and "p50" in after:
+                print(f"  {size:>5} B  {(after['p50'] - before['p50']) * 1000:+7.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Echo latency and throughput through the ESP32 serial bridge")
+    parser.add_argument("targets", nargs="*", help="bridge URLs or PTY paths, with TX looped back to RX")
+    parser.add_argument("-s", "--sizes", type=parse_sizes, default=list(DEFAULT_SIZES), help="payload sizes in bytes")
+    parser.add_argument("-n", "--count", type=int, default=DEFAULT_COUNT, help="round trips per size")
+    parser.add_argument("--stream", type=int, default=DEFAULT_STREAM, help="bytes per throughput run, 0 to skip")
+    parser.add_argument("-b", "--baud", type=int, default=115200, help="UART rate, for line utilisation")
+    parser.add_argument("--frames", action="store_true", help="send each payload as an XBee API frame")
+    parser.add_argument("--pty-hop", action="store_true", help="also measure socket:// targets through a PTY")
+    parser.add_argument("--socat", action="store_true", help="make the PTY hop with socat instead of xbee_bridge.py")
+    parser.add_argument("--local", action="store_true", help="start the stand-in and measure it")
+    parser.add_argument("--label", help="note stored with the results, e.g. the bridge settings")
+    parser.add_argument("--json", help="write the results to this file")
+    standin = parser.add_argument_group("stand-in")
+    standin.add_argument("--serve", metavar="PORT", type=int, help="serve the stand-in on this port")
+    standin.add_argument("--host", default="127.0.0.1", help="address to serve on")
+    standin.add_argument("--latency", type=float, default=0.0, help="one-way network delay in seconds")
+    standin.add_argument("--jitter", type=float, default=0.0, help="random extra delay, up to this many seconds")
+    standin.add_argument("--flush-threshold", type=int, default=FLUSH_THRESHOLD, help="bytes that trigger a send")
+    standin.add_argument("--flush-timeout", type=float, default=FLUSH_TIMEOUT, help="seconds before a partial send")
+    args = parser.parse_args()
+
+    if args.serve:
+        loopback = Loopback(args.baud, args.latency, args.jitter, args.flush_threshold, args.flush_timeout)
+        try:
+            asyncio.run(loopback.serve(args.host, args.serve,
+                                       lambda: print(f"✓ Echoing on socket://{args.host}:{args.serve}")))
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if args.socat and not shutil.which("socat"):
+        parser.error("socat not found")
+    local = None
+    targets = list(args.targets)
+    if args.local:
+        local, target = start_local(args)
+        targets.append(target)
+    if not targets:
+        parser.error("no targets, pass bridge URLs or use --local")
+
+    # Each socket:// target again through its PTY hop, straight after it
+    runs = []
+    for target in targets:
+        runs.append((target, None))
+        if args.pty_hop and target.startswith("socket://"):
+            runs.append((target, "socat" if args.socat else "xbee_bridge.py"))
+
+    print("XBee Bridge Bench")
+    print("=================")
+    print(f"Sizes: {', '.join(map(str, args.sizes))} bytes, {args.count} round trips each, "
+          f"{args.stream} byte streams{', API frames' if args.frames else ''}")
+    results = {"created": time.time(), "label": args.label, "baud": args.baud, "frames": args.frames, "runs": []}
+    try:
+        for target, hop in runs:
+            print(f"\n{target}" + (f" through a PTY ({hop})" if hop else ""))
+            try:
+                if hop:
+                    with PtyHop(target, args.socat) as device:
+                        sizes = bench_target(device, args.sizes, args.count, args.stream, args.baud, args.frames)
+                else:
+                    sizes = bench_target(target, args.sizes, args.count, args.stream, args.baud, args.frames)
+            except (OSError, RuntimeError) as e:
+                print(f"  ✗ {e}")
+                continue
+            results["runs"].append({"target": target, "hop": hop, "sizes": sizes})
+    except KeyboardInterrupt:
+        print("\n^C received")
+    finally:
+        if local is not None:
+            local.terminate()
+            local.wait()
+
+    print_hop_cost(results["runs"])
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=1)
+        print(f"\nResults saved to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+XBee Link Cache - Remember how each radio was last reached
+
+Entries are keyed by target (device path or bridge URL) and, once ATSH/ATSL
+are known, by the radio's serial number, so settings follow a radio that
+moves to another bridge. Stored per entry: baud, mode (bootloader, at_mode,
+api), firmware version, guard time and the product ID of the last GBL image
+flashed. Entries expire after a TTL and are dropped as soon as they fail.
+
+    python3 xbee_cache.py            show the cache
+    python3 xbee_cache.py --clear    forget everything
+"""
+
+import contextlib
+import fcntl
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from xbee_at import serial_number
+
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "xbee")
+DEFAULT_PATH = os.path.join(CACHE_DIR, "links.json")
+DEFAULT_TTL = 24 * 3600
+
+# Fields that belong to the radio rather than to the path it was reached on
+RADIO_FIELDS = ("baud", "mode", "firmware", "guard_time", "product")
+
+
+def write_json(path, data):
+    """Write atomically, a crashed tool never leaves half a file behind"""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    with os.fdopen(fd, "w") as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+# Read-modify-write of the file, one thread at a time (autobaud_many, sweeps)
+_write_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """Exclusive lock on path + ".lock", held across processes (fleet flashing)"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with _write_lock, open(path + ".lock", "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class LinkCache:
+    """JSON file backed cache, reloaded on every lookup so parallel tools see each other's writes"""
+
+    def __init__(self, path=DEFAULT_PATH, ttl=DEFAULT_TTL):
+        self.path = path
+        self.ttl = ttl
+
+    def load(self):
+        """Whole cache as {"targets": {}, "radios": {}}"""
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        data.setdefault("targets", {})
+        data.setdefault("radios", {})
+        return data
+
+    def save(self, data):
+        """Write the whole cache"""
+        write_json(self.path, data)
+
+    def fresh(self, entry):
+        """True for an entry within the TTL"""
+        return entry is not None and time.time() - entry.get("updated", 0) < self.ttl
+
+    def lookup(self, target):
+        """Last known settings for target, None if unknown or expired"""
+        data = self.load()
+        entry = data["targets"].get(target)
+        if not self.fresh(entry):
+            return None
+        entry = dict(entry)
+        radio = data["radios"].get(entry.get("serial"))
+        if self.fresh(radio) and radio["updated"] > entry["updated"]:
+            # The radio was reached more recently somewhere else
+            entry.update({key: radio[key] for key in RADIO_FIELDS if key in radio})
+        return entry
+
+    def remember(self, target, **fields):
+        """Merge fields into target's entry (and its radio's, when the serial is known)"""
+        with file_lock(self.path):
+            data = self.load()
+            now = time.time()
+            entry = data["targets"].get(target) if self.fresh(data["targets"].get(target)) else {}
+            entry.update({key: value for key, value in fields.items() if value is not None})
+            entry["updated"] = now
+            data["targets"][target] = entry
+            if entry.get("serial"):
+                radio = data["radios"].setdefault(entry["serial"], {})
+                radio.update({key: entry[key] for key in RADIO_FIELDS if key in entry})
+                radio["updated"] = now
+            self.save(data)
+
+    def invalidate(self, target):
+        """Forget target after its cached settings stopped working"""
+        with file_lock(self.path):
+            data = self.load()
+            entry = data["targets"].pop(target, None)
+            if entry and entry.get("serial"):
+                data["radios"].pop(entry["serial"], None)
+            self.save(data)
+
+    def clear(self):
+        """Forget everything"""
+        with file_lock(self.path):
+            self.save({"targets": {}, "radios": {}})
+
+
+def remember_radio(cache, target, baud, mode, info):
+    """Store what a parameter query (xbee_at.query) found out about the radio"""
+    number = serial_number(info)
+    guard_time = info.get("GT")
+    cache.remember(
+        target,
+        baud=baud,
+        mode=mode,
+        firmware=info.get("VR"),
+        serial=f"{number:016X}" if number is not None else None,
+        guard_time=guard_time / 1000 if guard_time else None,
+    )
+
+
+def main():
+    cache = LinkCache()
+    if "--clear" in sys.argv[1:]:
+        cache.clear()
+        print(f"✓ Cleared {cache.path}")
+        return
+
+    data = cache.load()
+    print(f"XBee link cache: {cache.path}")
+    if not data["targets"]:
+        print("  (empty)")
+    for target, entry in sorted(data["targets"].items()):
+        age = time.time() - entry.get("updated", 0)
+        state = "" if cache.fresh(entry) else " (expired)"
+        details = ", ".join(f"{key}={entry[key]}" for key in ("baud", "mode", "firmware", "guard_time", "product", "serial")
+                            if key in entry)
+        print(f"  {target}: {details}, {age:.0f}s ago{state}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,742 @@
+#!/usr/bin/env python3
+"""
+XBee Emulator - A software XBee3 with Gecko bootloader, for testing without hardware
+
+Serves one emulated radio on a PTY or a TCP port, so every script here can
+run against it unchanged:
+
+    python3 xbee_emulator.py --pty /tmp/ttyXBEE
+    python3 xbee_emulator.py --tcp 8888 --rfc2217 --latency 0.02 --jitter 0.03
+    python3 test.py -d rfc2217://127.0.0.1:8888
+
+What it models:
+    transparent mode   +++ with guard times before and after, command mode
+                       timeout, chained ATxx,yy queries, settings applied on CN/AC
+    API mode           AP=1 and AP=2 local AT command frames, modem status on boot
+    baud rate          the radio's UART runs at BD, the bootloader at 115200; a
+                       host at another rate (PTY termios, RFC 2217) gets garbage
+    bootloader         AT%P / AT%F or a break with DTR low, the BL > menu,
+                       XMODEM-CRC receive with 128 and 1K blocks (or a raw stream
+                       with --raw-upload, done after a second of silence), GBL
+                       validation, the new image's version in ATVR after option 2
+    the path           one-way latency, jitter and dropped FIFO-sized chunks for
+                       the WiFi bridge, bytes paced at the UART rate
+
+Over plain TCP the host's rate is whatever --uart-baud says (the ESP32 UART),
+by default it follows the radio. Each instance reports its own SH/SL serial
+number, derived from where it listens unless --serial sets one.
+"""
+
+import argparse
+import asyncio
+import binascii
+import os
+import random
+import socket
+import sys
+import termios
+import tty
+from collections import deque
+
+import serial
+from serial import rfc2217
+
+from xbee_api import AT_COMMAND, AT_COMMAND_RESPONSE, MODEM_STATUS, FrameDecoder, encode_frame
+from xbee_at import BAUD_RATES
+from xbee_bridge import run_until_stopped
+from xbee_expect import BL_PROMPT, GECKO_BANNER
+from xbee_gbl import parse
+from xbee_stream import BITS_PER_BYTE, BRIDGE_BURST
+from xbee_xmodem import ACK, BEGIN_UPLOAD, CAN, CRC_REQUEST, EOT, LARGE_BLOCK, NAK, PAD, SMALL_BLOCK, SOH, STX
+
+AT_COMMAND_QUEUED = 0x09
+DIGI_OUI = 0x0013A200  # SH of every XBee
+BOOTLOADER_BAUD = 115200
+MENU = (b"\r\n" + GECKO_BANNER + b" v1.6.0\r\n1. upload gbl\r\n2. run\r\n3. ebl info\r\n" + BL_PROMPT + b" ")
+TICK = 0.01
+# The receiver asks for the first block once a second, and gives up after a minute
+CRC_REQUEST_INTERVAL = 1.0
+CRC_REQUESTS = 60
+BLOCK_TIMEOUT = 1.0
+
+# name: (bytes in API responses, (lowest, highest) or None if read only)
+REGISTERS = {
+    "VR": (2, None),
+    "HV": (2, None),
+    "SH": (4, None),
+    "SL": (4, None),
+    "AI": (1, None),
+    "ID": (8, (0, 0xFFFFFFFFFFFFFFFF)),
+    "AP": (1, (0, 2)),
+    "CE": (1, (0, 1)),
+    "BD": (4, (0, 0xE1000)),  # 0-8 or the rate itself
+    "GT": (2, (1, 0x1770)),
+    "CT": (2, (2, 0x1770)),
+}
+# Answered with OK, no value
+ACTIONS = ("CN", "AC", "WR", "FR", "%P", "%F")
+
+# Standard termios speeds, what a PTY client set with tcsetattr
+TERMIOS_SPEEDS = {getattr(termios, f"B{baud}"): baud for baud in
+                  (1200, 2400, 4800, 9600, 19200, 38400, 57600, 115200, 230400, 460800, 921600)
+                  if hasattr(termios, f"B{baud}")}
+
+
+def garble(data, sent_baud, received_baud, rng):
+    """What a UART at received_baud makes of data sent at sent_baud, random bytes of about the right count"""
+    count = max(1, round(len(data) * received_baud / sent_baud))
+    return bytes(rng.getrandbits(8) for _ in range(count))
+
+
+class Radio:
+    """XBee3 firmware and Gecko bootloader as a state machine
+
+    Bytes go in through receive(), replies come out through the send
+    callback, timers run from tick(). Time comes from clock, so the same
+    radio works on any event loop.
+    """
+
+    def __init__(self, send, clock, baud=9600, api_mode=0, guard_time=1.0, firmware=0x1014,
+                 serial_number=DIGI_OUI << 32 | 0x41A1B2C3, pan_id=0x1234, coordinator=True, boot_time=1.0, bootloader=False,
+                 raw_upload=False):
+        self.send = send
+        self.clock = clock
+        self.boot_time = boot_time
+        self.raw_upload = raw_upload  # takes the image as a plain byte stream instead of XMODEM
+        bd = next((value for value, rate in BAUD_RATES.items() if rate == baud), baud)
+        self.registers = {
+            "VR": firmware, "HV": 0x4247, "SH": serial_number >> 32, "SL": serial_number & 0xFFFFFFFF, "AI": 0,
+            "ID": pan_id, "AP": api_mode, "CE": int(coordinator), "BD": bd, "GT": int(guard_time * 1000), "CT": 0x64,
+        }
+        self.pending = {}  # set in command mode, applied by CN/AC
+        self.decoder = FrameDecoder(api_mode == 2)
+        self.line = bytearray()
+        self.last_rx = -guard_time
+        self.plus_count = 0
+        self.state = None
+        self.ready_at = 0.0
+        self.image = bytearray()
+        self.buffer = bytearray()
+        self.expected = 1
+        self.next_request = 0.0
+        self.requests = 0
+        self.application = True
+        self.stats = {"commands": 0, "frames": 0, "blocks": 0, "nak": 0, "uploads": 0, "aborted": 0, "transmitted": 0}
+        if bootloader:
+            # Its banner went out before anyone was listening
+            self.state = "bootloader"
+        else:
+            self.boot()
+
+    @property
+    def uart_baud(self):
+        """Rate the radio's UART runs at right now"""
+        if self.state in ("bootloader", "receiving"):
+            return BOOTLOADER_BAUD
+        return BAUD_RATES.get(self.registers["BD"], self.registers["BD"])
+
+    @property
+    def guard_time(self):
+        return self.registers["GT"] / 1000
+
+    # - firmware
+
+    def boot(self):
+        """Reset into the application, deaf until it has booted"""
+        self.state = "booting"
+        self.ready_at = self.clock() + self.boot_time
+        self.plus_count = 0
+        self.line.clear()
+
+    def booted(self):
+        self.state = "api" if self.registers["AP"] else "transparent"
+        self.decoder = FrameDecoder(self.registers["AP"] == 2)
+        if self.registers["AP"]:
+            self.send_frame(bytes((MODEM_STATUS, 0x00)))  # hardware reset
+
+    def value(self, name):
+        """Register value as AT mode prints it"""
+        return f"{self.registers[name]:X}"
+
+    def set_register(self, name, value, queued=True):
+        """Validate and store a new value, False if it's out of range"""
+        limits = REGISTERS[name][1]
+        if limits is None or not limits[0] <= value <= limits[1]:
+            return False
+        if queued:
+            self.pending[name] = value
+        else:
+            self.apply({name: value})
+        return True
+
+    def apply(self, changes=None):
+        """Make pending settings take effect"""
+        changes = self.pending if changes is None else changes
+        api_mode = self.registers["AP"]
+        self.registers.update(changes)
+        changes.clear()
+        if self.registers["AP"] != api_mode:
+            self.decoder = FrameDecoder(self.registers["AP"] == 2)
+            if self.state in ("transparent", "api"):
+                self.state = "api" if self.registers["AP"] else "transparent"
+
+    def action(self, name):
+        """Commands that do something rather than read or write a register"""
+        if name in ("CN", "AC"):
+            self.apply()
+            if name == "CN" and self.state == "command":
+                self.state = "api" if self.registers["AP"] else "transparent"
+        elif name == "FR":
+            self.apply()
+            self.boot()
+        elif name in ("%P", "%F"):
+            self.enter_bootloader()
+
+    def command(self, text):
+        """One AT command line, possibly chained, returns (reply lines, actions to run after sending them)"""
+        self.stats["commands"] += 1
+        text = text.strip()
+        if text.upper() == "AT":
+            return ["OK"], []
+        if text[:2].upper() != "AT":
+            return ["ERROR"], []
+        replies = []
+        deferred = []
+        for part in text[2:].split(","):
+            name, parameter = part[:2].upper(), part[2:].strip()
+            if name in ACTIONS and not parameter:
+                replies.append("OK")
+                # After the reply, so OK still goes out at the old rate
+                deferred.append(name)
+            elif name in REGISTERS and not parameter:
+                replies.append(self.value(name))
+            elif name in REGISTERS:
+                try:
+                    ok = self.set_register(name, int(parameter, 16))
+                except ValueError:
+                    ok = False
+                replies.append("OK" if ok else "ERROR")
+            else:
+                replies.append("ERROR")
+        return replies, deferred
+
+    def receive_command(self, data):
+        for byte in data:
+            if byte != ord("\r"):
+                self.line.append(byte)
+                continue
+            replies, deferred = self.command(self.line.decode("ascii", errors="replace"))
+            self.line.clear()
+            self.send("".join(reply + "\r" for reply in replies).encode())
+            for name in deferred:
+                self.action(name)
+                if self.state != "command":
+                    return
+
+    def receive_transparent(self, data, quiet):
+        for byte in data:
+            # +++ only counts after a guard time of silence, and with nothing after it
+            if byte == ord("+") and self.plus_count < 3 and (self.plus_count or quiet >= self.guard_time):
+                self.plus_count += 1
+            else:
+                self.plus_count = 0
+                self.stats["transmitted"] += 1
+            quiet = 0.0
+
+    def receive_api(self, data):
+        for frame in self.decoder.feed(data):
+            self.stats["frames"] += 1
+            if frame[0] not in (AT_COMMAND, AT_COMMAND_QUEUED) or len(frame) < 4:
+                continue
+            frame_id = frame[1]
+            name = frame[2:4].decode("ascii", errors="replace").upper()
+            parameter = frame[4:]
+            value = b""
+            deferred = None
+            if name in ACTIONS:
+                status = 0
+                deferred = name
+            elif name not in REGISTERS:
+                status = 2  # invalid command
+            elif parameter:
+                ok = self.set_register(name, int.from_bytes(parameter, "big"), queued=frame[0] == AT_COMMAND_QUEUED)
+                status = 0 if ok else 3  # invalid parameter
+            else:
+                status = 0
+                value = self.registers[name].to_bytes(REGISTERS[name][0], "big")
+            if frame_id:
+                self.send_frame(bytes((AT_COMMAND_RESPONSE, frame_id)) + name.encode() + bytes((status,)) + value)
+            if deferred:
+                self.action(deferred)
+                if self.state != "api":
+                    return
+
+    def send_frame(self, frame_data):
+        self.send(encode_frame(frame_data, escaped=self.registers["AP"] == 2))
+
+    # - bootloader
+
+    def enter_bootloader(self):
+        self.state = "bootloader"
+        self.send(MENU)
+
+    def start_receive(self):
+        self.state = "receiving"
+        self.image.clear()
+        self.buffer.clear()
+        self.expected = 1
+        self.requests = 0
+        self.next_request = self.clock()
+        self.stats["uploads"] += 1
+
+    def receive_menu(self, data):
+        for index, byte in enumerate(data):
+            if byte == ord("\r"):
+                self.send(MENU)
+            elif byte == ord("1"):
+                self.send(b"\r\n" + BEGIN_UPLOAD + b"\r\n")
+                self.start_receive()
+                self.receive_blocks(data[index + 1:])
+                return
+            elif byte == ord("2"):
+                if not self.application:
+                    # Nothing to run, the bootloader starts over
+                    self.send(MENU)
+                    continue
+                self.boot()
+                return
+            elif byte == ord("3"):
+                self.send(f"\r\nApplication version 0x{self.registers['VR'] or 0:X}\r\n".encode() + MENU)
+
+    def receive_blocks(self, data):
+        if self.raw_upload:
+            # Complete once the stream stops, see tick()
+            self.image += data
+            if data:
+                self.application = False
+            return
+        self.buffer += data
+        while self.buffer and self.state == "receiving":
+            header = self.buffer[0]
+            if header == EOT:
+                del self.buffer[:1]
+                self.send(bytes((ACK,)))
+                self.finish_receive()
+                return
+            if header == CAN:
+                if len(self.buffer) < 2:
+                    return
+                if self.buffer[1] == CAN:
+                    self.abort("cancelled by sender")
+                    return
+            size = {SOH: SMALL_BLOCK, STX: LARGE_BLOCK}.get(header)
+            if size is None:
+                # Not a packet, a receiver that's mid-transfer NAKs it
+                del self.buffer[:1]
+                if self.expected > 1:
+                    self.nak()
+                continue
+            if len(self.buffer) < 3 + size + 2:
+                return
+            packet = bytes(self.buffer[:3 + size + 2])
+            del self.buffer[:3 + size + 2]
+            number, complement, block = packet[1], packet[2], packet[3:3 + size]
+            if number != 255 - complement or binascii.crc_hqx(block, 0) != int.from_bytes(packet[-2:], "big"):
+                self.nak()
+                continue
+            if number == self.expected & 0xFF:
+                # The old application is gone once the first block is written
+                self.application = False
+                self.image += block
+                self.expected += 1
+                self.stats["blocks"] += 1
+            elif number != (self.expected - 1) & 0xFF:
+                # Neither the next block nor a repeat of the last, can't recover
+                self.send(bytes((CAN, CAN)))
+                self.abort(f"block {number} out of sequence")
+                return
+            self.send(bytes((ACK,)))
+
+    def nak(self):
+        self.stats["nak"] += 1
+        self.buffer.clear()
+        self.send(bytes((NAK,)))
+
+    def abort(self, reason):
+        self.stats["aborted"] += 1
+        self.state = "bootloader"
+        self.send(f"\r\nSerial upload aborted\r\n{reason}\r\n".encode() + MENU)
+
+    def finish_receive(self):
+        """Check the received image like the bootloader would before installing it"""
+        info = parse(bytes(self.image))
+        # XMODEM pads the last block, anything after the end tag is padding
+        end = sum(8 + length for _, length in info["tags"])
+        errors = [error for error in info["errors"]
+                  if not (error.endswith("after the end tag") and not self.image[end:].strip(bytes((PAD,))))]
+        if errors:
+            self.abort(errors[0])
+            return
+        if info["version"] is not None:
+            self.registers["VR"] = info["version"]
+        self.application = True
+        self.state = "bootloader"
+        self.send(b"\r\nSerial upload complete\r\n" + MENU)
+
+    # - input
+
+    def receive(self, data):
+        """Bytes from the host, at the radio's UART rate"""
+        now = self.clock()
+        quiet = now - self.last_rx
+        self.last_rx = now
+        if self.state == "transparent":
+            self.receive_transparent(data, quiet)
+        elif self.state == "command":
+            self.receive_command(data)
+        elif self.state == "api":
+            self.receive_api(data)
+        elif self.state == "bootloader":
+            self.receive_menu(data)
+        elif self.state == "receiving":
+            self.receive_blocks(data)
+
+    def receive_garbage(self, data):
+        """Bytes at the wrong rate: no command in them, but they break a guard time"""
+        self.last_rx = self.clock()
+        self.plus_count = 0
+
+    def line_break(self, dtr):
+        """Break on DIN: with DTR low as well, the radio resets into the bootloader"""
+        if not dtr:
+            self.enter_bootloader()
+
+    def tick(self):
+        """Run timers, call every TICK"""
+        now = self.clock()
+        quiet = now - self.last_rx
+        if self.state == "booting" and now >= self.ready_at:
+            self.booted()
+        elif self.state == "transparent" and self.plus_count == 3 and quiet >= self.guard_time:
+            self.plus_count = 0
+            self.state = "command"
+            self.last_rx = now
+            self.send(b"OK\r")
+        elif self.state == "command" and quiet >= self.registers["CT"] / 10:
+            self.apply()
+            self.line.clear()
+            self.state = "api" if self.registers["AP"] else "transparent"
+        elif self.state == "receiving" and self.raw_upload:
+            if self.image and quiet >= BLOCK_TIMEOUT:
+                self.finish_receive()
+        elif self.state == "receiving":
+            if self.expected == 1 and not self.buffer and now >= self.next_request:
+                if self.requests >= CRC_REQUESTS:
+                    self.abort("no data")
+                    return
+                self.requests += 1
+                self.next_request = now + CRC_REQUEST_INTERVAL
+                self.send(bytes((CRC_REQUEST,)))
+            elif self.buffer and quiet >= BLOCK_TIMEOUT:
+                # Half a packet and then nothing, ask for it again
+                self.nak()
+
+
+class Channel:
+    """One direction of the path: network delay, jitter and drops, then the UART's pace
+
+    Data keeps its order like it does over TCP, and is dropped in
+    FIFO-sized chunks like an ESP32 UART overrun.
+    """
+
+    def __init__(self, deliver, latency=0.0, jitter=0.0, drop=0.0, rng=None):
+        self.deliver = deliver
+        self.latency = latency
+        self.jitter = jitter
+        self.drop = drop
+        self.rng = rng or random.Random()
+        self.queue = deque()  # (due, data, baud it was sent at)
+        self.free = 0.0  # when the UART has sent what it already has
+        self.timer = None
+        self.bytes = 0
+        self.dropped = 0
+
+    def send(self, data, baud):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        for start in range(0, len(data), BRIDGE_BURST):
+            chunk = data[start:start + BRIDGE_BURST]
+            if self.drop and self.rng.random() < self.drop:
+                self.dropped += len(chunk)
+                continue
+            arrival = now + self.latency + (self.rng.uniform(0, self.jitter) if self.jitter else 0.0)
+            self.free = max(self.free, arrival) + len(chunk) * BITS_PER_BYTE / baud
+            self.queue.append((self.free, chunk, baud))
+            self.bytes += len(chunk)
+        self.schedule(loop)
+
+    def schedule(self, loop):
+        if self.timer is None and self.queue:
+            self.timer = loop.call_at(self.queue[0][0], self.flush)
+
+    def flush(self):
+        loop = asyncio.get_running_loop()
+        self.timer = None
+        while self.queue and self.queue[0][0] <= loop.time():
+            _, out, baud = self.queue.popleft()
+            while self.queue and self.queue[0][0] <= loop.time() and self.queue[0][2] == baud:
+                out += self.queue.popleft()[1]
+            self.deliver(out, baud)
+        self.schedule(loop)
+
+
+class LinePort:
+    """Serial port as an RFC 2217 PortManager sees it: the host's line settings"""
+
+    def __init__(self, emulator):
+        self.emulator = emulator
+        self.baudrate = emulator.uart_baud or emulator.radio.uart_baud
+        self.bytesize = serial.EIGHTBITS
+        self.parity = serial.PARITY_NONE
+        self.stopbits = serial.STOPBITS_ONE
+        self.xonxoff = False
+        self.rtscts = False
+        self.rts = True
+        self.dtr = True
+        self.cts = self.dsr = True
+        self.ri = self.cd = False
+        self._break = False
+
+    @property
+    def break_condition(self):
+        return self._break
+
+    @break_condition.setter
+    def break_condition(self, value):
+        if value and not self._break:
+            self.emulator.radio.line_break(self.dtr)
+        self._break = value
+
+    def reset_input_buffer(self):
+        pass
+
+    def reset_output_buffer(self):
+        pass
+
+
+class Emulator:
+    """One Radio behind a PTY or a TCP port, with the path in between"""
+
+    def __init__(self, latency=0.0, jitter=0.0, drop=0.0, uart_baud=None, seed=None, **radio):
+        self.rng = random.Random(seed)
+        self.uart_baud = uart_baud
+        self.radio_settings = radio
+        self.radio = None
+        self.to_radio = Channel(self.deliver_to_radio, latency, jitter, drop, self.rng)
+        self.to_host = Channel(self.deliver_to_host, latency, jitter, drop, self.rng)
+        self.client = None
+        self.host_write = None
+        self.host_baud = lambda: self.uart_baud or self.radio.uart_baud
+        self.garbled = 0
+        self.clients = 0
+
+    def start_radio(self):
+        loop = asyncio.get_running_loop()
+        self.radio = Radio(self.radio_output, loop.time, **self.radio_settings)
+        self.tick(loop)
+
+    def tick(self, loop):
+        self.radio.tick()
+        loop.call_later(TICK, self.tick, loop)
+
+    def radio_output(self, data):
+        self.to_host.send(data, self.radio.uart_baud)
+
+    def deliver_to_host(self, data, sent):
+        # The host's rate as the bytes arrive, it may have changed on the way
+        received = self.host_baud()
+        if sent != received:
+            self.garbled += len(data)
+            data = garble(data, sent, received, self.rng)
+        if self.host_write is not None:
+            self.host_write(data)
+
+    def host_input(self, data, baud=None):
+        if data:
+            self.to_radio.send(data, baud or self.host_baud())
+
+    def deliver_to_radio(self, data, sent):
+        received = self.radio.uart_baud
+        if sent != received:
+            self.garbled += len(data)
+            self.radio.receive_garbage(data)
+        else:
+            self.radio.receive(data)
+
+    def status(self):
+        """Counters for the summary"""
+        return dict(self.radio.stats, state=self.radio.state, firmware=self.radio.value("VR"), clients=self.clients,
+                    to_radio=self.to_radio.bytes, to_host=self.to_host.bytes,
+                    dropped=self.to_radio.dropped + self.to_host.dropped, garbled=self.garbled)
+
+    # - TCP
+
+    async def serve_tcp(self, host, port, use_rfc2217=False, started=None):
+        """Serve the radio on host:port until cancelled, one client at a time"""
+        self.start_radio()
+
+        async def handle(reader, writer):
+            sock = writer.get_extra_info("socket")
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.clients += 1
+            # Like the bridge, a new client takes over from the old one
+            if self.client is not None:
+                self.client.close()
+            self.client = writer
+            manager = None
+            if use_rfc2217:
+                line = LinePort(self)
+                manager = rfc2217.PortManager(line, writer)
+                self.host_baud = lambda: line.baudrate
+                self.host_write = lambda data: writer.write(b"".join(manager.escape(data)))
+            else:
+                self.host_write = writer.write
+            try:
+                while True:
+                    data = await reader.read(65536)
+                    if not data:
+                        break
+                    if manager is None:
+                        self.host_input(data)
+                        continue
+                    # filter() applies a baud change when it gets to it, the
+                    # bytes before it still went out at the old rate
+                    run = bytearray()
+                    baud = line.baudrate
+                    for byte in manager.filter(data):
+                        if line.baudrate != baud:
+                            self.host_input(bytes(run), baud)
+                            run.clear()
+                            baud = line.baudrate
+                        run += byte
+                    if run:
+                        self.host_input(bytes(run), baud)
+            except OSError:
+                pass
+            if self.client is writer:
+                self.client = None
+                self.host_write = None
+            writer.close()
+
+        server = await asyncio.start_server(handle, host, port, reuse_address=True)
+        if started:
+            started(server)
+        async with server:
+            await server.serve_forever()
+
+    # - PTY
+
+    async def serve_pty(self, device_path, started=None):
+        """Serve the radio on a PTY linked at device_path until cancelled"""
+        self.start_radio()
+        master_fd, slave_fd = os.openpty()
+        # Held open here, so clients can come and go (see xbee_bridge.py)
+        tty.setraw(slave_fd)
+        os.set_blocking(master_fd, False)
+        if os.path.islink(device_path) or os.path.exists(device_path):
+            os.unlink(device_path)
+        os.symlink(os.ttyname(slave_fd), device_path)
+        loop = asyncio.get_running_loop()
+
+        def host_baud():
+            # Whatever the client set with tcsetattr, custom rates count as a match
+            speed = termios.tcgetattr(slave_fd)[5]
+            return TERMIOS_SPEEDS.get(speed) or self.radio.uart_baud
+
+        def readable():
+            try:
+                data = os.read(master_fd, 65536)
+            except (BlockingIOError, OSError):
+                return
+            self.host_input(data)
+
+        def write(data):
+            try:
+                os.write(master_fd, data)
+            except BlockingIOError:
+                # Nobody reading and the PTY is full, lost like on a real UART
+                self.to_host.dropped += len(data)
+
+        self.host_baud = host_baud
+        self.host_write = write
+        self.clients = 1
+        loop.add_reader(master_fd, readable)
+        if started:
+            started(os.ttyname(slave_fd))
+        try:
+            await asyncio.Event().wait()
+        finally:
+            loop.remove_reader(master_fd)
+            if os.path.islink(device_path):
+                os.unlink(device_path)
+            os.close(master_fd)
+            os.close(slave_fd)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Emulate an XBee3 with Gecko bootloader on a PTY or TCP port")
+    where = parser.add_mutually_exclusive_group(required=True)
+    where.add_argument("--pty", metavar="PATH", help="create a PTY and link it here")
+    where.add_argument("--tcp", metavar="PORT", type=int, help="listen on this TCP port")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--rfc2217", action="store_true", help="speak RFC 2217, the host sets the baud rate")
+    parser.add_argument("--uart-baud", type=int, help="host side rate over plain TCP (default: follows the radio)")
+    parser.add_argument("-b", "--baud", type=int, default=9600, help="radio baud rate (BD)")
+    parser.add_argument("-a", "--api-mode", type=int, choices=(0, 1, 2), default=0, help="AP setting")
+    parser.add_argument("--guard-time", type=float, default=1.0, help="GT in seconds")
+    parser.add_argument("--firmware", type=lambda value: int(value, 16), default=0x1014, help="VR, hex")
+    parser.add_argument("--serial", type=lambda value: int(value, 16),
+                        help="SH/SL as 16 hex digits (default: derived from the PTY path or TCP port)")
+    parser.add_argument("--boot-time", type=float, default=1.0, help="seconds from reset until the radio answers")
+    parser.add_argument("--bootloader", action="store_true", help="start in the bootloader menu")
+    parser.add_argument("--raw-upload", action="store_true", help="bootloader takes a raw image instead of XMODEM")
+    parser.add_argument("--latency", type=float, default=0.0, help="one-way delay in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random extra delay, up to this many seconds")
+    parser.add_argument("--drop", type=float, default=0.0, help="probability of losing each 128-byte chunk")
+    parser.add_argument("--seed", type=int, help="random seed, for repeatable jitter, drops and garbage")
+    args = parser.parse_args()
+
+    if args.serial is None:
+        # Stable per listening address, so emulated radios don't share a cache entry
+        where = args.pty or f"{args.host}:{args.tcp}"
+        args.serial = DIGI_OUI << 32 | binascii.crc32(where.encode())
+
+    emulator = Emulator(args.latency, args.jitter, args.drop, args.uart_baud, args.seed, baud=args.baud,
+                        api_mode=args.api_mode, guard_time=args.guard_time, firmware=args.firmware,
+                        serial_number=args.serial, boot_time=args.boot_time, bootloader=args.bootloader,
+                        raw_upload=args.raw_upload)
+    print("XBee Emulator")
+    print(f"Radio: {args.baud} baud, AP={args.api_mode}, firmware {args.firmware:X}, serial {args.serial:016X}"
+          f"{', in the bootloader' if args.bootloader else ''}")
+    if args.latency or args.jitter or args.drop:
+        print(f"Path: {args.latency * 1000:.0f}ms latency, {args.jitter * 1000:.0f}ms jitter, {args.drop:.1%} drops")
+
+    if args.pty:
+        serve = emulator.serve_pty(args.pty, lambda name: print(f"✓ {args.pty} -> {name}"))
+    else:
+        scheme = "rfc2217" if args.rfc2217 else "socket"
+        serve = emulator.serve_tcp(args.host, args.tcp, args.rfc2217,
+                                   lambda server: print(f"✓ Listening on {scheme}://{args.host}:{args.tcp}"))
+    try:
+        asyncio.run(run_until_stopped(serve))
+    except KeyboardInterrupt:
+        print("\nStopping...")
+    except OSError as e:
+        print(f"✗ {e}")
+        sys.exit(1)
+    if emulator.radio is not None:
+        print(" ".join(f"{key}={value}" for key, value in emulator.status().items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+XBee Expect - Wait for known replies instead of sleeping a fixed time
+
+Reads incrementally and returns as soon as one of the patterns shows up, or
+when the deadline passes. Works on any pyserial port, local or over the bridge.
+Bytes after a match stay buffered for the next call.
+
+Open the port with timeout=POLL_INTERVAL. The reader never changes the port
+timeout itself, over rfc2217:// every change renegotiates the line settings.
+"""
+
+import time
+
+OK = b"OK\r"
+ERROR = b"ERROR\r"
+BL_PROMPT = b"BL >"
+GECKO_BANNER = b"Gecko Bootloader"
+
+AT_REPLY = (OK, ERROR)
+BOOTLOADER = (BL_PROMPT, GECKO_BANNER)
+
+GUARD_TIME = 1.0  # XBee GT default, 0x3E8 ms
+GUARD_MARGIN = 0.1
+POLL_INTERVAL = 0.05
+
+
+class Expect:
+    """Pattern-driven reader on top of a pyserial port"""
+
+    def __init__(self, ser):
+        self.serial = ser
+        self.buffer = bytearray()
+        self.last_write = 0.0
+
+    def write(self, data):
+        """Write and remember when, for the command mode guard time"""
+        self.serial.write(data)
+        self.last_write = time.monotonic()
+
+    def discard(self):
+        """Drop everything received so far"""
+        self.serial.reset_input_buffer()
+        self.buffer.clear()
+
+    def fill(self, deadline):
+        """Read whatever arrives before the deadline, False if nothing did"""
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        # Returns at once with what is queued, or waits up to the port timeout
+        self.buffer += self.serial.read(max(1, self.serial.in_waiting))
+        return True
+
+    def expect(self, patterns, timeout=1.0):
+        """Wait for any of patterns, returns (pattern, data up to and including it)
+
+        On timeout returns (None, everything received), so callers can still
+        report what the device said.
+        """
+        if isinstance(patterns, bytes):
+            patterns = (patterns,)
+        deadline = time.monotonic() + timeout
+        while True:
+            found = None
+            for pattern in patterns:
+                index = self.buffer.find(pattern)
+                if index >= 0 and (found is None or index < found[1]):
+                    found = (pattern, index)
+            if found is not None:
+                end = found[1] + len(found[0])
+                data = bytes(self.buffer[:end])
+                del self.buffer[:end]
+                return found[0], data
+            if not self.fill(deadline):
+                data = bytes(self.buffer)
+                self.buffer.clear()
+                return None, data
+
+    def read(self, size, timeout=1.0):
+        """Read up to size bytes, buffered data first (for XMODEM getc)"""
+        deadline = time.monotonic() + timeout
+        while len(self.buffer) < size and self.fill(deadline):
+            pass
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def read_some(self, timeout=1.0):
+        """Whatever is buffered, or the first bytes to arrive before the timeout"""
+        if not self.buffer:
+            self.fill(time.monotonic() + timeout)
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+    def read_line(self, timeout=1.0):
+        """One CR terminated reply, decoded and stripped, or None on timeout"""
+        pattern, data = self.expect(b"\r", timeout)
+        if pattern is None:
+            return None
+        return data.decode("utf-8", errors="ignore").strip()
+
+    def command_mode(self, guard_time=GUARD_TIME):
+        """Enter AT command mode with +++, only waiting out the guard time still needed"""
+        quiet = self.last_write + guard_time + GUARD_MARGIN - time.monotonic()
+        if quiet > 0:
+            time.sleep(quiet)
+        self.discard()
+        self.write(b"+++")
+        # OK comes once the trailing guard time has passed
+        pattern, data = self.expect(AT_REPLY, guard_time + 1.0)
+        return pattern == OK, data
+
+    def at(self, command, timeout=1.0):
+        """Send one AT command, returns the reply line or None"""
+        self.write(f"AT{command}\r".encode())
+        return self.read_line(timeout)
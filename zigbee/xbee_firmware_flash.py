@@ -4,222 +4,217 @@ XBee Bootloader Invoke - Use %P command to enter bootloader
 """
 
 import serial
-import time
 import sys
 import os
+import time
+
+from xbee_api import ApiClient
+from xbee_at import describe
+from xbee_autobaud import autobaud, probe, rank_candidates
+from xbee_cache import LinkCache, remember_radio
+from xbee_expect import BL_PROMPT, GUARD_TIME
+from xbee_gbl import approve
+from xbee_stream import stream_file
+from xbee_transport import DEFAULT_TARGET, XBeeLink
+from xbee_verify import finish_upload, run_firmware, verify_firmware
+from xbee_xmodem import FlashJournal, XmodemError, XmodemSender, locate, start_upload, upload
 
-def invoke_bootloader_with_percent_p(device_path="/tmp/ttyXBEE"):
+BOOTLOADER_BAUD = 115200  # Gecko bootloader, whatever BD is set to
+BOOTLOADER_TIMEOUT = 3.0
+
+def enter_bootloader(link, mode=None, api_mode=1, guard_time=GUARD_TIME):
+    """Send %P at the current rate the way the radio listens, True once the bootloader answers
+    
+    mode is what probe() found: "api" sends a Local AT Command frame (escaped
+    for AP=2), "at_mode" means command mode is already open, anything else
+    enters it with +++ first. The Gecko bootloader always runs at 115200, the
+    link follows it as soon as the radio has taken %P.
+    """
+    console = link.console
+    if mode == "api":
+        print(f"  Sending %P as an API frame (AP={api_mode})...")
+        client = ApiClient(console, escaped=api_mode == 2)
+        frame_ids = client.send([("%P", b"")])
+        _, status, _ = client.wait(frame_ids).get(frame_ids[0], (None, None, None))
+        print(f"  %P status: {status}")
+        if status != 0:
+            return False
+    else:
+        if mode != "at_mode":
+            entered, at_response = console.command_mode(guard_time)
+            print(f"  AT response: {repr(at_response.decode('utf-8', errors='ignore'))}")
+            if not entered:
+                print("  No AT response")
+                return False
+        response = console.at("%P")
+        print(f"  AT%P Response: {repr(response)}")
+        if response != "OK":
+            return False
+    
+    print(f"  Switching to bootloader at {BOOTLOADER_BAUD} baud...")
+    link.set_baud(BOOTLOADER_BAUD)
+    # The radio resets first, keep asking for the menu until it shows up
+    deadline = time.monotonic() + BOOTLOADER_TIMEOUT
+    while time.monotonic() < deadline:
+        console.write(b'\r')
+        pattern, bl_response = console.expect(BL_PROMPT, 0.5)
+        if pattern is not None:
+            print(f"  Bootloader prompt: {repr(bl_response.decode('utf-8', errors='ignore')[-40:])}")
+            return True
+    print("  No bootloader menu")
+    return False
+
+def invoke_bootloader_with_percent_p(link):
     """Try to invoke bootloader using %P command"""
     
     print("Attempting to invoke bootloader with %P command...")
     
-    # Try at different baud rates since we don't know current XBee baud
+    # Cached settings first, then short probes at every rate, +++ only after
+    cache = LinkCache()
+    entry = cache.lookup(link.target) or {}
+    guard_time = entry.get("guard_time", GUARD_TIME)
     baud_rates = [115200, 9600, 38400, 19200]
+    result = autobaud(link, rank_candidates([entry.get("baud")]), cache=cache)
+    if result is None:
+        print("  No answer at any baud rate")
+        return False
+    print(f"  Radio answered at {result.baud} baud ({result.mode}) after {result.elapsed:.1f}s")
+    if result.mode == "bootloader":
+        print("  ✓ Bootloader already running")
+        link.set_baud(BOOTLOADER_BAUD)
+        return True
+    if enter_bootloader(link, result.mode, result.api_mode, guard_time):
+        print(f"  ✓ BOOTLOADER ACTIVATED via %P at {result.baud} baud!")
+        return True
     
-    for i, baud in enumerate(baud_rates):
+    # Whatever autobaud found didn't take %P, start over from the list
+    cache.invalidate(link.target)
+    for baud in baud_rates:
         print(f"\nTrying %P at {baud} baud...")
         
-        # Wait for socat to reconnect after previous attempt
-        if i > 0:
-            print("  Waiting for socat to reconnect...")
-            time.sleep(8)  # Wait for socat reconnection
-            
-            # Wait for device to appear
-            timeout = 15
-            start_time = time.time()
-            while not os.path.exists(device_path) and (time.time() - start_time) < timeout:
-                time.sleep(1)
-                print("  .", end="", flush=True)
-            
-            if not os.path.exists(device_path):
-                print(f"\n  ✗ Device {device_path} not available")
-                continue
-            
-            print("\n  ✓ Device ready")
-        
         try:
-            ser = serial.Serial(device_path, baud, timeout=5)
-            time.sleep(3)  # Longer initial delay
-            
-            # Clear buffers
-            ser.flushInput()
-            ser.flushOutput()
-            
-            # Send %P command directly (no AT mode needed)
-            print("  Sending %P command...")
-            ser.write(b'%P\r')
-            time.sleep(3)
+            link.set_baud(baud)
             
-            # Check for bootloader response
-            response = ser.read(2000).decode('utf-8', errors='ignore')
-            print(f"  Response: {repr(response[:200])}")
-            
-            if "Gecko Bootloader" in response or "BL >" in response:
-                print(f"  ✓ BOOTLOADER ACTIVATED at {baud} baud!")
-                
-                # Set baud rate to 115200 for bootloader communication
-                ser.close()
-                
-                print("  Connecting to bootloader at 115200 baud...")
-                time.sleep(2)
-                
-                bootloader_ser = serial.Serial(device_path, 115200, timeout=5)
-                time.sleep(2)
-                
-                # Send carriage return to get prompt
-                bootloader_ser.write(b'\r')
-                time.sleep(1)
-                
-                bl_response = bootloader_ser.read(1000).decode('utf-8', errors='ignore')
-                print(f"  Bootloader prompt: {repr(bl_response)}")
-                
-                bootloader_ser.close()
+            # One short probe tells how the radio listens at this rate
+            mode, api_mode = probe(link.console)
+            if mode == "bootloader":
+                print(f"  ✓ Bootloader already running at {baud} baud")
+                link.set_baud(BOOTLOADER_BAUD)
                 return True
             
-            # Also try AT mode + %P
-            print("  Trying AT mode + %P...")
-            time.sleep(1.5)
-            ser.write(b'+++')
-            time.sleep(1.5)
-            
-            at_response = ser.read(100).decode('utf-8', errors='ignore')
-            print(f"  AT response: {repr(at_response)}")
-            
-            if 'OK' in at_response:
-                print("  AT mode entered, sending AT%P...")
-                ser.write(b'AT%P\r')
-                time.sleep(3)
-                
-                response = ser.read(2000).decode('utf-8', errors='ignore')
-                print(f"  AT%P Response: {repr(response[:200])}")
-                
-                if "Gecko Bootloader" in response or "BL >" in response:
-                    print(f"  ✓ BOOTLOADER ACTIVATED via AT%P at {baud} baud!")
-                    ser.close()
-                    return True
-            else:
-                print("  No AT response")
-            
-            ser.close()
+            if enter_bootloader(link, mode, api_mode, guard_time):
+                print(f"  ✓ BOOTLOADER ACTIVATED via %P at {baud} baud!")
+                return True
             
         except Exception as e:
             print(f"  Error at {baud}: {e}")
     
     return False
 
-def upload_firmware_xmodem(firmware_path, device_path="/tmp/ttyXBEE"):
+def upload_firmware_xmodem(firmware_path, link):
     """Upload firmware using proper XMODEM protocol"""
     
     if not os.path.exists(firmware_path):
         print(f"✗ Firmware file not found: {firmware_path}")
         return False
     
-    try:
-        # Try to import xmodem library
-        from xmodem import XMODEM
-        print("✓ Using xmodem library")
-    except ImportError:
-        print("⚠ xmodem library not available, trying manual upload...")
-        return manual_firmware_upload(firmware_path, device_path)
+    with open(firmware_path, 'rb') as f:
+        firmware_data = f.read()
+    journal = FlashJournal(link.target, firmware_data)
     
     try:
         print("Connecting to bootloader...")
-        ser = serial.Serial(device_path, 115200, timeout=30)
-        time.sleep(2)
+        link.set_baud(115200)
+        console = link.console
+        
+        entry = journal.load()
+        if entry:
+            # A previous run was cut off, carry on without probing or %P
+            print(f"Interrupted upload found at block {entry['number']}, looking for the bootloader...")
+            state = locate(console)
+            if state is None:
+                journal.clear()
+                print("✗ Bootloader not found, run again to start over")
+                return False
+            print(f"Bootloader: {state}")
+        else:
+            # Get bootloader prompt
+            console.write(b'\r')
+            _, response = console.expect(BL_PROMPT, 1)
+            response = response.decode('utf-8', errors='ignore')
+            print(f"Bootloader: {response}")
+            
+            if "BL >" not in response and "Gecko Bootloader" not in response:
+                print("✗ Not in bootloader mode")
+                return False
+            LinkCache().remember(link.target, baud=115200, mode="bootloader")
+            
+            # Send '1' to start upload
+            print("Starting firmware upload...")
+            if not start_upload(console):
+                print("✗ Bootloader did not start the upload")
+                return False
+            state = "start"
         
-        # Get bootloader prompt
-        ser.write(b'\r')
-        time.sleep(1)
-        response = ser.read(1000).decode('utf-8', errors='ignore')
-        print(f"Bootloader: {response}")
+        # Anything the bootloader sent after "begin upload" is still in the
+        # console buffer, where the sender looks for the first 'C'
+        print("Starting XMODEM transfer...")
+        sender = XmodemSender(console, journal=journal)
+        try:
+            upload(link, sender, firmware_data, state)
+        except XmodemError as e:
+            if sender.blocks == 0 and state == "start":
+                print(f"⚠ XMODEM not accepted ({e}), trying manual upload...")
+                return manual_firmware_upload(firmware_path, link)
+            print(f"✗ XMODEM transfer failed: {e}")
+            return False
+        # The connection may have been reopened during the upload
+        console = link.console
+        
+        print("✓ XMODEM transfer completed!")
+        print(f"  {sender.summary()}")
         
-        if "BL >" not in response and "Gecko Bootloader" not in response:
-            print("✗ Not in bootloader mode")
+        # Completion message and the menu after it, as soon as they arrive
+        completed, response = finish_upload(console)
+        print(f"Upload result: {response}")
+        if not completed:
+            print("✗ Bootloader did not accept the image")
             return False
         
-        # Send '1' to start upload
-        print("Starting firmware upload...")
-        ser.write(b'1')
-        time.sleep(2)
+        # Send '2' to run firmware
+        print("Running new firmware...")
+        run_firmware(console)
         
-        # Open firmware file
-        with open(firmware_path, 'rb') as f:
-            # Setup XMODEM
-            def getc(size, timeout=10):
-                return ser.read(size) or None
-            
-            def putc(data, timeout=10):
-                return ser.write(data)
-            
-            modem = XMODEM(getc, putc)
-            
-            print("Starting XMODEM transfer...")
-            success = modem.send(f)
-            
-            if success:
-                print("✓ XMODEM transfer completed!")
-                
-                # Wait for completion message
-                time.sleep(5)
-                response = ser.read(1000).decode('utf-8', errors='ignore')
-                print(f"Upload result: {response}")
-                
-                # Send '2' to run firmware
-                print("Running new firmware...")
-                ser.write(b'2')
-                time.sleep(5)
-                
-                ser.close()
-                return True
-            else:
-                print("✗ XMODEM transfer failed")
-                ser.close()
-                return False
+        return True
                 
     except Exception as e:
         print(f"✗ XMODEM upload failed: {e}")
         return False
 
-def manual_firmware_upload(firmware_path, device_path="/tmp/ttyXBEE"):
+def manual_firmware_upload(firmware_path, link):
     """Manual firmware upload without xmodem library"""
     
     print("Attempting manual firmware upload...")
     print("⚠ This is less reliable than proper XMODEM")
     
-    # Use our previous gentle upload method
+    # Raw stream, paced to what the UART behind the link can take
     try:
-        ser = serial.Serial(device_path, 115200, timeout=10)
-        time.sleep(2)
-        
-        # Send '1' to bootloader
-        ser.write(b'1')
-        time.sleep(3)
+        link.set_baud(115200)
+        console = link.console
         
-        # Read firmware and upload
-        with open(firmware_path, 'rb') as f:
-            firmware_data = f.read()
-        
-        print(f"Uploading {len(firmware_data)} bytes...")
-        
-        # Upload in chunks
-        chunk_size = 128
-        for i in range(0, len(firmware_data), chunk_size):
-            chunk = firmware_data[i:i+chunk_size]
-            ser.write(chunk)
-            time.sleep(0.01)
-            
-            if i % (chunk_size * 50) == 0:
-                progress = 100 * i // len(firmware_data)
-                print(f"  Progress: {progress}%")
+        print(f"Uploading {os.path.getsize(firmware_path)} bytes...")
+        writer = stream_file(link.serial, firmware_path, remote=link.remote)
+        print(f"  {writer.summary()}")
         
         print("Upload completed, waiting for processing...")
-        time.sleep(10)
+        completed, response = finish_upload(console)
+        if not completed:
+            print(f"✗ Bootloader did not accept the image: {repr(response)}")
+            return False
         
         # Send '2' to run
-        ser.write(b'2')
-        time.sleep(5)
+        run_firmware(console)
         
-        ser.close()
         return True
         
     except Exception as e:
@@ -227,47 +222,106 @@ def manual_firmware_upload(firmware_path, device_path="/tmp/ttyXBEE"):
         return False
 
 def main():
-    device_path = "/tmp/ttyXBEE"
-    
-    if len(sys.argv) != 2:
-        print("Usage: python xbee_bootloader_invoke.py <firmware.gbl>")
+    args = [arg for arg in sys.argv[1:] if arg != "--force"]
+    force = len(args) < len(sys.argv) - 1
+    if len(args) not in (1, 2):
+        print("Usage: python xbee_firmware_flash.py <firmware.gbl> [device or URL] [--force]")
         sys.exit(1)
     
-    firmware_path = sys.argv[1]
+    firmware_path = args[0]
+    target = args[1] if len(args) == 2 else DEFAULT_TARGET
     
     print("XBee Bootloader Invoke & Flash")
     print("==============================")
     print(f"Firmware: {firmware_path}")
+    print(f"Target: {target}")
+    
+    # A broken or wrong image is turned away before the radio is touched
+    image = approve(firmware_path, target, force)
+    if image is None:
+        sys.exit(1)
     print()
     
-    # Step 1: Try to invoke bootloader
-    if not invoke_bootloader_with_percent_p(device_path):
+    try:
+        link = XBeeLink(target, 115200).open()
+    except serial.SerialException as e:
+        print(f"✗ Could not open {target}: {e}")
+        sys.exit(1)
+    
+    with link:
+        result = flash(firmware_path, link, image)
+    sys.exit(0 if result else 1)
+
+def resume_pending(firmware_path, link):
+    """True if an upload of this firmware to this target was cut off"""
+    if not os.path.exists(firmware_path):
+        return False
+    with open(firmware_path, 'rb') as f:
+        return FlashJournal(link.target, f.read()).load() is not None
+
+def flash(firmware_path, link, image=None):
+    """Invoke the bootloader and upload firmware over an open XBeeLink, image is its xbee_gbl info
+
+    Returns the xbee_verify.VerifyResult once the new firmware answers, None otherwise.
+    """
+    
+    # The firmware comes back at the rate it ran at before, remember it
+    # before the upload marks the target as being in the bootloader
+    cache = LinkCache()
+    entry = cache.lookup(link.target)
+    before = entry if entry and entry.get("mode") != "bootloader" else {}
+    
+    # Step 1: Try to invoke bootloader, unless an interrupted upload says it's already there
+    if resume_pending(firmware_path, link):
+        print("Resuming interrupted upload, bootloader already running")
+    elif not invoke_bootloader_with_percent_p(link):
         print("✗ Could not invoke bootloader")
         print("\nTroubleshooting:")
         print("1. Check if XBee has any working firmware")
         print("2. Try hardware reset method with DTR/RTS lines")
         print("3. Consider direct USB-serial connection")
-        return
+        return None
+    else:
+        # Autobaud has just stored the rate the radio answered at
+        entry = cache.lookup(link.target)
+        if entry and entry.get("mode") != "bootloader":
+            before = entry
     
     print("\n" + "="*50)
     print("BOOTLOADER READY - Starting firmware upload...")
     print("="*50)
     
     # Step 2: Upload firmware
-    success = upload_firmware_xmodem(firmware_path, device_path)
+    success = upload_firmware_xmodem(firmware_path, link)
     
     if success:
         print("\n✓ Firmware flash completed successfully!")
-        print("Testing XBee in 10 seconds...")
-        
-        time.sleep(10)
+        print("Waiting for the new firmware to answer...")
         
-        # Test XBee
-        import subprocess
-        subprocess.run(["python3", "xbee_at_test.py", "-b", "115200"])
+        # Test XBee on the same connection, a second one would only get
+        # a read-only monitor slot on the bridge
+        result = verify_firmware(link, rank_candidates([before.get("baud")], [115200, 9600]),
+                                 guard_time=before.get("guard_time", GUARD_TIME))
+        if result is None:
+            print("⚠ XBee not responding after firmware flash")
+            cache.invalidate(link.target)
+        elif result.mode == "bootloader":
+            print("✗ Firmware did not start, the bootloader is back")
+            return None
+        else:
+            firmware = describe("VR", result.info["VR"])
+            print(f"✓ Firmware {firmware} answering at {result.baud} baud ({result.mode}) "
+                  f"after {result.elapsed:.1f}s")
+            if before.get("firmware") is not None:
+                print(f"  Was {describe('VR', before['firmware'])}")
+            remember_radio(cache, link.target, result.baud, result.mode, result.info)
+            if image and image["product"]:
+                cache.remember(link.target, product=image["product"])
+        return result
         
     else:
         print("\n✗ Firmware flash failed")
+        return None
 
 if __name__ == "__main__":
     main()
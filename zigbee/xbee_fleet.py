@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+XBee Fleet Flash - Roll one firmware image out to many bridges at once
+
+Every device gets its own xbee_firmware_flash.py run (bootloader entry,
+upload, verification), up to --jobs at a time, each with its own deadline.
+A device that runs out of time is killed; its upload journal stays, so the
+next rollout resumes it. A rollout takes about as long as the slowest device.
+
+    python3 xbee_fleet.py XB3-24Z/XB3-24Z_1014-th.gbl -i bridges.txt -j 8
+    python3 xbee_fleet.py firmware.gbl rfc2217://10.0.0.5:8888 rfc2217://10.0.0.6:8888
+
+The inventory file lists one target (device path or bridge URL) per line,
+# starts a comment.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+import time
+from collections import namedtuple
+
+from xbee_at import describe
+from xbee_cache import LinkCache
+from xbee_gbl import approve
+
+FLASH_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "xbee_firmware_flash.py")
+DEFAULT_JOBS = 4
+DEFAULT_DEADLINE = 600.0
+# Lines worth showing live, the rest goes to the per-device log
+STATUS_MARKS = ("✓", "✗", "⚠")
+
+DeviceResult = namedtuple("DeviceResult", ["target", "status", "elapsed", "firmware", "detail"])
+
+
+def read_inventory(path):
+    """Targets from an inventory file, one per line"""
+    targets = []
+    with open(path) as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if line:
+                targets.append(line)
+    return targets
+
+
+def log_name(target):
+    """File name for a target's log"""
+    return re.sub(r"[^A-Za-z0-9.]+", "_", target).strip("_") + ".log"
+
+
+async def flash_device(target, firmware_path, semaphore, deadline, force=False, log_dir=None):
+    """Flash one device in its own process, returns a DeviceResult"""
+    async with semaphore:
+        start = time.monotonic()
+        print(f"[{target}] started")
+        command = [sys.executable, FLASH_SCRIPT, firmware_path, target] + (["--force"] if force else [])
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            env=dict(os.environ, PYTHONUNBUFFERED="1"),
+            # Progress updates pile up on one \r separated line
+            limit=1 << 20,
+        )
+        output = []
+
+        async def follow():
+            async for raw in process.stdout:
+                # Progress lines end in \r, keep only what's left after the last one
+                line = raw.decode("utf-8", errors="replace").rstrip("\n").split("\r")[-1].rstrip()
+                output.append(line)
+                if line.lstrip().startswith(STATUS_MARKS):
+                    print(f"[{target}] {line.strip()}")
+            await process.wait()
+
+        status = None
+        try:
+            await asyncio.wait_for(follow(), deadline)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            status = "timeout"
+        elapsed = time.monotonic() - start
+
+        if log_dir:
+            with open(os.path.join(log_dir, log_name(target)), "w") as f:
+                f.write("\n".join(output) + "\n")
+
+        if status is None:
+            status = "ok" if process.returncode == 0 else "failed"
+        firmware = None
+        if status == "ok":
+            entry = LinkCache().lookup(target)
+            if entry and entry.get("firmware") is not None:
+                firmware = describe("VR", entry["firmware"])
+        # Last verdict the flash printed explains a failure best
+        verdicts = [line.strip() for line in output if line.lstrip().startswith(STATUS_MARKS)]
+        detail = verdicts[-1] if verdicts else (output[-1].strip() if output else "")
+        if status == "timeout":
+            detail = f"no result after {deadline:g}s, last: {detail}"
+        mark = "✓" if status == "ok" else "✗"
+        print(f"[{target}] {mark} {status} in {elapsed:.1f}s")
+        return DeviceResult(target, status, elapsed, firmware, detail)
+
+
+async def rollout(targets, firmware_path, jobs=DEFAULT_JOBS, deadline=DEFAULT_DEADLINE, force=False, log_dir=None):
+    """Flash all targets, at most jobs at a time, returns their DeviceResults in order"""
+    semaphore = asyncio.Semaphore(jobs)
+    return await asyncio.gather(*(
+        flash_device(target, firmware_path, semaphore, deadline, force, log_dir) for target in targets
+    ))
+
+
+def print_summary(results, elapsed):
+    """Table of results, one line per device"""
+    width = max(len(result.target) for result in results)
+    print()
+    print("Summary")
+    print("=======")
+    for result in results:
+        firmware = result.firmware or "-"
+        print(f"  {result.target:<{width}}  {result.status:<7}  {result.elapsed:6.1f}s  {firmware:<6}  {result.detail}")
+    ok = sum(result.status == "ok" for result in results)
+    slowest = max(result.elapsed for result in results)
+    print(f"\n{ok}/{len(results)} flashed in {elapsed:.1f}s (slowest device {slowest:.1f}s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Flash a GBL image to many XBees in parallel")
+    parser.add_argument("firmware", help="GBL image")
+    parser.add_argument("targets", nargs="*", help="device paths or bridge URLs")
+    parser.add_argument("-i", "--inventory", help="file with one target per line")
+    parser.add_argument("-j", "--jobs", type=int, default=DEFAULT_JOBS, help="devices flashed at the same time")
+    parser.add_argument("--deadline", type=float, default=DEFAULT_DEADLINE, help="seconds allowed per device")
+    parser.add_argument("--log-dir", help="keep each device's full output here")
+    parser.add_argument("--json", help="write the summary to this file")
+    parser.add_argument("--force", action="store_true", help="flash even if the image doesn't match a radio")
+    args = parser.parse_args()
+
+    targets = list(args.targets)
+    if args.inventory:
+        targets += read_inventory(args.inventory)
+    targets = list(dict.fromkeys(targets))
+    if not targets:
+        parser.error("no targets, pass them as arguments or with --inventory")
+
+    print("XBee Fleet Flash")
+    print("================")
+    print(f"Firmware: {args.firmware}")
+    print(f"Devices: {len(targets)}, {args.jobs} at a time, {args.deadline:.0f}s each")
+    # Checked once here, every device run checks it against its radio again
+    if approve(args.firmware, force=args.force) is None:
+        sys.exit(1)
+    print()
+
+    if args.log_dir:
+        os.makedirs(args.log_dir, exist_ok=True)
+    start = time.monotonic()
+    results = asyncio.run(rollout(targets, args.firmware, args.jobs, args.deadline, args.force, args.log_dir))
+    print_summary(results, time.monotonic() - start)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump([result._asdict() for result in results], f, indent=1, ensure_ascii=False)
+    sys.exit(0 if all(result.status == "ok" for result in results) else 1)
+
+
+if __name__ == "__main__":
+    main()
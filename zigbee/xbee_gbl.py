@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+XBee GBL - Parse and validate Gecko Bootloader images before flashing
+
+A .gbl file is a sequence of tags: 32-bit tag ID, 32-bit length, data, all
+little endian. It starts with the header tag and ends with the end tag,
+whose CRC32 covers every byte before it. The application tag carries the
+product ID and version the image is built for.
+
+Results are indexed by SHA-256 of the content, so checking the same image
+again only costs the hash:
+    python3 xbee_gbl.py XB3-24Z/XB3-24Z_1014-th.gbl
+"""
+
+import hashlib
+import json
+import os
+import struct
+import sys
+import time
+import zlib
+
+from xbee_cache import CACHE_DIR, LinkCache, file_lock, write_json
+from xbee_stream import map_file
+
+TAG_HEADER = 0x03A617EB
+TAG_BOOTLOADER = 0xF50909F5
+TAG_APPLICATION = 0xF40A0AF4
+TAG_METADATA = 0xF60808F6
+TAG_PROG = 0xFE0101FE
+TAG_ERASEPROG = 0xFD0303FD
+TAG_PROG_LZ4 = 0xFD0505FD
+TAG_PROG_LZMA = 0xFD0707FD
+TAG_SE_UPGRADE = 0x5EA617EB
+TAG_SIGNATURE = 0xF70A0AF7
+TAG_CERTIFICATE = 0xF30B0BF3
+TAG_END = 0xFC0404FC
+
+TAG_NAMES = {
+    TAG_HEADER: "header",
+    TAG_BOOTLOADER: "bootloader",
+    TAG_APPLICATION: "application",
+    TAG_METADATA: "metadata",
+    TAG_PROG: "prog",
+    TAG_ERASEPROG: "eraseprog",
+    TAG_PROG_LZ4: "prog_lz4",
+    TAG_PROG_LZMA: "prog_lzma",
+    TAG_SE_UPGRADE: "se_upgrade",
+    TAG_SIGNATURE: "signature",
+    TAG_CERTIFICATE: "certificate",
+    TAG_END: "end",
+}
+PROG_TAGS = (TAG_PROG, TAG_ERASEPROG, TAG_PROG_LZ4, TAG_PROG_LZMA)
+
+HEADER_MAJOR = 3
+TYPE_ENCRYPTED = 0x00000001
+TYPE_SIGNED = 0x00000100
+
+APPLICATION_TYPES = {
+    0x01: "zigbee",
+    0x02: "thread",
+    0x04: "flex",
+    0x08: "bluetooth",
+    0x10: "mcu",
+    0x20: "bluetooth_app",
+    0x40: "bootloader",
+}
+
+DEFAULT_INDEX = os.path.join(CACHE_DIR, "gbl.json")
+MAX_ENTRIES = 64
+
+
+def parse(data):
+    """Walk the tags of a GBL image (bytes or mmap), returns a JSON friendly dict"""
+    view = memoryview(data)
+    info = {
+        "size": len(view),
+        "tags": [],
+        "product": None,
+        "version": None,
+        "app_types": [],
+        "encrypted": False,
+        "signed": False,
+        "prog_bytes": 0,
+        "errors": [],
+    }
+    errors = info["errors"]
+    pos = 0
+    ended = False
+    try:
+        while pos + 8 <= len(view):
+            tag, length = struct.unpack_from("<II", view, pos)
+            name = TAG_NAMES.get(tag, f"0x{tag:08X}")
+            body = pos + 8
+            if pos == 0 and tag != TAG_HEADER:
+                errors.append("not a GBL file (no header tag)")
+                break
+            if body + length > len(view):
+                errors.append(f"{name} tag at {pos} runs past the end of the file")
+                break
+            info["tags"].append([name, length])
+
+            if tag == TAG_HEADER and length >= 8:
+                version, image_type = struct.unpack_from("<II", view, body)
+                if version >> 24 != HEADER_MAJOR:
+                    errors.append(f"unsupported GBL version 0x{version:08X}")
+                info["encrypted"] = bool(image_type & TYPE_ENCRYPTED)
+                info["signed"] = bool(image_type & TYPE_SIGNED)
+            elif tag == TAG_APPLICATION and length >= 28:
+                app_type, version, _capabilities = struct.unpack_from("<III", view, body)
+                info["version"] = version
+                info["product"] = bytes(view[body + 12:body + 28]).hex()
+                info["app_types"] = [name for bit, name in APPLICATION_TYPES.items() if app_type & bit]
+            elif tag in PROG_TAGS and length >= 4:
+                info["prog_bytes"] += length - 4
+            elif tag == TAG_END and length >= 4:
+                stored, = struct.unpack_from("<I", view, body)
+                # Everything up to and including the end tag's ID and length
+                computed = zlib.crc32(view[:body])
+                if stored != computed:
+                    errors.append(f"CRC mismatch (file 0x{stored:08X}, computed 0x{computed:08X})")
+                ended = True
+                pos = body + length
+                break
+            pos = body + length
+    finally:
+        view.release()
+
+    if errors:
+        return info
+    if not ended:
+        errors.append("no end tag, file is truncated")
+    elif pos < info["size"]:
+        errors.append(f"{info['size'] - pos} bytes after the end tag")
+    if not info["encrypted"] and not info["prog_bytes"] and "bootloader" not in dict(info["tags"]):
+        errors.append("no programming data")
+    return info
+
+
+class GblIndex:
+    """Parse results keyed by content hash, in a JSON file next to the link cache"""
+
+    def __init__(self, path=DEFAULT_INDEX):
+        self.path = path
+
+    def load(self):
+        """Whole index as {sha256: info}"""
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def inspect(self, firmware_path):
+        """Info for a file, parsed only the first time its content is seen"""
+        with map_file(firmware_path) as image, file_lock(self.path):
+            digest = hashlib.sha256(image).hexdigest()
+            index = self.load()
+            info = index.get(digest)
+            if info is None:
+                info = parse(image)
+                info["sha256"] = digest
+            info["checked"] = time.time()
+            index[digest] = info
+            # Oldest checks go first once the index is full
+            for stale in sorted(index, key=lambda key: index[key].get("checked", 0))[:-MAX_ENTRIES]:
+                del index[stale]
+            write_json(self.path, index)
+        return info
+
+
+def describe(info):
+    """One line summary of an image"""
+    version = f"0x{info['version']:X}" if info["version"] is not None else "unknown"
+    flags = [flag for flag in ("encrypted", "signed") if info[flag]]
+    return (f"{'/'.join(info['app_types']) or 'image'} version {version}, product {info['product'] or 'unknown'}, "
+            f"{info['prog_bytes']} bytes of flash data{', ' + ', '.join(flags) if flags else ''}")
+
+
+def check_image(firmware_path, target=None, cache=None):
+    """Validate an image and match it against the radio last seen on target
+
+    Returns (info, problems), an empty problems list means it's fine to flash.
+    """
+    info = GblIndex().inspect(firmware_path)
+    problems = list(info["errors"])
+    tags = dict(info["tags"])
+    if "bootloader" in info["app_types"] or ("bootloader" in tags and "application" not in tags):
+        problems.append("bootloader upgrade image, not an application")
+    entry = (cache or LinkCache()).lookup(target) if target else None
+    product = entry.get("product") if entry else None
+    if product and info["product"] and product != info["product"]:
+        problems.append(f"image is for product {info['product']}, the radio on {target} runs {product}")
+    return info, problems
+
+
+def approve(firmware_path, target=None, force=False):
+    """Check an image before flashing and print the verdict, returns its info or None to stop"""
+    try:
+        info, problems = check_image(firmware_path, target)
+    except OSError as e:
+        print(f"✗ Firmware file not usable: {e}")
+        return None
+    print(f"Image: {describe(info)}")
+    for problem in problems:
+        print(f"{'⚠' if force else '✗'} {problem}")
+    if problems and not force:
+        print("Refusing to flash, use --force to override")
+        return None
+    return info
+
+
+def main():
+    paths = sys.argv[1:]
+    if not paths:
+        print("Usage: python3 xbee_gbl.py <firmware.gbl>...")
+        sys.exit(1)
+
+    failed = False
+    for path in paths:
+        try:
+            info, problems = check_image(path)
+        except OSError as e:
+            print(f"✗ {path}: {e}")
+            failed = True
+            continue
+        mark = "✗" if problems else "✓"
+        print(f"{mark} {path}: {describe(info)}")
+        print(f"  {info['size']} bytes, sha256 {info['sha256'][:16]}..., tags: "
+              f"{', '.join(name for name, _ in info['tags'])}")
+        for problem in problems:
+            print(f"  ✗ {problem}")
+        failed = failed or bool(problems)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
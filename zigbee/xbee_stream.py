@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+XBee Stream - Paced raw upload for bootloaders that don't take XMODEM
+
+Writes a memory-mapped image to the port no faster than the UART at the far
+end can send it on, with one of three pacing sources:
+
+    rtscts       hardware flow control, the driver blocks until CTS
+    out_waiting  local port, the driver's output queue is kept short
+    rate         over the bridge, a token bucket at the line rate (10 bits
+                 per byte) with a burst the ESP32 UART FIFO absorbs
+
+Progress reports bytes actually on the wire (sent minus still queued), not
+bytes handed to the driver.
+"""
+
+import mmap
+import time
+from contextlib import contextmanager
+
+import serial
+
+from xbee_xmodem import print_progress
+
+BITS_PER_BYTE = 10  # 8N1
+CHUNK_SIZE = 1024
+# Local driver queue is topped up to HIGH_WATER once it drains below LOW_WATER
+HIGH_WATER = 256
+LOW_WATER = 64
+# Largest burst ahead of the line rate over the bridge, the ESP32 UART FIFO size
+BRIDGE_BURST = 128
+RATE_MARGIN = 0.95
+
+
+@contextmanager
+def map_file(path):
+    """Read-only mmap of a file, b"" for an empty one (which can't be mapped)"""
+    with open(path, "rb") as f:
+        try:
+            image = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            yield b""
+            return
+        try:
+            yield image
+        finally:
+            image.close()
+
+
+def choose_pacing(ser, remote=False):
+    """Best pacing source the port offers"""
+    if ser.rtscts:
+        return "rtscts"
+    if not remote:
+        try:
+            ser.out_waiting
+            return "out_waiting"
+        except (AttributeError, OSError, serial.SerialException):
+            pass
+    return "rate"
+
+
+class StreamWriter:
+    """Write a bytes-like object (bytes, mmap) to a pyserial port at the pace it drains"""
+
+    def __init__(self, ser, pacing="rate", progress=print_progress):
+        self.serial = ser
+        self.pacing = pacing
+        self.progress = progress
+        self.line_rate = ser.baudrate / BITS_PER_BYTE
+        self.sent = 0
+        self.waits = 0  # times the writer had to hold back
+        self.started = None
+        self.tokens = BRIDGE_BURST
+        self.refilled = None
+
+    def queued(self):
+        """Bytes handed over but not yet on the wire, as far as we can tell"""
+        if self.pacing == "out_waiting":
+            return self.serial.out_waiting
+        if self.pacing == "rate":
+            return max(0, int(self.sent - (time.monotonic() - self.started) * self.line_rate * RATE_MARGIN))
+        return 0
+
+    def room(self):
+        """Bytes that can be written right now, and how long to wait if none"""
+        if self.pacing == "out_waiting":
+            queued = self.serial.out_waiting
+            if queued > LOW_WATER:
+                return 0, (queued - LOW_WATER) / self.line_rate
+            return HIGH_WATER - queued, 0.0
+        if self.pacing == "rate":
+            now = time.monotonic()
+            rate = self.line_rate * RATE_MARGIN
+            self.tokens = min(BRIDGE_BURST, self.tokens + (now - self.refilled) * rate)
+            self.refilled = now
+            # Refill half the burst before writing again, not single bytes
+            if self.tokens < BRIDGE_BURST / 2:
+                return 0, (BRIDGE_BURST / 2 - self.tokens) / rate
+            return int(self.tokens), 0.0
+        # The driver blocks on CTS itself
+        return CHUNK_SIZE, 0.0
+
+    def write(self, data):
+        """Stream data, returns once it has left the port"""
+        # Views are released even when the port fails, a mapped file can't
+        # close while one is still alive
+        with memoryview(data) as view:
+            total = len(view)
+            self.started = self.refilled = time.monotonic()
+            last_report = 0.0
+            while self.sent < total:
+                room, wait = self.room()
+                if room <= 0:
+                    self.waits += 1
+                    time.sleep(wait)
+                    continue
+                end = min(self.sent + room, self.sent + CHUNK_SIZE, total)
+                with view[self.sent:end] as chunk:
+                    self.serial.write(chunk)
+                if self.pacing == "rate":
+                    self.tokens -= end - self.sent
+                self.sent = end
+                if self.progress and (time.monotonic() - last_report > 0.25 or self.sent == total):
+                    last_report = time.monotonic()
+                    self.report(total)
+        self.drain()
+
+    def drain(self):
+        """Wait until everything written has been sent on"""
+        if self.pacing == "out_waiting":
+            self.serial.flush()
+        elif self.pacing == "rate":
+            time.sleep(self.queued() / (self.line_rate * RATE_MARGIN))
+
+    def rate(self):
+        """Bytes per second actually on the wire"""
+        elapsed = time.monotonic() - self.started if self.started else 0.0
+        return (self.sent - self.queued()) / elapsed if elapsed > 0 else 0.0
+
+    def report(self, total):
+        """Call the progress callback"""
+        rate = self.rate()
+        on_wire = self.sent - self.queued()
+        eta = (total - on_wire) / rate if rate > 0 else 0.0
+        self.progress(on_wire if self.sent < total else total, total, rate, eta)
+
+    def summary(self):
+        """One line of transfer statistics"""
+        elapsed = time.monotonic() - self.started if self.started else 0.0
+        return (f"{self.sent} bytes, {self.pacing} pacing, {self.waits} waits, {elapsed:.1f}s, "
+                f"{self.rate() / 1024:.1f} KB/s")
+
+
+def stream_file(ser, firmware_path, remote=False, **kwargs):
+    """Stream a file straight from its mapping, returns the writer for its statistics"""
+    writer = StreamWriter(ser, choose_pacing(ser, remote), **kwargs)
+    with map_file(firmware_path) as image:
+        writer.write(image)
+    return writer
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+XBee Transport - One persistent connection to an XBee, local or over the ESP32 bridge
+
+Targets are anything pyserial can open:
+    /tmp/ttyXBEE or /dev/ttyUSB0      local device or PTY
+    socket://192.168.1.100:8888       raw TCP to the serial_bridge component
+    rfc2217://192.168.1.100:8888      same, with remote baud/line control (rfc2217: true)
+
+The connection is opened once and kept for the whole session, baud changes go
+through the open port. Over socket:// the ESP32 UART keeps its configured baud
+rate, use rfc2217:// when probing other rates.
+"""
+
+import os
+
+import serial
+
+from xbee_bridge import control_path_for, wait_for_link
+from xbee_expect import POLL_INTERVAL, Expect
+
+DEFAULT_TARGET = os.environ.get("XBEE_TARGET", "/tmp/ttyXBEE")
+
+
+def is_url(target):
+    """True for pyserial URLs, False for device paths"""
+    return "://" in target
+
+
+class XBeeLink:
+    """Session wide connection, use as a context manager or call open()/close()"""
+
+    def __init__(self, target=DEFAULT_TARGET, baud=9600):
+        self.target = target
+        self.baud = baud
+        self.serial = None
+        self.console = None  # Expect reader on serial
+
+    @property
+    def remote(self):
+        """True when a network hop (ESP32 bridge) sits between us and the UART"""
+        return is_url(self.target) or os.path.exists(control_path_for(self.target))
+
+    def open(self):
+        """Open the connection, waiting for an xbee_bridge.py link to come up first"""
+        if not is_url(self.target) and os.path.exists(control_path_for(self.target)):
+            wait_for_link(self.target)
+        # Short and fixed, Expect polls with it and passes its own deadlines
+        self.serial = serial.serial_for_url(self.target, baudrate=self.baud, timeout=POLL_INTERVAL)
+        self.console = Expect(self.serial)
+        return self
+
+    def close(self):
+        """Close the connection"""
+        if self.serial is not None:
+            self.serial.close()
+            self.serial = None
+            self.console = None
+
+    def reopen(self):
+        """Connect again at the current baud rate after the connection dropped"""
+        self.close()
+        return self.open()
+
+    def set_baud(self, baud):
+        """Switch baud rate on the open connection"""
+        if baud != self.baud:
+            self.baud = baud
+            self.serial.baudrate = baud
+            # Anything read so far was at the old rate
+            self.console.discard()
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __str__(self):
+        return f"{self.target} at {self.baud} baud"
@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 """
 XBee Direct USB Flash - Flash XBee via direct USB-TTL connection
+
+Also works through the ESP32 bridge. Hardware bootloader entry (DTR, RTS and
+break) needs a local port or rfc2217://, plain socket:// can't carry them.
 """
 
 import serial
@@ -8,82 +11,70 @@ import time
 import sys
 import os
 
-def check_xbee_connection(device_path="/dev/ttyUSB0"):
-    """Check if XBee is connected and responding"""
+from xbee_at import describe
+from xbee_autobaud import autobaud, rank_candidates
+from xbee_cache import LinkCache, remember_radio
+from xbee_expect import BL_PROMPT, BOOTLOADER, GUARD_TIME
+from xbee_firmware_flash import BOOTLOADER_BAUD, enter_bootloader
+from xbee_gbl import approve
+from xbee_stream import stream_file
+from xbee_transport import XBeeLink, is_url
+from xbee_verify import finish_upload, run_firmware, verify_firmware
+from xbee_xmodem import XmodemError, XmodemSender, start_upload
+
+def check_xbee_connection(link):
+    """Check if XBee is connected and responding on an open XBeeLink, returns (baud, mode, AP value)"""
     
-    print(f"Checking XBee connection on {device_path}...")
+    print(f"Checking XBee connection on {link.target}...")
     
-    # Try different baud rates
-    baud_rates = [9600, 115200, 38400, 19200]
+    # Try different baud rates, one short probe each before falling back to +++
+    baud_rates = rank_candidates([9600, 115200, 38400, 19200])
     
-    for baud in baud_rates:
-        print(f"Testing at {baud} baud...")
+    cache = LinkCache()
+    try:
+        result = autobaud(link, baud_rates, cache=cache)
+        if result is None:
+            return None, None, None
         
-        try:
-            ser = serial.Serial(device_path, baud, timeout=3)
-            time.sleep(2)
-            
-            # Try AT command mode
-            ser.flushInput()
-            ser.flushOutput()
-            time.sleep(1.5)
-            ser.write(b'+++')
-            time.sleep(1.5)
-            
-            response = ser.read(100).decode('utf-8', errors='ignore')
-            print(f"  Response: {repr(response)}")
-            
-            if 'OK' in response:
-                print(f"✓ XBee responding at {baud} baud in AT mode")
-                
-                # Get version info
-                ser.write(b'ATVR\r')
-                time.sleep(1)
-                version = ser.read(100).decode('utf-8', errors='ignore')
-                print(f"  Firmware: {repr(version.strip())}")
-                
-                # Exit AT mode
-                ser.write(b'ATCN\r')
-                time.sleep(1)
-                
-                ser.close()
-                return baud, "at_mode"
-            
-            # Check if already in bootloader
-            ser.write(b'\r\n')
-            time.sleep(1)
-            response = ser.read(1000).decode('utf-8', errors='ignore')
-            
-            if "Gecko Bootloader" in response or "BL >" in response:
-                print(f"✓ XBee in bootloader mode at {baud} baud")
-                ser.close()
-                return baud, "bootloader"
-            
-            ser.close()
-            
-        except Exception as e:
-            print(f"  Error at {baud}: {e}")
+        print(f"  Answer after {result.elapsed:.2f}s")
+        if result.mode == "bootloader":
+            print(f"✓ XBee in bootloader mode at {result.baud} baud")
+            return result.baud, "bootloader", None
+        if result.mode == "api":
+            print(f"✓ XBee responding at {result.baud} baud in API mode (AP={result.api_mode})")
+            return result.baud, "api", result.api_mode
+        
+        print(f"✓ XBee responding at {result.baud} baud in AT mode")
+        
+        # Get version info
+        version = link.console.at("VR")
+        print(f"  Firmware: {repr(version)}")
+        cache.remember(link.target, firmware=version)
+        
+        # Exit AT mode
+        link.console.at("CN")
+        return result.baud, "at_mode", None
+        
+    except Exception as e:
+        print(f"  Error: {e}")
     
-    return None, None
+    return None, None, None
 
-def force_bootloader_hardware(device_path="/dev/ttyUSB0", baud_rate=9600):
+def force_bootloader_hardware(link, baud_rate=9600):
     """Force bootloader using hardware DTR/RTS control"""
     
     print("Attempting hardware bootloader entry...")
+    if link.target.startswith("socket://"):
+        print("✗ No DTR/RTS/break over socket://, use rfc2217:// (rfc2217: true on the bridge)")
+        return False
     
     try:
-        # Open with DTR/RTS control
-        ser = serial.Serial(
-            device_path, 
-            baud_rate, 
-            timeout=5,
-            dsrdtr=True,   # Enable DTR/DSR
-            rtscts=True    # Enable RTS/CTS
-        )
+        ser = link.serial
+        link.set_baud(baud_rate)
         
         print("Setting DTR low, RTS high...")
-        ser.setDTR(False)  # DTR low
-        ser.setRTS(True)   # RTS high
+        ser.dtr = False  # DTR low
+        ser.rts = True   # RTS high
         time.sleep(0.5)
         
         print("Sending break signal...")
@@ -91,50 +82,47 @@ def force_bootloader_hardware(device_path="/dev/ttyUSB0", baud_rate=9600):
         time.sleep(0.5)
         
         print("Setting DTR and DIN low, RTS high...")
-        ser.setDTR(False)  # DTR low
-        ser.setRTS(True)   # RTS high
+        ser.dtr = False  # DTR low
+        ser.rts = True   # RTS high
         time.sleep(0.5)
         
         # Switch to 115200 for bootloader
-        ser.close()
-        ser = serial.Serial(device_path, 115200, timeout=5)
-        time.sleep(1)
+        link.set_baud(BOOTLOADER_BAUD)
+        console = link.console
         
         print("Sending carriage return at 115200...")
-        ser.write(b'\r')
-        time.sleep(2)
+        console.write(b'\r')
         
-        response = ser.read(1000).decode('utf-8', errors='ignore')
+        _, response = console.expect(BOOTLOADER, 2)
+        response = response.decode('utf-8', errors='ignore')
         print(f"Bootloader response: {repr(response)}")
         
         if "Gecko Bootloader" in response or "BL >" in response:
             print("✓ Hardware bootloader entry successful!")
-            ser.close()
             return True
         
-        ser.close()
         return False
         
     except Exception as e:
         print(f"✗ Hardware bootloader entry failed: {e}")
         return False
 
-def flash_firmware_direct(firmware_path, device_path="/dev/ttyUSB0"):
-    """Flash firmware directly via USB-TTL"""
+def flash_firmware_direct(firmware_path, link, app_baud=None):
+    """Flash firmware over an open XBeeLink, app_baud is the rate the old firmware ran at"""
     
     if not os.path.exists(firmware_path):
         print(f"✗ Firmware file not found: {firmware_path}")
         return False
     
     try:
-        print(f"Connecting to bootloader at {device_path}...")
-        ser = serial.Serial(device_path, 115200, timeout=30)
-        time.sleep(2)
+        print(f"Connecting to bootloader at {link.target}...")
+        link.set_baud(BOOTLOADER_BAUD)
+        console = link.console
         
         # Get bootloader menu
-        ser.write(b'\r')
-        time.sleep(1)
-        response = ser.read(1000).decode('utf-8', errors='ignore')
+        console.write(b'\r')
+        _, response = console.expect(BL_PROMPT, 1)
+        response = response.decode('utf-8', errors='ignore')
         print(f"Bootloader menu: {response}")
         
         if "BL >" not in response and "Gecko Bootloader" not in response:
@@ -143,162 +131,148 @@ def flash_firmware_direct(firmware_path, device_path="/dev/ttyUSB0"):
         
         # Start firmware upload
         print("Starting firmware upload (option 1)...")
-        ser.write(b'1')
-        time.sleep(2)
-        
-        # Check if ready for XMODEM
-        response = ser.read(100).decode('utf-8', errors='ignore')
-        print(f"Upload ready response: {repr(response)}")
+        if not start_upload(console):
+            print("✗ Bootloader did not start the upload")
+            return False
         
         # Try XMODEM upload
+        print("Using XMODEM protocol...")
+        sender = XmodemSender(console)
         try:
-            from xmodem import XMODEM
-            print("Using XMODEM protocol...")
-            
             with open(firmware_path, 'rb') as f:
-                def getc(size, timeout=30):
-                    return ser.read(size) or None
-                
-                def putc(data, timeout=30):
-                    return ser.write(data)
-                
-                modem = XMODEM(getc, putc)
-                success = modem.send(f)
-                
-                if success:
-                    print("✓ XMODEM transfer completed!")
-                else:
-                    print("✗ XMODEM transfer failed")
-                    return False
-                    
-        except ImportError:
-            print("XMODEM library not available, trying binary upload...")
+                sender.send(f.read())
+            print("✓ XMODEM transfer completed!")
+            print(f"  {sender.summary()}")
+        except XmodemError as e:
+            if sender.blocks:
+                print(f"✗ XMODEM transfer failed: {e}")
+                return False
+            print(f"XMODEM not accepted ({e}), trying binary upload...")
             
-            # Read and upload firmware
-            with open(firmware_path, 'rb') as f:
-                firmware_data = f.read()
-            
-            print(f"Uploading {len(firmware_data)} bytes...")
-            
-            # Upload in 1KB chunks
-            chunk_size = 1024
-            total_chunks = (len(firmware_data) + chunk_size - 1) // chunk_size
-            
-            for i in range(0, len(firmware_data), chunk_size):
-                chunk = firmware_data[i:i+chunk_size]
-                ser.write(chunk)
-                
-                chunk_num = i // chunk_size + 1
-                if chunk_num % 10 == 0:
-                    progress = 100 * chunk_num // total_chunks
-                    print(f"  Progress: {progress}% ({chunk_num}/{total_chunks})")
-                
-                time.sleep(0.01)
+            print(f"Uploading {os.path.getsize(firmware_path)} bytes...")
+            writer = stream_file(link.serial, firmware_path, remote=link.remote)
+            print(f"  {writer.summary()}")
         
-        # Wait for completion
+        # Completion message and the menu after it, as soon as they arrive
         print("Waiting for firmware processing...")
-        time.sleep(10)
-        
-        response = ser.read(1000).decode('utf-8', errors='ignore')
+        completed, response = finish_upload(console)
         print(f"Processing response: {repr(response)}")
+        if not completed:
+            print("✗ Bootloader did not accept the image")
+            return False
         
         # Run firmware (option 2)
         print("Running new firmware (option 2)...")
-        ser.write(b'2')
-        time.sleep(5)
+        run_firmware(console)
         
-        response = ser.read(1000).decode('utf-8', errors='ignore')
-        print(f"Run response: {repr(response)}")
-        
-        ser.close()
-        
-        # Test new firmware
+        # Test new firmware on the same port, polling until it answers
         print("Testing new firmware...")
-        time.sleep(5)
+        result = verify_firmware(link, rank_candidates([app_baud], [115200, 9600]))
         
-        test_baud, test_mode = check_xbee_connection(device_path)
-        if test_baud:
-            print(f"✓ XBee responding at {test_baud} baud in {test_mode} mode")
-            return True
-        else:
+        if result is None:
             print("⚠ XBee not responding after firmware flash")
             return False
+        if result.mode == "bootloader":
+            print("✗ Firmware did not start, the bootloader is back")
+            return False
+        print(f"✓ XBee responding at {result.baud} baud in {result.mode} mode, "
+              f"firmware {describe('VR', result.info['VR'])} after {result.elapsed:.1f}s")
+        remember_radio(LinkCache(), link.target, result.baud, result.mode, result.info)
+        return True
             
     except Exception as e:
         print(f"✗ Firmware flash failed: {e}")
         return False
 
 def main():
-    device_path = "/dev/ttyUSB0"
-    
-    if len(sys.argv) != 2:
-        print("Usage: python xbee_usb_flash.py <firmware.gbl>")
-        print("Example: python xbee_usb_flash.py XB3-24Z/XB3-24Z_1014-th.gbl")
+    args = [arg for arg in sys.argv[1:] if arg != "--force"]
+    force = len(args) < len(sys.argv) - 1
+    if len(args) not in (1, 2):
+        print("Usage: python xbee_usb_direct_flash.py <firmware.gbl> [device or URL] [--force]")
+        print("Example: python xbee_usb_direct_flash.py XB3-24Z/XB3-24Z_1014-th.gbl rfc2217://192.168.1.100:8888")
         sys.exit(1)
     
-    firmware_path = sys.argv[1]
+    firmware_path = args[0]
+    device_path = args[1] if len(args) == 2 else "/dev/ttyUSB0"
     
     print("XBee Direct USB Flash")
     print("====================")
     print(f"Device: {device_path}")
     print(f"Firmware: {firmware_path}")
+    
+    # A broken or wrong image is turned away before the radio is touched
+    image = approve(firmware_path, device_path, force)
+    if image is None:
+        sys.exit(1)
     print()
     
     # Check if device exists
-    if not os.path.exists(device_path):
+    if not is_url(device_path) and not os.path.exists(device_path):
         print(f"✗ Device {device_path} not found")
         print("Make sure XBee is connected via USB-TTL adapter")
         return
     
-    # Step 1: Check current XBee status
-    current_baud, current_mode = check_xbee_connection(device_path)
+    # The firmware comes back at the rate it ran at before. Read that from the
+    # cache first, probing a radio in the bootloader stores 115200 over it.
+    entry = LinkCache().lookup(device_path)
+    before = entry if entry and entry.get("mode") != "bootloader" else {}
+    
+    # One connection for the whole session, closed on every way out
+    try:
+        link = XBeeLink(device_path, 9600).open()
+    except serial.SerialException as e:
+        print(f"✗ Could not open {device_path}: {e}")
+        return
     
-    if current_mode == "bootloader":
-        print("✓ XBee already in bootloader mode")
-    elif current_mode == "at_mode":
-        print("XBee in AT mode, attempting to invoke bootloader...")
+    with link:
+        # Step 1: Check current XBee status
+        current_baud, current_mode, api_mode = check_xbee_connection(link)
+        app_baud = current_baud if current_mode in ("at_mode", "api") else before.get("baud")
+        guard_time = before.get("guard_time", GUARD_TIME)
         
-        # Try software bootloader invocation
-        try:
-            ser = serial.Serial(device_path, current_baud, timeout=5)
-            time.sleep(2)
-            
-            # Enter AT mode and send %P
-            ser.write(b'+++\r')
-            time.sleep(2)
-            ser.write(b'AT%P\r')
-            time.sleep(3)
+        if current_mode == "bootloader":
+            print("✓ XBee already in bootloader mode")
+        elif current_mode == "at_mode":
+            print("XBee in AT mode, attempting to invoke bootloader...")
             
-            response = ser.read(1000).decode('utf-8', errors='ignore')
-            if "Gecko Bootloader" in response:
+            # Try software bootloader invocation, +++ and AT%P
+            link.set_baud(current_baud)
+            if enter_bootloader(link, guard_time=guard_time):
                 print("✓ Software bootloader entry successful")
             else:
                 print("Software method failed, trying hardware method...")
-                ser.close()
-                if not force_bootloader_hardware(device_path, current_baud):
+                if not force_bootloader_hardware(link, current_baud):
                     print("✗ Could not enter bootloader mode")
                     return
+        elif current_mode == "api":
+            print("XBee in API mode, attempting to invoke bootloader...")
             
-            ser.close()
-            
-        except Exception as e:
-            print(f"Error invoking bootloader: {e}")
-            return
-    else:
-        print("XBee not responding, trying hardware bootloader entry...")
-        if not force_bootloader_hardware(device_path):
-            print("✗ Could not enter bootloader mode")
-            return
-    
-    # Step 2: Flash firmware
-    print("\n" + "="*50)
-    print("Starting firmware flash...")
-    print("="*50)
-    
-    success = flash_firmware_direct(firmware_path, device_path)
+            # +++ and AT%P are text, in API mode %P goes as a Local AT Command frame
+            link.set_baud(current_baud)
+            if enter_bootloader(link, "api", api_mode):
+                print("✓ Software bootloader entry successful")
+            else:
+                print("Software method failed, trying hardware method...")
+                if not force_bootloader_hardware(link, current_baud):
+                    print("✗ Could not enter bootloader mode")
+                    return
+        else:
+            print("XBee not responding, trying hardware bootloader entry...")
+            if not force_bootloader_hardware(link):
+                print("✗ Could not enter bootloader mode")
+                return
+        
+        # Step 2: Flash firmware
+        print("\n" + "="*50)
+        print("Starting firmware flash...")
+        print("="*50)
+        
+        success = flash_firmware_direct(firmware_path, link, app_baud)
     
     if success:
         print("\n✓ Firmware flash completed successfully!")
+        if image["product"]:
+            LinkCache().remember(device_path, product=image["product"])
     else:
         print("\n✗ Firmware flash failed")
 
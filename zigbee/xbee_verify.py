@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+XBee Verify - Boot freshly flashed firmware and confirm it answers
+
+Instead of sleeping through the bootloader's processing and the firmware's
+boot, the completion message is awaited as it arrives, option 2 goes out
+straight after, and the radio is polled with short probes until ATVR comes
+back or the deadline passes. Everything happens on the open connection.
+"""
+
+import time
+from collections import namedtuple
+
+from xbee_api import ApiClient
+from xbee_at import query
+from xbee_autobaud import probe
+from xbee_expect import BL_PROMPT, GUARD_TIME
+
+UPLOAD_ABORTED = b"aborted"
+PROCESSING_TIMEOUT = 10.0
+BOOT_TIMEOUT = 20.0
+# Only probes while the firmware boots, +++ after that (transparent mode)
+PROBE_WINDOW = 3.0
+
+# Enough to tie the result to the radio in the link cache
+VERIFY_PARAMETERS = ("VR", "SH", "SL")
+
+VerifyResult = namedtuple("VerifyResult", ["baud", "mode", "info", "elapsed"])
+
+
+def finish_upload(console, timeout=PROCESSING_TIMEOUT):
+    """Wait for the bootloader to report the upload and show its menu again
+
+    Returns (ok, what it said), ok is False if it reported an abort or never
+    came back.
+    """
+    pattern, data = console.expect(BL_PROMPT, timeout)
+    ok = pattern is not None and UPLOAD_ABORTED not in data.lower()
+    return ok, data.decode("utf-8", errors="ignore")
+
+
+def run_firmware(console):
+    """Menu option 2, the application starts right away"""
+    console.write(b"2")
+
+
+def read_firmware(link, mode, guard_time=GUARD_TIME, names=VERIFY_PARAMETERS, api_mode=None):
+    """Query names in the mode the radio answered in, None if VR didn't come back
+
+    api_mode is the AP value the probe reported, for "api" radios.
+    """
+    console = link.console
+    if mode == "api":
+        if api_mode:
+            info = ApiClient(console, escaped=api_mode == 2).query(names)
+            return info if info["VR"] is not None else None
+        # AP=1 or AP=2 isn't known. Short values like VR decode either
+        # way, an escaped byte elsewhere breaks the unescaped decoder.
+        for escaped in (False, True):
+            client = ApiClient(console, escaped)
+            info = client.query(names)
+            if not client.decoder.errors:
+                break
+        return info if info["VR"] is not None else None
+    if mode != "at_mode":
+        # Transparent mode only answers +++
+        entered, _ = console.command_mode(guard_time)
+        if not entered:
+            return None
+    info = query(console, names)
+    console.at("CN")
+    return info if info["VR"] is not None else None
+
+
+def verify_firmware(link, bauds, timeout=BOOT_TIMEOUT, guard_time=GUARD_TIME):
+    """Poll the new firmware at bauds until it answers, returns VerifyResult or None
+
+    A mode of "bootloader" means the image didn't start and the bootloader
+    took over again.
+    """
+    start = time.monotonic()
+    deadline = start + timeout
+    while time.monotonic() < deadline:
+        # Short probes at every rate first, +++ with its guard times only after
+        for baud in bauds:
+            link.set_baud(baud)
+            mode, api_mode = probe(link.console)
+            if mode == "bootloader":
+                return VerifyResult(baud, mode, None, time.monotonic() - start)
+            if mode:
+                info = read_firmware(link, mode, guard_time, api_mode=api_mode)
+                if info:
+                    return VerifyResult(baud, mode, info, time.monotonic() - start)
+        if time.monotonic() - start < PROBE_WINDOW:
+            # Still booting, most likely
+            continue
+        for baud in bauds:
+            if time.monotonic() >= deadline:
+                break
+            link.set_baud(baud)
+            info = read_firmware(link, None, guard_time)
+            if info:
+                return VerifyResult(baud, "at_mode", info, time.monotonic() - start)
+    return None
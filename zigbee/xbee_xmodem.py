@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+"""
+XBee XMODEM - Firmware upload engine for the Gecko bootloader
+
+XMODEM-CRC sender that starts with 1K blocks (STX) and drops to 128-byte
+blocks (SOH) for the rest of the transfer if the receiver refuses the first
+one. Every packet goes out in a single write and replies are read in bulk
+from the console buffer, not one getc() per byte. Progress, throughput and
+ETA are reported through a callback.
+
+Every acknowledged block is journaled to disk. When the bridge drops
+mid-upload, upload() reconnects, finds out where the bootloader is and
+carries on: with the next block if the receiver is still waiting for it, from
+block 1 if it restarted, or through menu option 1 if it gave up. A new run
+picks up the same journal, so no baud probing is needed to continue.
+"""
+
+import binascii
+import hashlib
+import json
+import os
+import re
+import time
+
+import serial
+
+from xbee_cache import CACHE_DIR, write_json
+from xbee_expect import BOOTLOADER
+
+SOH = 0x01
+STX = 0x02
+EOT = 0x04
+ACK = 0x06
+NAK = 0x15
+CAN = 0x18
+CRC_REQUEST = ord("C")
+PAD = 0x1A
+
+SMALL_BLOCK = 128
+LARGE_BLOCK = 1024
+# Attempts at the first 1K block before settling for 128-byte blocks
+NEGOTIATION_RETRIES = 2
+
+JOURNAL_DIR = os.path.join(CACHE_DIR, "flash")
+RECONNECT_ATTEMPTS = 5
+RECONNECT_DELAY = 1.0
+LOCATE_TIMEOUT = 3.0
+
+BEGIN_UPLOAD = b"begin upload"
+
+
+class XmodemError(Exception):
+    """Transfer aborted"""
+
+
+def print_progress(sent, total, rate, eta):
+    """Default progress callback, one updating line"""
+    percent = 100 * sent // total if total else 100
+    print(f"\r  {percent:3d}% {sent}/{total} bytes, {rate / 1024:.1f} KB/s, ETA {eta:.0f}s ", end="", flush=True)
+    if sent >= total:
+        print()
+
+
+class XmodemSender:
+    """Send a bytes-like object (bytes, mmap, memoryview) over an Expect console"""
+
+    def __init__(self, console, block_size=LARGE_BLOCK, retries=10, timeout=10.0, progress=print_progress,
+                 journal=None):
+        self.console = console
+        self.block_size = block_size
+        self.retries = retries
+        self.timeout = timeout
+        self.progress = progress
+        self.journal = journal
+        self.crc = True
+        self.number = 1  # next block to send
+        self.sent = 0
+        self.blocks = 0
+        self.retransmits = 0
+        self.started = None
+        self.offset = 0  # bytes acknowledged before this run, not counted in the rate
+
+    def restart(self):
+        """Back to block 1, keeping the negotiated block size"""
+        self.number = 1
+        self.sent = 0
+        self.blocks = 0
+
+    def restore(self, entry):
+        """Continue where a journal entry left off"""
+        self.number = entry["number"]
+        self.sent = entry["sent"]
+        self.blocks = entry["blocks"]
+        self.block_size = entry["block_size"]
+        self.crc = entry.get("crc", True)
+        self.offset = self.sent
+
+    def wait_for_receiver(self):
+        """Receiver asks for CRC mode with 'C' (or checksum mode with NAK)"""
+        deadline = time.monotonic() + self.timeout
+        while time.monotonic() < deadline:
+            data = self.console.read_some(deadline - time.monotonic())
+            if CRC_REQUEST in data:
+                self.crc = True
+                return
+            if NAK in data:
+                self.crc = False
+                return
+            if data.count(CAN) >= 2:
+                raise XmodemError("cancelled by receiver")
+        raise XmodemError("receiver never asked for data")
+
+    def packet(self, number, payload, size):
+        """One complete packet, header to CRC"""
+        block = bytes(payload)
+        if len(block) < size:
+            block += bytes((PAD,)) * (size - len(block))
+        header = bytes((STX if size == LARGE_BLOCK else SOH, number & 0xFF, 0xFF - (number & 0xFF)))
+        if self.crc:
+            trailer = binascii.crc_hqx(block, 0).to_bytes(2, "big")
+        else:
+            trailer = bytes((sum(block) & 0xFF,))
+        return header + block + trailer
+
+    def wait_for_reply(self):
+        """ACK, NAK or CAN for the packet just sent, None on timeout"""
+        deadline = time.monotonic() + self.timeout
+        cancels = 0
+        while time.monotonic() < deadline:
+            data = self.console.read_some(deadline - time.monotonic())
+            # Anything else (stray 'C's from before the first block, line
+            # noise) is skipped over
+            for index, byte in enumerate(data):
+                if byte == CAN:
+                    cancels += 1
+                if byte in (ACK, NAK) or cancels >= 2:
+                    # What follows (the bootloader's messages) is for the next reader
+                    self.console.buffer[:0] = data[index + 1:]
+                    return byte
+        return None
+
+    def send_packet(self, number, payload, size, retries):
+        """Send until ACKed, False if the receiver keeps refusing it"""
+        packet = self.packet(number, payload, size)
+        for attempt in range(retries):
+            if attempt:
+                self.retransmits += 1
+            self.console.write(packet)
+            reply = self.wait_for_reply()
+            if reply == ACK:
+                return True
+            if reply == CAN:
+                raise XmodemError("cancelled by receiver")
+        return False
+
+    def report(self, total):
+        """Call the progress callback"""
+        if self.progress is None:
+            return
+        rate = self.rate()
+        eta = (total - self.sent) / rate if rate > 0 else 0.0
+        self.progress(self.sent, total, rate, eta)
+
+    def rate(self):
+        """Bytes per second acknowledged in this run"""
+        elapsed = time.monotonic() - self.started if self.started else 0.0
+        return (self.sent - self.offset) / elapsed if elapsed > 0 else 0.0
+
+    def send(self, data):
+        """Transfer data from the first block, True once the receiver acknowledged the end of transmission"""
+        self.started = time.monotonic()
+        self.wait_for_receiver()
+        return self.transfer(data)
+
+    def transfer(self, data):
+        """Send from the current block on, for a receiver that is already listening"""
+        view = memoryview(data)
+        total = len(view)
+        if self.started is None:
+            self.started = time.monotonic()
+
+        while self.sent < total:
+            number = self.number
+            size = self.block_size
+            payload = view[self.sent:self.sent + size]
+            negotiating = size == LARGE_BLOCK and self.blocks == 0
+            retries = NEGOTIATION_RETRIES if negotiating else self.retries
+            if not self.send_packet(number, payload, size, retries):
+                if negotiating:
+                    # No 1K support, the rest goes in 128-byte blocks
+                    self.block_size = SMALL_BLOCK
+                    continue
+                raise XmodemError(f"block {number} refused {self.retries} times")
+            self.sent += len(payload)
+            self.blocks += 1
+            self.number += 1
+            if self.journal:
+                self.journal.record(self)
+            self.report(total)
+
+        for _ in range(self.retries):
+            self.console.write(bytes((EOT,)))
+            if self.wait_for_reply() == ACK:
+                return True
+        raise XmodemError("end of transmission not acknowledged")
+
+    def summary(self):
+        """One line of transfer statistics"""
+        elapsed = time.monotonic() - self.started if self.started else 0.0
+        resumed = f", resumed at {self.offset} bytes" if self.offset else ""
+        return (f"{self.sent} bytes in {self.blocks} blocks of {self.block_size}, "
+                f"{self.retransmits} retransmits, {elapsed:.1f}s, {self.rate() / 1024:.1f} KB/s{resumed}")
+
+
+class FlashJournal:
+    """Last acknowledged block of an upload to one target, kept on disk until it completes"""
+
+    def __init__(self, target, data=None, directory=JOURNAL_DIR):
+        self.target = target
+        name = re.sub(r"[^A-Za-z0-9.]+", "_", target).strip("_")
+        self.path = os.path.join(directory, f"{name}.json")
+        # Without data, any upload to the target matches
+        self.digest = hashlib.sha256(data).hexdigest() if data is not None else None
+
+    def load(self):
+        """The interrupted upload of this firmware, None if there is none"""
+        try:
+            with open(self.path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if self.digest is not None and entry.get("firmware") != self.digest:
+            return None
+        return entry
+
+    def record(self, sender):
+        """Write the sender's position, called after every ACK"""
+        write_json(self.path, {
+            "target": self.target,
+            "firmware": self.digest,
+            "number": sender.number,
+            "sent": sender.sent,
+            "blocks": sender.blocks,
+            "block_size": sender.block_size,
+            "crc": sender.crc,
+            "updated": time.time(),
+        })
+
+    def clear(self):
+        """Upload finished or can't be continued"""
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def start_upload(console, timeout=2.0):
+    """Menu option 1, True once the bootloader is ready to receive"""
+    console.write(b"1")
+    pattern, _ = console.expect(BEGIN_UPLOAD, timeout)
+    return pattern is not None
+
+
+def locate(console, timeout=LOCATE_TIMEOUT):
+    """Where the bootloader is after a reconnect
+
+    "receiving" - mid-transfer, NAKs while it waits for the next block
+    "waiting"   - restarted its receive, asks for block 1 with 'C'
+    "menu"      - gave up the upload, back at BL >
+    None        - no bootloader, the application is running or the radio is gone
+    """
+    received = bytearray()
+    deadline = time.monotonic() + timeout
+    poked = False
+    while time.monotonic() < deadline:
+        received += console.read_some(deadline - time.monotonic())
+        if any(pattern in received for pattern in BOOTLOADER):
+            return "menu"
+        if NAK in received:
+            return "receiving"
+        if CRC_REQUEST in received:
+            return "waiting"
+        if not poked and deadline - time.monotonic() < timeout / 2:
+            # A CR is no packet header, a receiver NAKs it and the menu reprints itself
+            console.write(b"\r")
+            poked = True
+    return None
+
+
+def reconnect(link, attempts=RECONNECT_ATTEMPTS, delay=RECONNECT_DELAY):
+    """Reopen link at the same baud rate, waiting a little longer after each failure"""
+    for attempt in range(attempts):
+        try:
+            return link.reopen()
+        except (OSError, serial.SerialException):
+            time.sleep(delay * (attempt + 1))
+    raise XmodemError(f"could not reconnect to {link.target}")
+
+
+def upload(link, sender, data, state="start", reconnects=RECONNECT_ATTEMPTS):
+    """Upload data with sender to the bootloader on link, riding out dropped connections
+
+    state is what locate() returned, or "start" right after menu option 1.
+    Raises XmodemError when the upload can't be completed, sender.blocks
+    tells whether the receiver ever took a block.
+    """
+    journal = sender.journal
+    entry = journal.load() if journal else None
+    if state == "receiving" and entry:
+        sender.restore(entry)
+    elif state == "receiving":
+        raise XmodemError("bootloader is mid-transfer, but there is no journal to resume from")
+
+    interruptions = 0
+    while True:
+        try:
+            if state == "menu":
+                if not start_upload(link.console):
+                    raise XmodemError("bootloader did not accept option 1")
+                state = "start"
+            if state == "start":
+                sender.restart()
+                sender.send(data)
+            elif state == "waiting":
+                sender.restart()
+                sender.transfer(data)
+            else:
+                sender.transfer(data)
+            break
+        except (OSError, serial.SerialException, XmodemError) as e:
+            lost = not isinstance(e, XmodemError)
+            # A receiver that never took a block doesn't do XMODEM, let the caller decide
+            if (not lost and sender.blocks == 0) or interruptions >= reconnects:
+                raise
+            interruptions += 1
+            print(f"\n⚠ Upload interrupted at block {sender.number}: {e}")
+            if lost:
+                reconnect(link)
+                sender.console = link.console
+            state = locate(link.console)
+            if state is None:
+                if journal:
+                    journal.clear()
+                raise XmodemError("bootloader not found after reconnect")
+            print(f"  Bootloader {state}, continuing")
+
+    if journal:
+        journal.clear()
+    return True
+
+
+def send_file(console, firmware_path, **kwargs):
+    """Upload a file, returns the sender for its statistics"""
+    with open(firmware_path, "rb") as f:
+        data = f.read()
+    sender = XmodemSender(console, **kwargs)
+    sender.send(data)
+    return sender